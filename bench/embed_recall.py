@@ -0,0 +1,125 @@
+"""
+Embedding wire formats (EMBED_WIRE_FORMAT): size, parse time and how much
+matching quality the quantized formats give up against float32.
+
+    # synthetic identities (no model needed)
+    python bench/embed_recall.py --ids 200 --per-id 10
+
+    # real embeddings dumped from reid: an .npz with embs (N x D) and labels (N,)
+    python bench/embed_recall.py --npz reid_dump.npz --json embed.json
+
+For each format every embedding is used as a query against all others, exactly as
+the linker compares them: rows kept in wire precision (int8 stays int8) and scored
+with utils.codec.embedding_scores. Reported per format:
+  recall@1        nearest neighbour has the same identity
+  top1_agreement  same nearest neighbour as float32
+  decision_flips  pairs whose "same person" decision at SIM_THRESHOLD differs from float32
+
+The script exits 1 if a format is outside TOLERANCE against float32, so a change
+to pack_embedding or its scale cannot silently degrade matching.
+"""
+import argparse, json, time
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import numpy as np
+import config
+from utils.codec import pack_embedding, unpack_embedding, embedding_scores
+
+FORMATS = ("json", "f16", "i8")
+# format -> (max recall@1 drop vs float32, max decision flips as a fraction of all pairs)
+TOLERANCE = {"json": (0.0, 0.0), "f16": (0.0, 0.0), "i8": (0.01, 1e-5)}
+
+def synthetic(ids, per_id, dim, noise, seed):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((ids, dim)).astype(np.float32)
+    embs = np.repeat(centers, per_id, axis=0) + noise * rng.standard_normal((ids * per_id, dim)).astype(np.float32)
+    return embs, np.repeat(np.arange(ids), per_id)
+
+def unit(x):
+    return (x / (np.linalg.norm(x, axis=1, keepdims=True) + 1e-12)).astype(np.float32)
+
+def wire(embs, fmt):
+    """Round-trip through the wire format; returns (bodies, matrix in wire precision, row scales, parse seconds)."""
+    bodies = [json.dumps(pack_embedding(e, fmt)) for e in embs]
+    t0 = time.perf_counter()
+    rows = []
+    for b in bodies:
+        a = json.loads(b)
+        packed = unpack_embedding(a)
+        rows.append(np.asarray(a["embedding"], dtype=np.float32) if packed is None else packed)
+    parse_s = time.perf_counter() - t0
+    mat = np.stack([r if isinstance(r, np.ndarray) else r[0] for r in rows])
+    scales = np.array([1.0 if isinstance(r, np.ndarray) else r[1] for r in rows], dtype=np.float32)
+    return bodies, mat, scales, parse_s
+
+def similarities(mat, scales):
+    """All-pairs similarity, one embedding_scores call per query as in Linker.assign."""
+    return np.stack([embedding_scores(mat, scales, q, s) for q, s in zip(mat, scales)])
+
+def evaluate(sim, labels, ref_top1=None, ref_same=None, thr=None):
+    np.fill_diagonal(sim, -np.inf)
+    top1 = sim.argmax(axis=1)
+    out = {"recall@1": float((labels[top1] == labels).mean())}
+    same = sim >= thr
+    if ref_top1 is not None:
+        out["top1_agreement"] = float((top1 == ref_top1).mean())
+        iu = np.triu_indices(len(labels), 1)
+        out["decision_flips"] = int((same[iu] != ref_same[iu]).sum())
+    return out, top1, same
+
+def check(report):
+    """Messages for every format outside TOLERANCE; empty if all pass."""
+    n = report["n"]; pairs = n * (n - 1) // 2
+    errors = []
+    for fmt, q in report["formats"].items():
+        max_drop, max_flips = TOLERANCE[fmt]
+        drop = report["float32"]["recall@1"] - q["recall@1"]
+        if drop > max_drop + 1e-9:
+            errors.append(f"{fmt}: recall@1 {q['recall@1']:.4f} is {drop:.4f} below float32 (allowed {max_drop})")
+        if q["decision_flips"] > max_flips * pairs:
+            errors.append(f"{fmt}: {q['decision_flips']} decision flips (allowed {int(max_flips * pairs)} of {pairs} pairs)")
+    return errors
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--npz", help="real embeddings: arrays 'embs' and 'labels'")
+    ap.add_argument("--ids", type=int, default=200)
+    ap.add_argument("--per-id", type=int, default=10)
+    ap.add_argument("--dim", type=int, default=512)
+    ap.add_argument("--noise", type=float, default=1.2, help="synthetic within-identity spread")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--threshold", type=float, default=config.SIM_THRESHOLD)
+    ap.add_argument("--json", help="also write the report as JSON to this path")
+    args = ap.parse_args()
+
+    if args.npz:
+        d = np.load(args.npz)
+        embs, labels = d["embs"].astype(np.float32), d["labels"]
+    else:
+        embs, labels = synthetic(args.ids, args.per_id, args.dim, args.noise, args.seed)
+    embs = unit(embs)
+
+    ref, ref_top1, ref_same = evaluate(embs @ embs.T, labels, thr=args.threshold)
+    report = {"n": len(embs), "dim": embs.shape[1], "threshold": args.threshold, "float32": ref, "formats": {}}
+    base_bytes = base_parse = None
+    for fmt in FORMATS:
+        bodies, mat, scales, parse_s = wire(embs, fmt)
+        q, _, _ = evaluate(similarities(mat, scales), labels, ref_top1, ref_same, args.threshold)
+        nbytes = sum(len(b) for b in bodies) / len(bodies)
+        if fmt == "json":
+            base_bytes, base_parse = nbytes, parse_s
+        q.update({"bytes_per_embedding": round(nbytes, 1),
+                  "parse_us_per_embedding": round(parse_s / len(bodies) * 1e6, 2),
+                  "size_vs_json": round(base_bytes / nbytes, 2),
+                  "parse_speedup_vs_json": round(base_parse / parse_s, 2) if parse_s else None})
+        report["formats"][fmt] = q
+    report["errors"] = check(report)
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as f: json.dump(report, f, indent=2)
+    if report["errors"]:
+        for e in report["errors"]: print(e, file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
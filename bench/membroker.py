@@ -0,0 +1,78 @@
+"""
+In-memory stand-in for a pika channel.
+
+Stage callbacks (`on_frame`, `on_detections`, ...) only touch the channel through
+basic_publish / basic_ack / basic_nack and connection.add_callback_threadsafe, so the harness can run one or more stages
+in-process, in order, without RabbitMQ. Messages are queued per binding and
+delivered by `drain()`; CPU time spent inside each callback is accounted per stage.
+"""
+import time
+from collections import deque, defaultdict
+from types import SimpleNamespace
+
+class MemChannel:
+    def __init__(self):
+        self.bindings = defaultdict(list)   # (exchange, routing_key) -> [stage names]
+        self.consumers = {}                 # stage -> callback
+        self.queues = defaultdict(deque)    # stage -> deque[(method, props, body)]
+        self.taps = defaultdict(list)       # (exchange, routing_key) -> [fn(props, body)]
+        self.cpu_s = defaultdict(float)     # stage -> thread CPU seconds inside its callback
+        self.delivered = defaultdict(int)
+        self.acked = self.nacked = 0
+        self._tag = 0
+        self._deferred = deque()            # add_callback_threadsafe callbacks
+        self.connection = self
+        self.is_open = True
+
+    # --- wiring ---
+    def consume(self, stage, exchange, routing_key, callback):
+        self.bindings[(exchange, routing_key)].append(stage)
+        self.consumers[stage] = callback
+
+    def tap(self, exchange, routing_key, fn):
+        self.taps[(exchange, routing_key)].append(fn)
+
+    # --- the subset of the pika channel API used by the services ---
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        props = properties if properties is not None else SimpleNamespace(headers=None)
+        for fn in self.taps.get((exchange, routing_key), ()):
+            fn(props, body)
+        for stage in self.bindings.get((exchange, routing_key), ()):
+            self._tag += 1
+            method = SimpleNamespace(delivery_tag=self._tag, exchange=exchange,
+                                     routing_key=routing_key, redelivered=False)
+            self.queues[stage].append((method, props, body))
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.acked += 1
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self.nacked += 1
+
+    def add_callback_threadsafe(self, callback):
+        # like BlockingConnection: runs after the current batch of deliveries is dispatched
+        self._deferred.append(callback)
+
+    def basic_qos(self, *args, **kwargs): pass
+    def stop_consuming(self, *args, **kwargs): pass
+    def close(self): self.is_open = False
+
+    # --- pump ---
+    def drain(self, order):
+        """Deliver everything queued, upstream stages first. Returns number of deliveries."""
+        n = 0
+        progressed = True
+        while progressed:
+            progressed = False
+            for stage in order:
+                q = self.queues[stage]
+                t0 = time.thread_time()
+                while q:
+                    method, props, body = q.popleft()
+                    self.consumers[stage](self, method, props, body)
+                    self.delivered[stage] += 1
+                    n += 1; progressed = True
+                while self._deferred:
+                    self._deferred.popleft()()
+                self.cpu_s[stage] += time.thread_time() - t0
+        return n
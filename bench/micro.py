@@ -0,0 +1,230 @@
+"""
+Micro-benchmarks for the pipeline's hot functions, checked against a stored baseline.
+
+    python bench/micro.py                          # run all, compare with bench/baseline.json
+    python bench/micro.py -k linker --json out.json
+    python bench/micro.py --update-baseline        # on the reference machine, after an intended change
+
+Fixtures are synthetic (no broker, camera or model downloads). Each case reports
+the median and best time per call over --repeat timed batches. A case regresses
+when its median exceeds the baseline by more than the tolerance: --tolerance
+(default 0.25 = 25%), or a per-case "tolerance" stored in the baseline file.
+The exit status is 1 if any case regressed.
+
+Cases whose dependencies are not installed (e.g. scipy for the tracker) are
+reported as skipped. Baselines are machine-specific; compare like with like.
+"""
+import argparse, json, os, platform, re, tempfile, time, timeit
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import numpy as np
+import config
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+CASES = []   # (name, param label, factory(param) -> zero-arg callable)
+
+def case(name, params=(None,)):
+    def register(factory):
+        for p in params:
+            CASES.append((name if p is None else f"{name}[{p}]", p, factory))
+        return factory
+    return register
+
+def synthetic_frame(h, w, seed=0):
+    """Smooth gradients plus noise: compresses like a camera frame, unlike pure noise."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:h, 0:w]
+    base = np.stack([(x * 255 // w), (y * 255 // h), ((x + y) * 255 // (w + h))], axis=-1)
+    return np.clip(base + rng.integers(-12, 12, (h, w, 3)), 0, 255).astype(np.uint8)
+
+def synthetic_boxes(n, h, w, seed=0):
+    rng = np.random.default_rng(seed)
+    x1 = rng.uniform(0, w - 60, n); y1 = rng.uniform(0, h - 150, n)
+    return np.stack([x1, y1, x1 + rng.uniform(30, 60, n), y1 + rng.uniform(80, 150, n)], axis=1)
+
+def unit_vectors(n, d=512, seed=0):
+    v = np.random.default_rng(seed).standard_normal((n, d)).astype(np.float32)
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+SIZES = {"480p": (480, 640), "720p": (720, 1280), "1080p": (1080, 1920)}
+
+@case("codec.encode_frame_b64", params=list(SIZES))
+def _encode(size):
+    from utils.codec import encode_frame_b64
+    frame = synthetic_frame(*SIZES[size])
+    return lambda: encode_frame_b64(frame)
+
+@case("codec.decode_frame_b64", params=list(SIZES))
+def _decode(size):
+    from utils.codec import encode_frame_b64, decode_frame_b64
+    b64 = encode_frame_b64(synthetic_frame(*SIZES[size]))
+    return lambda: decode_frame_b64(b64)
+
+@case("json.envelope", params=[0, 20, 100])
+def _envelope(n_tracks):
+    """reid -> linker message: frame pass-through plus tracks with packed embeddings."""
+    from utils.codec import encode_frame_b64, pack_embedding
+    h, w = SIZES["480p"]
+    tracks = [{"track_id": i, "bbox": [float(v) for v in b], "conf": 0.9, **pack_embedding(e, config.EMBED_WIRE_FORMAT)}
+              for i, (b, e) in enumerate(zip(synthetic_boxes(n_tracks, h, w), unit_vectors(n_tracks)))]
+    msg = {"cam_id": "cam1", "t_ms": 1700000000000, "frame_id": 1,
+           "frame_b64": encode_frame_b64(synthetic_frame(h, w)), "tracks": tracks}
+    return lambda: json.loads(json.dumps(msg).encode("utf-8").decode("utf-8"))
+
+@case("reid.crop", params=[5, 20])
+def _crop(n):
+    from workers.reid_service import crop
+    h, w = SIZES["720p"]
+    frame = synthetic_frame(h, w)
+    boxes = synthetic_boxes(n, h, w)
+    return lambda: [crop(frame, b) for b in boxes]
+
+@case("linker._to_unit")
+def _to_unit(_):
+    from workers.linker_service import _to_unit
+    v = (unit_vectors(1)[0] * 3.0).tolist()
+    return lambda: _to_unit(v)
+
+@case("linker.assign", params=[100, 1000, 5000])
+def _assign(gallery):
+    """New track on cam0 against `gallery` embeddings from 4 other cameras inside the window."""
+    from workers.linker_service import Linker
+    from utils.codec import pack_embedding, unpack_embedding
+    lk = Linker(config.SIM_THRESHOLD, window_ms=10 ** 9, max_per_cam=10 ** 6)
+    embs = unit_vectors(gallery + 1)
+    for i, e in enumerate(embs[:-1]):
+        q, scale = unpack_embedding(pack_embedding(e, config.EMBED_WIRE_FORMAT))
+        lk.assign(f"cam{1 + i % 4}", i, q, i, scale)
+    q, scale = unpack_embedding(pack_embedding(embs[-1], config.EMBED_WIRE_FORMAT))
+    tid = iter(range(10 ** 9))
+    def run():
+        lk.assign("cam0", next(tid), q, gallery, scale)
+        lk.cam_track_gid["cam0"].clear()   # keep every call on the full-search path
+        lk.gallery.pop("cam0", None)
+    return run
+
+def _db(rows_tracks=0, rows_sessions=0):
+    d = tempfile.mkdtemp(prefix="bench-db-")
+    config.DB_PATH = os.path.join(d, "events.db")
+    from services import db
+    conn = db.init()
+    rng = np.random.default_rng(0)
+    with conn:
+        conn.executemany("INSERT INTO tracks(cam_id,global_id,track_id,x1,y1,x2,y2,conf,t_ms) VALUES(?,?,?,?,?,?,?,?,?)",
+                         ((f"cam{i % 4}", int(rng.integers(1000)), i, 0, 0, 10, 10, 0.9, i) for i in range(rows_tracks)))
+        conn.executemany("INSERT INTO sessions(cam_id,global_id,t_enter_ms,t_exit_ms) VALUES(?,?,?,?)",
+                         ((f"cam{i % 4}", int(rng.integers(1000)), i, i + 1000) for i in range(rows_sessions)))
+    return db, conn
+
+@case("db.insert_track", params=[0, 100000])
+def _insert(rows):
+    db, conn = _db(rows_tracks=rows)
+    return lambda: db.insert_track(conn, "cam1", 7, 3, (1, 2, 3, 4), 0.9, 123)
+
+@case("db.update_sessions", params=[1000, 100000])
+def _sessions(rows):
+    """10 people present on one camera, alternating with an empty frame so sessions open and close."""
+    db, conn = _db(rows_sessions=rows)
+    state = {"last_seen": {}, "t": 10 ** 9, "n": 0}
+    present = {"cam1": set(range(2000, 2010))}
+    def run():
+        state["t"] += 3000; state["n"] += 1
+        state["last_seen"] = db.update_sessions(conn, present if state["n"] % 2 else {"cam1": set()},
+                                                state["last_seen"], now_ms=state["t"])
+    return run
+
+@case("tracker.update", params=[5, 20, 100])
+def _tracker(n):
+    from workers.multi_tracker import TrackerManager
+    h, w = SIZES["480p"]
+    boxes = synthetic_boxes(n, h, w)
+    rng = np.random.default_rng(1)
+    trk = TrackerManager()
+    t = iter(range(0, 10 ** 12, 500))
+    def run():
+        jitter = boxes + rng.normal(0, 2, boxes.shape)
+        dets = np.concatenate([jitter, rng.uniform(0.6, 0.95, (n, 1))], axis=1).astype(np.float32)
+        trk.update("cam0", next(t), dets)
+    return run
+
+@case("tracker.update_batch", params=[1, 4, 16])
+def _tracker_batch(cams):
+    """One prefetch batch: 20 people on each of `cams` cameras, advanced in one step (time per batch)."""
+    from workers.multi_tracker import TrackerManager
+    h, w = SIZES["480p"]
+    boxes = [synthetic_boxes(20, h, w, seed=c) for c in range(cams)]
+    rng = np.random.default_rng(1)
+    trk = TrackerManager()
+    t = iter(range(0, 10 ** 12, 500))
+    def run():
+        t_ms = next(t)
+        trk.update_batch([(f"cam{c}", t_ms, np.concatenate([b + rng.normal(0, 2, b.shape), np.full((20, 1), 0.9)], axis=1))
+                          for c, b in enumerate(boxes)])
+    return run
+
+def measure(fn, repeat, min_time):
+    fn()   # warm caches / lazy imports
+    timer = timeit.Timer(fn)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    per_call = sorted(t / number * 1e6 for t in timer.repeat(repeat=repeat, number=number))
+    return {"median_us": round(per_call[len(per_call) // 2], 3), "best_us": round(per_call[0], 3), "calls": number}
+
+def compare(result, base, tolerance):
+    if base is None:
+        return "new"
+    tol = base.get("tolerance", tolerance)
+    ratio = result["median_us"] / base["median_us"]
+    result["vs_baseline"] = round(ratio, 3)
+    if ratio > 1 + tol: return "regressed"
+    if ratio < 1 / (1 + tol): return "improved"
+    return "ok"
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("-k", "--filter", help="regex on case names")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--min-time", type=float, default=0.2, help="seconds per timed batch")
+    ap.add_argument("--tolerance", type=float, default=0.25)
+    ap.add_argument("--baseline", default=BASELINE)
+    ap.add_argument("--update-baseline", action="store_true", help="write results as the new baseline")
+    ap.add_argument("--json", help="also write the report as JSON to this path")
+    args = ap.parse_args()
+
+    try:
+        with open(args.baseline) as f: baseline = json.load(f)
+    except (OSError, ValueError):
+        baseline = {"cases": {}}
+    report = {"machine": {"python": platform.python_version(), "platform": platform.platform(),
+                          "cpus": os.cpu_count()},
+              "time": int(time.time()), "cases": {}}
+    for name, param, factory in CASES:
+        if args.filter and not re.search(args.filter, name): continue
+        try:
+            fn = factory(param)
+        except ImportError as e:
+            report["cases"][name] = {"status": "skipped", "reason": str(e)}
+            print(f"{name:40s} skipped ({e})", file=sys.stderr)
+            continue
+        res = measure(fn, args.repeat, args.min_time)
+        res["status"] = compare(res, baseline["cases"].get(name), args.tolerance)
+        report["cases"][name] = res
+        print(f"{name:40s} {res['median_us']:12.1f} us  {res['status']}"
+              + (f" ({res['vs_baseline']:.2f}x)" if "vs_baseline" in res else ""), file=sys.stderr)
+
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as f: json.dump(report, f, indent=2)
+    if args.update_baseline:
+        cases = dict(baseline.get("cases", {}))
+        for name, res in report["cases"].items():
+            if "median_us" not in res: continue
+            entry = {"median_us": res["median_us"]}
+            if "tolerance" in cases.get(name, {}): entry["tolerance"] = cases[name]["tolerance"]
+            cases[name] = entry
+        with open(args.baseline, "w") as f:
+            json.dump({"machine": report["machine"], "time": report["time"], "cases": cases}, f, indent=2)
+    sys.exit(1 if any(r.get("status") == "regressed" for r in report["cases"].values()) else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Capture messages flowing through an exchange into a recording file.
+
+By default a private auto-delete queue is bound next to the real one, so the
+running pipeline keeps receiving everything. Pass --queue to drain an existing
+queue instead.
+
+    python bench/record.py out.rec --stage detector --seconds 60
+    python bench/record.py out.rec --exchange tracks --routing-key tracker_frames --max 500
+"""
+import argparse, time, logging
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import pika
+import config
+from bench.recording import Writer
+from bench.stages import STAGES
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+logger = logging.getLogger("record")
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("out")
+    ap.add_argument("--stage", choices=sorted(STAGES), help="record the input of this stage")
+    ap.add_argument("--exchange"); ap.add_argument("--routing-key")
+    ap.add_argument("--queue", help="consume (and ack) this existing queue instead of tapping")
+    ap.add_argument("--max", type=int, default=0, help="stop after N messages (0 = unlimited)")
+    ap.add_argument("--seconds", type=float, default=0, help="stop after N seconds (0 = unlimited)")
+    args = ap.parse_args()
+
+    if args.stage:
+        args.exchange, args.routing_key = STAGES[args.stage][2:4]
+    if not args.queue and not (args.exchange and args.routing_key):
+        ap.error("need --stage, --exchange/--routing-key or --queue")
+
+    conn = pika.BlockingConnection(pika.URLParameters(config.RABBIT_URL))
+    ch = conn.channel()
+    if args.queue:
+        queue = args.queue
+    else:
+        ch.exchange_declare(exchange=args.exchange, exchange_type='direct', durable=True)
+        queue = ch.queue_declare(queue="", exclusive=True, auto_delete=True).method.queue
+        ch.queue_bind(queue=queue, exchange=args.exchange, routing_key=args.routing_key)
+
+    deadline = time.monotonic() + args.seconds if args.seconds else None
+    with Writer(args.out) as w:
+        try:
+            for method, props, body in ch.consume(queue, auto_ack=True, inactivity_timeout=0.5):
+                if method is not None:
+                    w.write(time.time(), method.exchange, method.routing_key, props.headers, body)
+                    if w.count % 100 == 0:
+                        logger.info("[record] %d messages", w.count)
+                if args.max and w.count >= args.max: break
+                if deadline and time.monotonic() >= deadline: break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            try: ch.cancel(); ch.close()
+            finally: conn.close()
+        logger.info("[record] wrote %d messages to %s", w.count, args.out)
+
+if __name__ == "__main__":
+    main()
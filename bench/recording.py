@@ -0,0 +1,55 @@
+"""
+Compact on-disk format for captured broker messages.
+
+File layout:  MAGIC, then one record per message:
+    <d  t_recv      wall-clock seconds when the message was captured
+    <H  len(exchange)
+    <H  len(routing_key)
+    <I  len(headers)   JSON-encoded AMQP headers (may be 0)
+    <I  len(body)
+    exchange, routing_key, headers, body   (raw bytes)
+"""
+import json, struct
+
+MAGIC = b"ITRACK-REC1\n"
+_HDR = struct.Struct("<dHHII")
+
+class Record:
+    __slots__ = ("t", "exchange", "routing_key", "headers", "body")
+    def __init__(self, t, exchange, routing_key, headers, body):
+        self.t, self.exchange, self.routing_key, self.headers, self.body = t, exchange, routing_key, headers, body
+
+class Writer:
+    def __init__(self, path):
+        self.f = open(path, "wb")
+        self.f.write(MAGIC)
+        self.count = 0
+
+    def write(self, t, exchange, routing_key, headers, body):
+        ex, rk = exchange.encode("utf-8"), routing_key.encode("utf-8")
+        hb = json.dumps(headers, separators=(",", ":"), default=str).encode("utf-8") if headers else b""
+        self.f.write(_HDR.pack(t, len(ex), len(rk), len(hb), len(body)))
+        self.f.write(ex); self.f.write(rk); self.f.write(hb); self.f.write(body)
+        self.count += 1
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+
+def read(path):
+    """Yield Record objects from a recording file."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path}: not a recording file")
+        while True:
+            raw = f.read(_HDR.size)
+            if len(raw) < _HDR.size:
+                return
+            t, lex, lrk, lh, lb = _HDR.unpack(raw)
+            ex = f.read(lex).decode("utf-8"); rk = f.read(lrk).decode("utf-8")
+            hb = f.read(lh); body = f.read(lb)
+            if len(body) < lb:
+                return  # truncated tail (recorder killed mid-write)
+            yield Record(t, ex, rk, json.loads(hb) if hb else {}, body)
@@ -0,0 +1,262 @@
+"""
+Replay recorded messages (or a folder of video clips) into the pipeline and
+report throughput, per-stage CPU and latency percentiles.
+
+    # in-process, no broker: run detector..linker on a recording as fast as possible
+    python bench/replay.py frames.rec --broker memory --first detector --last linker --speed 0
+
+    # against the local RabbitMQ and the running services, at 4x real time
+    python bench/replay.py frames.rec --broker amqp --first detector --last linker --speed 4
+
+    # a folder of clips, sampled at 2 fps, fed into the detector in real time
+    python bench/replay.py /data/clips --fps 2 --speed 1
+
+    # check the replayed tracker against its output recorded in the same live run
+    python bench/record.py dets.rec --stage tracker --seconds 120 &
+    python bench/record.py tracks.rec --exchange tracks --routing-key tracker_frames --seconds 120
+    python bench/replay.py dets.rec --first tracker --last tracker --speed 0 --expect-tracks tracks.rec
+
+Latency numbers come from the trace headers (utils/trace.py) on the output of
+the last stage, so they cover every stage in between. Message t_ms keep their
+recorded spacing (the tracker derives frame rate and lost-track age from it);
+only the trace start is stamped at injection.
+"""
+import argparse, glob, itertools, json, threading, time, logging
+from types import SimpleNamespace
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import config
+from utils import trace
+from bench.recording import read, Record
+from bench.stages import STAGES, chain, load_callback
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+logger = logging.getLogger("replay")
+
+VIDEO_EXTS = (".mp4", ".avi", ".mkv", ".mov")
+
+def video_records(folder, fps):
+    """Turn every clip in `folder` into publisher-shaped frame messages, one camera per clip."""
+    import cv2
+    from utils.codec import encode_frame_b64
+    for path in sorted(p for p in glob.glob(os.path.join(folder, "*")) if p.lower().endswith(VIDEO_EXTS)):
+        cam_id = os.path.splitext(os.path.basename(path))[0]
+        cap = cv2.VideoCapture(path)
+        step_ms, pos_ms, frame_id = 1000.0 / fps, 0.0, 0
+        try:
+            while True:
+                cap.set(cv2.CAP_PROP_POS_MSEC, pos_ms)
+                ok, frame = cap.read()
+                if not ok or frame is None: break
+                body = json.dumps({"cam_id": cam_id, "frame_id": frame_id, "t_ms": int(pos_ms),
+                                   "frame_b64": encode_frame_b64(frame, 80)}).encode("utf-8")
+                yield Record(pos_ms / 1000.0, config.EX_FRAMES, "raw_frames", {}, body)
+                frame_id += 1; pos_ms += step_ms
+        finally:
+            cap.release()
+
+class Rebase:
+    """
+    Move replayed messages to the present by one constant offset (now - first t_ms),
+    so the recorded t_ms deltas are kept; e2e latency is measured from injection.
+    """
+    def __init__(self):
+        self.offset = None
+
+    def __call__(self, rec):
+        msg = json.loads(rec.body.decode("utf-8"))
+        now = trace.now()
+        if self.offset is None:
+            self.offset = int(now) - int(msg["t_ms"])
+        msg["t_ms"] = int(msg["t_ms"]) + self.offset
+        headers = {trace.T0: now, trace.LAST_PUB: now}
+        return json.dumps(msg).encode("utf-8"), headers
+
+def paced(records, speed):
+    """Yield records no earlier than their recorded offset / speed (speed 0 = no pacing)."""
+    start = t_first = None
+    for rec in records:
+        if speed > 0:
+            if start is None: start, t_first = time.monotonic(), rec.t
+            delay = start + (rec.t - t_first) / speed - time.monotonic()
+            if delay > 0: time.sleep(delay)
+        yield rec
+
+class Sink:
+    """Collects trace headers from the last stage's output."""
+    def __init__(self, stages):
+        self.stages = stages
+        self.samples = {"e2e": []}
+        for s in stages:
+            self.samples[f"{s}.queue_wait"] = []; self.samples[f"{s}.stage"] = []
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, props, body):
+        h = getattr(props, "headers", None) or {}
+        with self.lock:
+            self.count += 1
+            prev_pub = h.get("replay.pub")
+            for s in self.stages:
+                recv, pub = h.get(f"{s}.recv"), h.get(f"{s}.pub")
+                if recv is None or pub is None: continue
+                self.samples[f"{s}.stage"].append(pub - recv)
+                if prev_pub is not None: self.samples[f"{s}.queue_wait"].append(recv - prev_pub)
+                prev_pub = pub
+            last = h.get(f"{self.stages[-1]}.pub")
+            if last is not None and trace.T0 in h:
+                self.samples["e2e"].append(last - h[trace.T0])
+
+class TrackCounts:
+    """Number of tracks per (cam_id, frame_id) in tracker output messages."""
+    def __init__(self):
+        self.counts = {}
+
+    def __call__(self, props, body):
+        msg = json.loads(body.decode("utf-8"))
+        self.counts[(msg["cam_id"], msg["frame_id"])] = len(msg["tracks"])
+
+def compare_tracks(got, want, warmup=5):
+    """
+    Compare per-frame track counts of a replay with a recording of the live tracker.
+    Only frames both published count (the live tracker skips stale frames), minus
+    the first `warmup` frames per camera, where the live tracker still had tracks
+    from before the recording started.
+    """
+    common = sorted(set(got) & set(want))
+    first = {}
+    for cam_id, frame_id in common:
+        first.setdefault(cam_id, []).append(frame_id)
+    skip = {(cam_id, f) for cam_id, ids in first.items() for f in ids[:warmup]}
+    keys = [k for k in common if k not in skip]
+    bad = [(k, got[k], want[k]) for k in keys if got[k] != want[k]]
+    return {"frames": len(keys), "mismatched": len(bad),
+            "examples": [{"cam_id": c, "frame_id": f, "replay": g, "recorded": w} for (c, f), g, w in bad[:10]]}
+
+def percentiles(xs, ps=(50, 90, 99)):
+    if not xs: return {f"p{p}": None for p in ps}
+    xs = sorted(xs)
+    return {f"p{p}": round(xs[min(len(xs) - 1, int(round(p / 100.0 * (len(xs) - 1))))], 2) for p in ps}
+
+def proc_cpu_seconds(script):
+    """Total user+system CPU seconds of processes whose command line mentions `script` (Linux /proc)."""
+    tick = os.sysconf("SC_CLK_TCK"); total = 0.0
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                if script.encode() not in f.read(): continue
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / tick
+        except (OSError, IndexError, ValueError):
+            continue
+    return total
+
+def run_memory(records, stages, speed, sink, tracks=None):
+    from bench.membroker import MemChannel
+    mem = MemChannel()
+    for s in stages:
+        _, _, ex, rk, _, _ = STAGES[s]
+        mem.consume(s, ex, rk, load_callback(s))
+    mem.tap(*STAGES[stages[-1]][4:6], sink)
+    if tracks is not None:
+        mem.tap(*STAGES["tracker"][4:6], tracks)
+    sent, rebase = 0, Rebase()
+    for rec in paced(records, speed):
+        body, headers = rebase(rec)
+        headers["replay.pub"] = trace.now()
+        mem.basic_publish(rec.exchange, rec.routing_key, body, SimpleNamespace(headers=headers))
+        mem.drain(stages); sent += 1
+    return sent, dict(mem.cpu_s)
+
+def run_amqp(records, stages, speed, sink, drain_timeout):
+    import pika
+    params = pika.URLParameters(config.RABBIT_URL)
+    out_ex, out_rk = STAGES[stages[-1]][4:6]
+    ready = threading.Event(); stop = threading.Event()
+
+    def consume():
+        c = pika.BlockingConnection(params); ch = c.channel()
+        ch.exchange_declare(exchange=out_ex, exchange_type='direct', durable=True)
+        q = ch.queue_declare(queue="", exclusive=True, auto_delete=True).method.queue
+        ch.queue_bind(queue=q, exchange=out_ex, routing_key=out_rk)
+        ready.set()
+        for method, props, body in ch.consume(q, auto_ack=True, inactivity_timeout=0.2):
+            if method is not None: sink(props, body)
+            if stop.is_set(): break
+        ch.cancel(); c.close()
+
+    t = threading.Thread(target=consume, daemon=True); t.start(); ready.wait(10)
+    scripts = {s: STAGES[s][0].replace(".", "/") + ".py" for s in stages}
+    cpu0 = {s: proc_cpu_seconds(p) for s, p in scripts.items()}
+    conn = pika.BlockingConnection(params); ch = conn.channel()
+    sent, rebase = 0, Rebase()
+    for rec in paced(records, speed):
+        body, headers = rebase(rec)
+        headers["replay.pub"] = trace.now()
+        ch.basic_publish(exchange=rec.exchange, routing_key=rec.routing_key, body=body,
+                         properties=pika.BasicProperties(delivery_mode=2, headers=headers))
+        sent += 1
+    conn.close()
+    deadline = time.monotonic() + drain_timeout
+    while sink.count < sent and time.monotonic() < deadline:
+        time.sleep(0.1)
+    stop.set(); t.join(2)
+    return sent, {s: proc_cpu_seconds(p) - cpu0[s] for s, p in scripts.items()}
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("source", help="recording file or folder of video clips")
+    ap.add_argument("--broker", choices=["memory", "amqp"], default="memory")
+    ap.add_argument("--first", choices=sorted(STAGES), default="detector", help="stage that receives the replayed messages")
+    ap.add_argument("--last", choices=sorted(STAGES), default="linker", help="stage whose output is measured")
+    ap.add_argument("--speed", type=float, default=1.0, help="1 = real time, N = N x, 0 = as fast as possible")
+    ap.add_argument("--fps", type=float, default=1.0, help="sampling rate for video folders")
+    ap.add_argument("--limit", type=int, default=0, help="replay at most N messages")
+    ap.add_argument("--drain-timeout", type=float, default=30.0, help="amqp: seconds to wait for stragglers")
+    ap.add_argument("--json", help="also write the report as JSON to this path")
+    ap.add_argument("--expect-tracks", metavar="REC",
+                    help="memory: recording of the live tracker's output; exit 1 if replayed track counts differ")
+    args = ap.parse_args()
+
+    stages = chain(args.first, args.last)
+    if args.expect_tracks and ("tracker" not in stages or args.broker != "memory"):
+        ap.error("--expect-tracks needs --broker memory and the tracker among the replayed stages")
+    if os.path.isdir(args.source):
+        if args.first != "detector": ap.error("video folders can only be replayed into the detector")
+        records = video_records(args.source, args.fps)
+    else:
+        records = read(args.source)
+    in_ex, in_rk = STAGES[stages[0]][2:4]
+    records = (r for r in records if (r.exchange, r.routing_key) == (in_ex, in_rk))
+    if args.limit:
+        records = itertools.islice(records, args.limit)
+
+    sink = Sink(stages)
+    tracks = TrackCounts() if args.expect_tracks else None
+    t0 = time.monotonic()
+    if args.broker == "memory":
+        sent, cpu = run_memory(records, stages, args.speed, sink, tracks)
+    else:
+        sent, cpu = run_amqp(records, stages, args.speed, sink, args.drain_timeout)
+    wall = time.monotonic() - t0
+
+    report = {"broker": args.broker, "stages": stages, "speed": args.speed,
+              "sent": sent, "received": sink.count, "wall_s": round(wall, 3),
+              "frames_per_s": round(sink.count / wall, 2) if wall > 0 else None,
+              "cpu_s": {s: round(v, 3) for s, v in cpu.items()},
+              "latency_ms": {k: percentiles(v) for k, v in sink.samples.items()}}
+    if tracks is not None:
+        want = TrackCounts()
+        for rec in read(args.expect_tracks):
+            if (rec.exchange, rec.routing_key) == tuple(STAGES["tracker"][4:6]): want(None, rec.body)
+        report["tracks"] = compare_tracks(tracks.counts, want.counts)
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as f: json.dump(report, f, indent=2)
+    if tracks is not None and (report["tracks"]["mismatched"] or not report["tracks"]["frames"]):
+        logger.error("[replay] track counts differ from %s", args.expect_tracks)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+Pipeline wiring as seen by the benchmark tools.
+
+name -> (module, callback, input exchange, input routing key, output exchange, output routing key)
+"""
+import config
+
+STAGES = {
+    "detector": ("workers.detector_service", "on_frame",
+                 config.EX_FRAMES, "raw_frames", config.EX_DETECTIONS, "detector_frames"),
+    "tracker":  ("workers.tracker_service", "on_detections",
+                 config.EX_DETECTIONS, "detector_frames", config.EX_TRACKS, "tracker_frames"),
+    "reid":     ("workers.reid_service", "on_tracks",
+                 config.EX_TRACKS, "tracker_frames", config.EX_REID, "reid_frames"),
+    "linker":   ("workers.linker_service", "on_reid",
+                 config.EX_REID, "reid_frames", config.EX_GLOBAL_TRACKS, "global_track_frames"),
+}
+ORDER = ["detector", "tracker", "reid", "linker"]
+
+# Models the services load in main(), which the harness never calls:
+# name -> (module global, loader function); load_callback fills the global first.
+LOADS = {
+    "detector": ("yolo", "load_model"),
+    "reid":     ("extractor", "load_model"),
+}
+
+def chain(first, last):
+    """Stage names from `first` through `last` inclusive, in pipeline order."""
+    i, j = ORDER.index(first), ORDER.index(last)
+    if j < i:
+        raise ValueError(f"stage {last} comes before {first}")
+    return ORDER[i:j + 1]
+
+def load_callback(name):
+    """Import a stage's module, load its model if it has one, and return its message callback."""
+    import importlib
+    mod, fn = STAGES[name][:2]
+    m = importlib.import_module(mod)
+    if name in LOADS:
+        attr, loader = LOADS[name]
+        if getattr(m, attr) is None:
+            setattr(m, attr, getattr(m, loader)())
+    return getattr(m, fn)
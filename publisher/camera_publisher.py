@@ -1,23 +1,265 @@
-import threading, cv2, pika, time, json, logging
+import threading, functools, collections, cv2, pika, time, json, logging
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from utils.codec import encode_frame_b64, now_ms
+from utils.sources import open_source
+from utils import metrics, trace, startup, logs, control
+from utils.freshness import declare_queue
 import config
 
-log_dir = "/home/msi/Desktop/logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, "camera_publisher.log")
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s", handlers=[
-    logging.FileHandler(log_file),
-    logging.StreamHandler()
-])
-logger = logging.getLogger("camera_publisher")
-
-# RabbitMQ topology
-def ensure_topology(ch):
-    ch.exchange_declare(exchange=config.EX_FRAMES, exchange_type='direct', durable=True)
-    ch.queue_declare(queue=config.Q_FRAMES_ANY, durable=True)
-    ch.queue_bind(queue=config.Q_FRAMES_ANY, exchange=config.EX_FRAMES, routing_key='raw_frames')
+logger = logs.setup("camera_publisher")
+
+metrics.describe("publisher_publish_ms", "histogram", "Frame handed over by a camera thread -> basic_publish done")
+metrics.describe("publisher_confirm_ms", "histogram", "basic_publish -> broker confirm")
+metrics.describe("publisher_inflight", "gauge", "Unconfirmed frames per camera")
+metrics.describe("publisher_dropped_total", "counter", "Frames dropped before publishing (backpressure, blocked, disconnected)")
+metrics.describe("publisher_nacked_total", "counter", "Frames the broker nacked")
+metrics.describe("publisher_blocked", "gauge", "1 while the broker has blocked the connection")
+
+class _Cam:
+    __slots__ = ("ch", "next_tag", "outstanding", "pending", "lossless", "backlog", "inflight", "cond", "open")
+    def __init__(self):
+        self.ch = None
+        self.next_tag = 1
+        self.outstanding = {}   # delivery tag -> (monotonic publish time, (body, headers, t_submit))
+        self.pending = None     # live: newest frame waiting for window space: (body, headers, t_submit)
+        self.lossless = False   # file source: never drop, block capture instead
+        self.backlog = collections.deque()   # lossless: frames handed over, not yet published
+        self.inflight = 0       # lossless: frames handed over and not yet confirmed (backlog + outstanding)
+        self.cond = threading.Condition()    # guards backlog/inflight; signalled on confirm
+        self.open = threading.Event()        # the camera's confirm channel is open
+
+class AmqpPublisher:
+    """
+    One SelectConnection shared by all cameras; its IO loop runs on a single thread.
+    Every camera gets its own channel with publisher confirms, pipelined up to
+    `window` unconfirmed frames. For live cameras, when the window is full or the
+    broker has blocked the connection (memory/disk alarm), only the newest frame is
+    kept and superseded ones are counted in publisher_dropped_total; capture never
+    stalls on the broker. Lossless cameras (file sources, see set_lossless) instead
+    block in publish() until a confirm frees window space, and frames that were
+    unconfirmed when the connection dropped are published again after reconnect.
+    Camera threads only call publish(), which hops onto the IO thread.
+    """
+    def __init__(self, params, cam_ids, window):
+        self.params, self.window = params, int(window)
+        self.cams = {cam_id: _Cam() for cam_id in cam_ids}
+        self.conn = None
+        self.ctl = None          # topology/control channel
+        self.blocked = False
+        self._stopping = False
+        self._retry = 0
+        self.published = 0       # frames handed to the broker, read by FpsController
+        self.controller = None   # optional FpsController ticked on the IO loop
+        self._thread = threading.Thread(target=self._run, name="amqp-io", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopping = True
+        for c in self.cams.values():
+            with c.cond: c.cond.notify_all()
+        conn = self.conn
+        if conn is not None:
+            try: conn.ioloop.add_callback_threadsafe(lambda: conn.is_open and conn.close())
+            except Exception: pass
+        self._thread.join(5)
+
+    # --- camera threads ---
+    def set_lossless(self, cam_id, lossless=True):
+        """Block instead of dropping for this camera; call before its first publish()."""
+        self.cams[cam_id].lossless = bool(lossless)
+
+    def wait_open(self, cam_id, timeout=None):
+        """Wait until the camera's channel is open; False on timeout or stop."""
+        c = self.cams[cam_id]
+        while not self._stopping:
+            if c.open.wait(1.0 if timeout is None else min(timeout, 1.0)):
+                return True
+            if timeout is not None:
+                timeout -= 1.0
+                if timeout <= 0: return False
+        return False
+
+    def drain(self, cam_id, timeout=None):
+        """Wait until every frame a lossless camera handed over is confirmed; False if some are left."""
+        c = self.cams[cam_id]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with c.cond:
+            while c.inflight and not self._stopping:
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0: break
+                c.cond.wait(left)
+            return c.inflight == 0
+
+    def publish(self, cam_id, body, headers):
+        c = self.cams[cam_id]
+        if c.lossless:
+            with c.cond:
+                while c.inflight >= self.window and not self._stopping:
+                    c.cond.wait()
+                if self._stopping:
+                    return
+                c.inflight += 1
+                c.backlog.append((body, headers, time.monotonic()))
+            conn = self.conn
+            if conn is not None and conn.is_open:   # otherwise the backlog goes out when the channel reopens
+                try: conn.ioloop.add_callback_threadsafe(functools.partial(self._flush, cam_id))
+                except Exception: pass
+            return
+        conn = self.conn
+        if conn is None or not conn.is_open:
+            metrics.inc("publisher_dropped_total", cam=cam_id, reason="disconnected")
+            return
+        conn.ioloop.add_callback_threadsafe(functools.partial(self._offer, cam_id, body, headers, time.monotonic()))
+
+    # --- IO thread ---
+    def _run(self):
+        while not self._stopping:
+            self.conn = pika.SelectConnection(self.params, on_open_callback=self._on_open,
+                                              on_open_error_callback=self._on_open_error,
+                                              on_close_callback=self._on_closed)
+            self.conn.add_on_connection_blocked_callback(self._on_blocked)
+            self.conn.add_on_connection_unblocked_callback(self._on_unblocked)
+            self.conn.ioloop.start()
+            if not self._stopping:
+                time.sleep(min(2 ** self._retry, 10)); self._retry = min(self._retry + 1, 3)
+
+    def _on_open_error(self, conn, err):
+        logger.error("[publisher] cannot connect to broker: %s", err)
+        conn.ioloop.stop()
+
+    def _on_closed(self, conn, reason):
+        if not self._stopping:
+            logger.error("[publisher] broker connection closed: %s; reconnecting", reason)
+        for c in self.cams.values():
+            c.open.clear()
+            c.ch, c.pending = None, None
+            if c.lossless:
+                # unconfirmed frames may not have reached the broker: publish them again
+                with c.cond:
+                    c.backlog.extendleft(item for _, (_, item) in sorted(c.outstanding.items(), reverse=True))
+            c.outstanding.clear()
+        self.ctl, self.blocked = None, False
+        conn.ioloop.stop()
+
+    def _on_open(self, conn):
+        self._retry = 0
+        conn.channel(on_open_callback=self._declare)
+        control.attach_async(conn, "camera_publisher", {
+            "inflight": lambda: {cam_id: len(c.outstanding) for cam_id, c in self.cams.items()},
+            "pending": lambda: sum((c.pending is not None) + len(c.backlog) for c in self.cams.values()),
+            "fps_budget": lambda: self.controller and self.controller.total})
+
+    def _declare(self, ch):
+        self.ctl = ch
+        ch.add_on_close_callback(self._on_ctl_closed)
+        bind = lambda _: ch.queue_bind(queue=config.Q_FRAMES_ANY, exchange=config.EX_FRAMES,
+                                       routing_key='raw_frames', callback=lambda _: self._open_cams())
+        ch.exchange_declare(exchange=config.EX_FRAMES, exchange_type='direct', durable=True,
+                            callback=lambda _: declare_queue(ch, config.Q_FRAMES_ANY, callback=bind))
+
+    def _open_cams(self):
+        for cam_id in self.cams:
+            self.conn.channel(on_open_callback=functools.partial(self._on_cam_channel, cam_id))
+        if self.controller is not None:
+            self.conn.ioloop.call_later(self.controller.interval_s, self._tick)
+
+    def _on_ctl_closed(self, ch, reason):
+        # a passive declare of a queue nobody created yet closes the channel (404); reopen it
+        self.ctl = None
+        if self.conn is not None and self.conn.is_open and not self._stopping:
+            self.conn.channel(on_open_callback=lambda c: (setattr(self, "ctl", c), c.add_on_close_callback(self._on_ctl_closed)))
+
+    def _tick(self):
+        conn = self.conn
+        if conn is None or not conn.is_open or self._stopping:
+            return
+        self.poll_depths(self.controller.queues, self.controller.on_depths)
+        conn.ioloop.call_later(self.controller.interval_s, self._tick)
+
+    def poll_depths(self, queues, done):
+        """Passive-declare `queues` on the control channel; done({queue: (messages, consumers)})."""
+        ch = self.ctl
+        if ch is None or not ch.is_open:
+            return
+        results = {}
+        def on_ok(queue, frame):
+            results[queue] = (frame.method.message_count, frame.method.consumer_count)
+            if len(results) == len(queues):
+                done(results)
+        for q in queues:
+            ch.queue_declare(queue=q, passive=True, callback=functools.partial(on_ok, q))
+
+    def _on_cam_channel(self, cam_id, ch):
+        c = self.cams[cam_id]
+        c.ch, c.next_tag = ch, 1
+        c.outstanding.clear()
+        ch.confirm_delivery(ack_nack_callback=functools.partial(self._on_confirm, cam_id))
+        logger.info("[publisher] channel %d open for %s", ch.channel_number, cam_id)
+        c.open.set()
+        self._flush(cam_id)
+
+    def _offer(self, cam_id, body, headers, t_submit):
+        c = self.cams[cam_id]
+        if c.pending is not None:
+            metrics.inc("publisher_dropped_total", cam=cam_id, reason="blocked" if self.blocked else "backpressure")
+        c.pending = (body, headers, t_submit)
+        self._flush(cam_id)
+
+    def _flush(self, cam_id):
+        c = self.cams[cam_id]
+        while c.ch is not None and c.ch.is_open and not self.blocked and len(c.outstanding) < self.window:
+            if c.lossless:
+                with c.cond:
+                    if not c.backlog: return
+                    item = c.backlog.popleft()
+            else:
+                if c.pending is None: return
+                item, c.pending = c.pending, None
+            body, headers, t_submit = item
+            c.ch.basic_publish(exchange=config.EX_FRAMES, routing_key="raw_frames", body=body,
+                               properties=pika.BasicProperties(
+                                   delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE, headers=headers))
+            now = time.monotonic()
+            c.outstanding[c.next_tag] = (now, item)
+            c.next_tag += 1
+            self.published += 1
+            metrics.observe("publisher_publish_ms", (now - t_submit) * 1000.0, cam=cam_id)
+            metrics.set_gauge("publisher_inflight", len(c.outstanding), cam=cam_id)
+
+    def _on_confirm(self, cam_id, frame):
+        c = self.cams[cam_id]
+        m = frame.method
+        tags = [t for t in c.outstanding if t <= m.delivery_tag] if m.multiple else [m.delivery_tag]
+        now = time.monotonic()
+        done = 0
+        for t in tags:
+            entry = c.outstanding.pop(t, None)
+            if entry is not None:
+                done += 1
+                metrics.observe("publisher_confirm_ms", (now - entry[0]) * 1000.0, cam=cam_id)
+        if isinstance(m, pika.spec.Basic.Nack):
+            metrics.inc("publisher_nacked_total", len(tags), cam=cam_id)
+        if c.lossless and done:
+            with c.cond:
+                c.inflight -= done
+                c.cond.notify_all()
+        metrics.set_gauge("publisher_inflight", len(c.outstanding), cam=cam_id)
+        self._flush(cam_id)
+
+    def _on_blocked(self, conn, frame):
+        logger.warning("[publisher] broker blocked the connection; keeping only the newest frame per live camera")
+        self.blocked = True
+        metrics.set_gauge("publisher_blocked", 1)
+
+    def _on_unblocked(self, conn, frame):
+        logger.info("[publisher] broker unblocked the connection")
+        self.blocked = False
+        metrics.set_gauge("publisher_blocked", 0)
+        for cam_id in self.cams:
+            self._flush(cam_id)
 
 """
 def publish_camera(cam_id, src):
@@ -77,78 +319,129 @@ def publish_camera(cam_id, src):
         ch.close()
         conn.close()
 """
-def open_capture(src):
-    cap = cv2.VideoCapture(src, cv2.CAP_V4L2)
-    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH,  640)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-    try: cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-    except Exception: pass
-    return cap
+metrics.describe("publisher_target_fps", "gauge", "Frame rate the controller currently asks of each camera")
+metrics.describe("pipeline_queue_depth", "gauge", "Ready messages per watched queue")
+metrics.describe("pipeline_stage_rate", "gauge", "Estimated messages/s consumed from each watched queue")
 
-def publish_camera(cam_id, src, target_fps=1.0):
-    # Open a camera and publish one frame approximately every 1/target_fps seconds.
-    params = pika.ConnectionParameters(
-        host='localhost',
-        port=5672,
-        virtual_host='/',
-        credentials=pika.PlainCredentials('guest', 'guest'),
-        heartbeat=30,
-        blocked_connection_timeout=60,
-        socket_timeout=60
-    )
-    conn = pika.BlockingConnection(params)
-    ch = conn.channel()
-    ensure_topology(ch)
+class FpsController:
+    """
+    Follows downstream capacity instead of a fixed frame rate.
 
-    rk = "raw_frames"
-    period = 1.0/float(target_fps)
-    next_tick = time.monotonic()
+    Every FPS_CONTROL_SEC the publisher's IO loop polls the depth of FPS_WATCH_QUEUES
+    (frames -> detections -> tracks). Messages are 1:1 along that chain, so each
+    stage's consumption rate is its inflow (what we published, or the previous
+    stage's rate) minus its queue growth. The total fps budget then follows AIMD:
+      - a queue above QUEUE_DEPTH_HIGH, or growing while above QUEUE_DEPTH_LOW:
+        budget = min(budget * FPS_DECREASE, 0.9 * slowest stage rate)
+      - every queue at or below QUEUE_DEPTH_LOW: budget += FPS_STEP
+    and is split across cameras by weight, each clamped to its [min_fps, max_fps].
+    """
+    def __init__(self, cam_ids, amqp, start_fps):
+        self.amqp = amqp
+        self.queues = list(config.FPS_WATCH_QUEUES)
+        self.interval_s = float(config.FPS_CONTROL_SEC)
+        lo, hi = config.FPS_BOUNDS
+        self.limits = {}
+        for cam_id in cam_ids:
+            p = config.CAMERA_PRIORITY.get(cam_id, {})
+            self.limits[cam_id] = (float(p.get("weight", 1.0)), float(p.get("min_fps", lo)), float(p.get("max_fps", hi)))
+        self.sources = {}          # cam_id -> source, registered by the capture threads
+        self.total = start_fps * len(self.limits)
+        self._prev = None          # (monotonic, published, {queue: depth})
+
+    def register(self, cam_id, source):
+        self.sources[cam_id] = source
+        source.fps = self.allocate(self.total).get(cam_id, source.fps)
+
+    def allocate(self, total):
+        """Weighted split of `total` fps with per-camera clamps (water-filling)."""
+        out, free, budget = {}, dict(self.limits), total
+        while free:
+            wsum = sum(w for w, _, _ in free.values()) or 1.0
+            clamped = {}
+            for cam_id, (w, lo, hi) in free.items():
+                share = budget * w / wsum
+                if share < lo: clamped[cam_id] = lo
+                elif share > hi: clamped[cam_id] = hi
+            if not clamped:
+                for cam_id, (w, _, _) in free.items(): out[cam_id] = budget * w / wsum
+                break
+            for cam_id, f in clamped.items():
+                out[cam_id] = f; budget -= f; del free[cam_id]
+        return out
+
+    def on_depths(self, depths):
+        now, published = time.monotonic(), self.amqp.published
+        for q, (n, _) in depths.items():
+            metrics.set_gauge("pipeline_queue_depth", n, queue=q)
+        prev, self._prev = self._prev, (now, published, {q: n for q, (n, _) in depths.items()})
+        if prev is None:
+            return
+        dt = max(1e-3, now - prev[0])
+        inflow = (published - prev[1]) / dt
+        rates, behind = [], False
+        for q in self.queues:
+            depth, before = depths[q][0], prev[2].get(q, 0)
+            rate = max(0.0, inflow - (depth - before) / dt)
+            metrics.set_gauge("pipeline_stage_rate", rate, queue=q)
+            rates.append(rate)
+            inflow = rate
+            if depth > config.QUEUE_DEPTH_HIGH or (depth > config.QUEUE_DEPTH_LOW and depth > before):
+                behind = True
+        lo_total = sum(lo for _, lo, _ in self.limits.values())
+        hi_total = sum(hi for _, _, hi in self.limits.values())
+        if behind:
+            target = self.total * config.FPS_DECREASE
+            slowest = min(rates)
+            if slowest > 0: target = min(target, 0.9 * slowest)
+            self.total = max(lo_total, target)
+        elif all(depths[q][0] <= config.QUEUE_DEPTH_LOW for q in self.queues):
+            self.total = min(hi_total, self.total + config.FPS_STEP)
+        for cam_id, fps in self.allocate(self.total).items():
+            metrics.set_gauge("publisher_target_fps", fps, cam=cam_id)
+            src = self.sources.get(cam_id)
+            if src is not None: src.fps = fps
+
+def publish_camera(cam_id, src, amqp, target_fps=1.0):
+    # Capture thread: read one frame from `src` approximately every 1/target_fps seconds
+    # (of media time for files), encode it and hand it to the shared AMQP publisher.
     frame_id = 0
-    cap = open_capture(src)
-    retry = 0
-    if not cap.isOpened():
-        logger.error("[Camera %s] cannot open source: %s", cam_id, src)
-        ch.close(); conn.close()
-        return
+    # live sources pace and reconnect themselves; files decode only the sampled frames
+    source = open_source(src, fps=target_fps, realtime=config.SOURCE_REALTIME)
+    if amqp.controller is not None:
+        amqp.controller.register(cam_id, source)
+    if not source.live:
+        # files must not lose frames to confirm latency: block on the window, and don't start before the channel is up
+        amqp.set_lossless(cam_id)
+        if not amqp.wait_open(cam_id):
+            source.release()
+            return
 
     try:
         while True:
-            now = time.monotonic()
-            if now < next_tick:
-                time.sleep(next_tick - now)
-
-            for _ in range(5):
-                if time.monotonic() >= next_tick: break
-                cap.grab(); time.sleep(0.003)
-
-            ok, frame = cap.read()
-            if not ok or frame is None:
-                logger.error("[Camera %s] read failed; attempting reopen...", cam_id)
-                cap.release()
-                time.sleep(min(2**retry, 10))   # backoff up to 10s
-                cap = open_capture(src)
-                if not cap.isOpened():
-                    retry = min(retry+1, 3)
-                    continue
-                retry = 0
-                next_tick += period
+            item = source.read()
+            if item is None:
+                logger.info("[publisher] %s EOS", cam_id)
+                break
+            frame, src_ms = item
+            if frame is None:
+                logger.error("[Camera %s] decode failed; skipping frame", cam_id)
                 continue
 
-            # success path
-            retry = 0
-            msg = {"cam_id": cam_id, "frame_id": frame_id, "t_ms": now_ms(),
+            t_ms = now_ms()
+            span = trace.Span("publisher").bind(cam_id, t_ms)
+            msg = {"cam_id": cam_id, "frame_id": frame_id, "t_ms": t_ms,
                    "frame_b64": encode_frame_b64(frame, 80)}
-            ch.basic_publish(exchange=config.EX_FRAMES, routing_key="raw_frames",
-                             body=json.dumps(msg).encode("utf-8"),
-                             properties=pika.BasicProperties(
-                                 delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE))
-            logger.info("[Camera %s] published frame %d", cam_id, frame_id)
+            if not source.live:
+                msg["src_ms"] = int(src_ms)   # position in the file, for backfills
+            span.mark("encode")
+            amqp.publish(cam_id, json.dumps(msg).encode("utf-8"), span.finish())
+            logger.debug("[Camera %s] published frame %d", cam_id, frame_id)
             frame_id += 1
-            next_tick += period
     finally:
-        cap.release()
-        ch.close(); conn.close()
+        source.release()
+    if not source.live and not amqp.drain(cam_id, config.PUBLISH_DRAIN_SEC):
+        logger.warning("[publisher] %s: %d frames still unconfirmed after EOS", cam_id, amqp.cams[cam_id].inflight)
 
 """
 def publish_camera(cam_id, src, target_fps=1.0):
@@ -228,18 +521,36 @@ def publish_camera(cam_id, src, target_fps=1.0):
 """
 
 def main():
+    startup.apply_thread_budget()
+    metrics.serve(config.METRICS_PORTS["camera_publisher"])
+    params = pika.ConnectionParameters(
+        host='localhost',
+        port=5672,
+        virtual_host='/',
+        credentials=pika.PlainCredentials('guest', 'guest'),
+        heartbeat=30,
+        blocked_connection_timeout=60,
+        socket_timeout=60
+    )
+    amqp = AmqpPublisher(params, config.CAMERA_SOURCES.keys(), config.PUBLISH_CONFIRM_WINDOW)
+    if config.ADAPTIVE_FPS:
+        amqp.controller = FpsController(config.CAMERA_SOURCES.keys(), amqp, start_fps=1.0)
+    amqp.start()
     threads = []
     for cam_id, src in config.CAMERA_SOURCES.items():
-        t = threading.Thread(target=publish_camera, args=(cam_id, src), daemon=True)
+        t = threading.Thread(target=publish_camera, args=(cam_id, src, amqp), daemon=True)
         t.start()
         threads.append(t)
 
+    startup.mark_ready("camera_publisher")
     logger.info("[publisher] started. Ctrl+C to exit.")
     try:
         for t in threads:
             t.join()
     except KeyboardInterrupt:
         logger.info("[publisher] stopping...")
+    finally:
+        amqp.stop()
 
 if __name__ == "__main__":
     main()
@@ -1,8 +1,4 @@
 #!/bin/bash
+# Starts every enabled service in supervisor.json with CPU pinning, thread budgets and restarts.
 cd /home/msi/intrusion_track
-python3  publisher/camera_publisher.py > /dev/null 2>&1 &
-python3 workers/detector_service.py > /dev/null 2>&1 &
-python3 workers/tracker_service.py > /dev/null 2>&1 &
-python3 workers/reid_service.py > /dev/null 2>&1 &
-python3 workers/linker_service.py > /dev/null 2>&1 &
-python3 services/display_and_logger.py > /dev/null 2>&1 &
+exec python3 supervisor.py start
@@ -1,51 +1,114 @@
+"""
+Scene captions for the sampled raw frames (one every CAPTION_SAMPLE_SEC per camera).
+
+BLIP only runs when the scene changed: each sampled frame's 64-bit dHash is compared
+with the last captioned frame of its camera, and within CAPTION_HASH_DISTANCE bits the
+previous caption row's t_end_ms is extended instead (forced again after CAPTION_REFRESH_SEC).
+A new caption whose words overlap the previous one by CAPTION_DEDUP_JACCARD or more also
+extends the previous row, so captions are time spans [t_ms, t_end_ms] rather than samples.
+"""
 import os, time, json, pika, cv2, logging
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
-from transformers import BlipProcessor, BlipForConditionalGeneration
-from utils.codec import decode_frame_b64
-from services.db import init
-import config, sqlite3
-
-log_dir = "/home/msi/Desktop/logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, "caption_service.log")
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s", handlers=[
-    logging.FileHandler(log_file),
-    logging.StreamHandler()
-])
-logger = logging.getLogger("caption_service")
+from utils.codec import decode_frame_b64, frame_dhash, hamming
+from services.db import init, insert_caption, extend_caption, last_captions
+from utils import metrics, trace, startup, logs, control
+import numpy as np
+from utils.freshness import declare_queue
+import config
+
+logger = logs.setup("caption_service")
+
+metrics.describe("caption_generated_total", "counter", "Frames captioned by the model")
+metrics.describe("caption_skipped_total", "counter", "Sampled frames that extended the previous caption (unchanged scene or duplicate text)")
+
+STOPWORDS = frozenset("a an the of in on at with and is are there to".split())
 
 def ensure_topology(ch):
     ch.exchange_declare(exchange=config.EX_FRAMES, exchange_type='direct', durable=True)
-    ch.queue_declare(queue='raw_frames_sample', durable=True)
+    declare_queue(ch, 'raw_frames_sample')
     ch.queue_bind(queue='raw_frames_sample', exchange=config.EX_FRAMES, routing_key='raw_frames')
 
-def main():
-    conn_db = sqlite3.connect(config.DB_PATH); 
-    conn_db.execute("CREATE TABLE IF NOT EXISTS captions(id INTEGER PRIMARY KEY AUTOINCREMENT, cam_id TEXT, caption TEXT, t_ms INTEGER)")
+def load_model():
+    # transformers pulls in torch; importing it here lets main() connect to the broker in parallel
+    from transformers import BlipProcessor, BlipForConditionalGeneration
+    startup.apply_thread_budget()
     processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
     model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
+    # warmup generate on a blank image
+    model.generate(**processor(images=np.zeros((384, 384, 3), dtype=np.uint8), return_tensors="pt"), max_new_tokens=5)
     logger.info("[caption] loaded model.")
+    return processor, model
+
+def words(caption):
+    return frozenset(w for w in caption.lower().replace(",", " ").replace(".", " ").split() if w not in STOPWORDS)
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+class SceneState:
+    """Per camera: hash of the last captioned frame and the caption row it is extending."""
+    __slots__ = ("hash", "t_hash", "row_id", "words", "t_end")
+    def __init__(self, row_id=None, caption="", t_end=0):
+        self.hash, self.t_hash = None, 0
+        self.row_id, self.words, self.t_end = row_id, words(caption), t_end
+
+def main():
+    loader = startup.Loader("caption", load_model)
+    metrics.serve(config.METRICS_PORTS["caption"])
+    conn_db = init()
+    scenes = {cam: SceneState(*row) for cam, row in last_captions(conn_db).items()}
     params = pika.URLParameters(config.RABBIT_URL)
     connection = pika.BlockingConnection(params); ch = connection.channel(); ensure_topology(ch)
+    processor, model = startup.wait(loader, connection)
     last_ts = {}
-    def cb(ch, method, props, body):
-        msg = eval(body.decode('utf-8'))
-        cam_id = msg['cam_id']; t_ms = msg['t_ms']
-        if t_ms - last_ts.get(cam_id, 0) < config.CAPTION_SAMPLE_SEC*1000: ch.basic_ack(delivery_tag=method.delivery_tag); return
+    def extend(st, cam_id, t_ms, reason):
+        if st.row_id is not None and t_ms > st.t_end:
+            extend_caption(conn_db, st.row_id, t_ms); st.t_end = t_ms
+        metrics.inc("caption_skipped_total", cam=cam_id, reason=reason)
+    def caption(props, msg):
+        cam_id = msg['cam_id']; t_ms = int(msg['t_ms'])
+        if t_ms - last_ts.get(cam_id, 0) < config.CAPTION_SAMPLE_SEC*1000: return
         last_ts[cam_id] = t_ms
+        span = trace.Span("caption", props).bind(cam_id, t_ms)
+        st = scenes.setdefault(cam_id, SceneState())
+        h = frame_dhash(msg['frame_b64'])
+        span.mark("hash")
+        refresh = config.CAPTION_REFRESH_SEC and t_ms - st.t_hash >= config.CAPTION_REFRESH_SEC*1000
+        if st.hash is not None and not refresh and hamming(h, st.hash) <= config.CAPTION_HASH_DISTANCE:
+            extend(st, cam_id, t_ms, "unchanged")
+            span.finish(); return
         frame = decode_frame_b64(msg['frame_b64']); image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        span.mark("decode")
         out = model.generate(**processor(images=image, return_tensors="pt"), max_new_tokens=30)
+        span.mark("infer")
         caption = processor.decode(out[0], skip_special_tokens=True)
-        logger.info(f"[caption generated] cam={cam_id} t_ms={t_ms} caption={caption}")
-        with conn_db: conn_db.execute("INSERT INTO captions(cam_id, caption, t_ms) VALUES(?,?,?)", (cam_id, caption, t_ms))
-        logger.info(f"[caption] {cam_id}: {caption}")
+        metrics.inc("caption_generated_total", cam=cam_id)
+        st.hash, st.t_hash = h, t_ms
+        w = words(caption)
+        if st.row_id is not None and jaccard(w, st.words) >= config.CAPTION_DEDUP_JACCARD:
+            extend(st, cam_id, t_ms, "duplicate")
+        else:
+            st.row_id, st.words, st.t_end = insert_caption(conn_db, cam_id, caption, t_ms), w, t_ms
+            logger.info("[caption] %s t_ms=%s: %s", cam_id, t_ms, caption)
+        span.finish()
+    def cb(ch, method, props, body):
+        # a bad frame must not escape the callback: start_consuming would end and the redelivery crash-loop the service
+        try:
+            caption(props, json.loads(body.decode('utf-8')))
+        except Exception as e:
+            logger.exception("caption error: %s", e)
+            try: ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            except Exception: pass
+            return
         ch.basic_ack(delivery_tag=method.delivery_tag)
     ch.basic_qos(prefetch_count=1); ch.basic_consume(queue='raw_frames_sample', on_message_callback=cb, auto_ack=False)
+    control.attach(ch, "caption", {"cams": lambda: len(last_ts), "scenes": lambda: len(scenes)}, ['raw_frames_sample'])
+    startup.mark_ready("caption")
     logger.info("[caption] running.")
     try: ch.start_consuming()
     except KeyboardInterrupt: pass
-    finally: ch.close(); connection.close(); conn_db.close()
+    finally: startup.clear_ready("caption"); ch.close(); connection.close(); conn_db.close()
 
 if __name__ == "__main__":
     main()
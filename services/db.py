@@ -1,4 +1,5 @@
-import sqlite3, os, time
+import sqlite3, os, queue, time
+from contextlib import contextmanager
 import config
 
 SCHEMA = '''
@@ -15,29 +16,90 @@ CREATE TABLE IF NOT EXISTS sessions(
 );
 CREATE TABLE IF NOT EXISTS captions(
   id INTEGER PRIMARY KEY AUTOINCREMENT,
-  cam_id TEXT, caption TEXT, t_ms INTEGER
+  cam_id TEXT, caption TEXT, t_ms INTEGER, t_end_ms INTEGER
 );
 CREATE TABLE IF NOT EXISTS meta(
   k TEXT PRIMARY KEY, v TEXT
 );
 '''
 
+# Created by init(): trajectory / presence / dwell / transition queries (services/query_api.py)
+# and the open-session lookup in update_sessions.
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS tracks_gid_t ON tracks(global_id, t_ms, id);
+CREATE INDEX IF NOT EXISTS tracks_cam_t ON tracks(cam_id, t_ms, id);
+CREATE INDEX IF NOT EXISTS sessions_cam_enter ON sessions(cam_id, t_enter_ms, id);
+CREATE INDEX IF NOT EXISTS sessions_gid_enter ON sessions(global_id, t_enter_ms, id);
+CREATE INDEX IF NOT EXISTS sessions_open ON sessions(cam_id, global_id, t_exit_ms);
+CREATE INDEX IF NOT EXISTS captions_cam_t ON captions(cam_id, t_ms);
+'''
+
 def get_conn():
     os.makedirs(os.path.dirname(config.DB_PATH), exist_ok=True)
     return sqlite3.connect(config.DB_PATH, check_same_thread=False)
 
 def init():
     conn = get_conn()
+    # WAL: readers (query API, RAG indexer) never block the logger's writes
+    conn.execute("PRAGMA journal_mode=WAL")
     with conn: 
         conn.executescript(SCHEMA)
+        migrate(conn)
+        conn.executescript(INDEXES)
     return conn
 
+def migrate(conn):
+    """Columns added after the first release; CREATE TABLE IF NOT EXISTS leaves old tables as they were."""
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(captions)")}
+    if "t_end_ms" not in cols:
+        conn.execute("ALTER TABLE captions ADD COLUMN t_end_ms INTEGER")
+        conn.execute("UPDATE captions SET t_end_ms = t_ms")
+
+def get_ro_conn():
+    conn = sqlite3.connect(f"file:{os.path.abspath(config.DB_PATH)}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute("PRAGMA query_only=1")
+    return conn
+
+class ReadPool:
+    """Fixed set of read-only connections shared by request threads."""
+    def __init__(self, size=4):
+        self._q = queue.Queue()
+        for _ in range(size):
+            self._q.put(get_ro_conn())
+
+    @contextmanager
+    def conn(self):
+        c = self._q.get()
+        try:
+            yield c
+        finally:
+            self._q.put(c)
+
+    def close(self):
+        while not self._q.empty():
+            self._q.get_nowait().close()
+
 def insert_track(conn, cam_id, gid, tid, bbox, conf, t_ms):
     x1,y1,x2,y2 = bbox
     with conn:
         conn.execute("INSERT INTO tracks(cam_id,global_id,track_id,x1,y1,x2,y2,conf,t_ms) VALUES(?,?,?,?,?,?,?,?,?)",
                      (cam_id, gid, tid, x1,y1,x2,y2, conf, t_ms))
 
+def insert_caption(conn, cam_id, caption, t_ms):
+    with conn:
+        return conn.execute("INSERT INTO captions(cam_id, caption, t_ms, t_end_ms) VALUES(?,?,?,?)",
+                            (cam_id, caption, t_ms, t_ms)).lastrowid
+
+def extend_caption(conn, row_id, t_ms):
+    with conn:
+        conn.execute("UPDATE captions SET t_end_ms=MAX(COALESCE(t_end_ms, t_ms), ?) WHERE id=?", (t_ms, row_id))
+
+def last_captions(conn):
+    """cam_id -> (row id, caption, t_end_ms) of each camera's latest caption."""
+    rows = conn.execute("SELECT id, cam_id, caption, COALESCE(t_end_ms, t_ms) FROM captions "
+                        "WHERE id IN (SELECT MAX(id) FROM captions GROUP BY cam_id)")
+    return {cam: (rid, cap, t) for rid, cam, cap, t in rows}
+
 def update_sessions(conn, present_ids_by_cam, last_seen, timeout_ms=2000, now_ms=None):
     if now_ms is None:
         now_ms = int(time.time()*1000)
@@ -3,21 +3,17 @@ import sys
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 import config
 from utils.codec import decode_frame_b64
+from utils import metrics, trace, startup, logs, control
+from utils.freshness import declare_queue, Gate
 from services.db import init, insert_track, update_sessions
 import numpy as np
 
-log_dir = "/home/msi/Desktop/logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, "display_service.log")
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s", handlers=[
-    logging.FileHandler(log_file),
-    logging.StreamHandler()
-])
-logger = logging.getLogger("display_service")
+logger = logs.setup("display_service")
+gate = Gate("display")
 
 def ensure_topology(ch):
     ch.exchange_declare(exchange=config.EX_GLOBAL_TRACKS, exchange_type='direct', durable=True)
-    ch.queue_declare(queue=config.Q_DISPLAY, durable=True)
+    declare_queue(ch, config.Q_DISPLAY)
     ch.queue_bind(queue=config.Q_DISPLAY, exchange=config.EX_GLOBAL_TRACKS, routing_key='global_track_frames')
 
 """
@@ -50,26 +46,43 @@ update_sessions will open a session for (camB,7) as well. This enables later cro
 """
 
 def on_msg(ch, method, props, body, state):
-    data = json.loads(body.decode('utf-8'))
-    cam_id = data["cam_id"]
-    t_ms = data["t_ms"]
-    frame = decode_frame_b64(data["frame_b64"])
-    logger.info(f"[display and logger service] got {len(data.get('tracks', []))} tracks from cam={cam_id}")
-    present = set()
-    for a in data.get("tracks", []):
-        gid = int(a.get("global_id", -1))
-        if gid < 0: continue
-        tid = int(a["track_id"])
-        x1,y1,x2,y2 = map(int, a["bbox"])
-        cv2.rectangle(frame, (x1,y1), (x2,y2), (0,255,0), 2)
-        cv2.putText(frame, f"G{gid}/T{tid}", (x1, max(0,y1-5)), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0,255,0), 2)
-        insert_track(state["conn"], cam_id, gid, tid, (x1,y1,x2,y2), float(a.get("conf",1.0)), t_ms)
-        logger.info(f"[db] inserted track cam={cam_id} gid={gid} tid={tid} bbox=({x1},{y1},{x2},{y2}) conf={a.get('conf',1.0)} t_ms={t_ms}")
-        present.add(gid)
-    # {"camA": {7, 12}}
-    logger.info(f"[sessions] updating sessions with present ids by cam: {{{cam_id}: {present}}}")
-    state["last_seen"] = update_sessions(state["conn"], {cam_id: present}, state["last_seen"], now_ms=t_ms)
-    logger.info(f"[sessions] updated last_seen: {state['last_seen']}")
+    try:
+        span = trace.Span("display", props)
+        data = json.loads(body.decode('utf-8'))
+        cam_id = data["cam_id"]
+        t_ms = data["t_ms"]
+        span.bind(cam_id, t_ms)
+        # the tracks/sessions rows are the audit log and are always written; only the
+        # display is shed when behind. Cameras with FORWARD_FULL_FRAME off arrive without pixels.
+        stale = gate.stale(cam_id, t_ms)
+        frame = decode_frame_b64(data["frame_b64"]) if "frame_b64" in data and not stale else None
+        span.mark("decode")
+        present = set()
+        for a in data.get("tracks", []):
+            gid = int(a.get("global_id", -1))
+            if gid < 0: continue
+            tid = int(a["track_id"])
+            x1,y1,x2,y2 = map(int, a["bbox"])
+            if frame is not None:
+                cv2.rectangle(frame, (x1,y1), (x2,y2), (0,255,0), 2)
+                cv2.putText(frame, f"G{gid}/T{tid}", (x1, max(0,y1-5)), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0,255,0), 2)
+            insert_track(state["conn"], cam_id, gid, tid, (x1,y1,x2,y2), float(a.get("conf",1.0)), t_ms)
+            present.add(gid)
+        # {"camA": {7, 12}}
+        state["last_seen"] = update_sessions(state["conn"], {cam_id: present}, state["last_seen"], now_ms=t_ms)
+        metrics.inc("pipeline_objects_total", len(present), stage="display", cam=cam_id)
+        logger.debug("[display] %s: %d global ids present", cam_id, len(present))
+        span.mark("db")
+    except Exception as e:
+        logger.exception("display error: %s", e)
+        try: ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        except Exception: pass
+        return
+    # ACK once the rows are written; drawing is best effort
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+    if frame is None:
+        span.finish()
+        return
 
     # --- window management: one window per cam_id ---
     if "windows" not in state:
@@ -92,6 +105,8 @@ def on_msg(ch, method, props, body, state):
         state["windows"][cam_id] = True
 
     cv2.imshow(cam_id, frame)
+    # terminal stage: "pub" here means the box reached the screen
+    span.finish()
 
     # ESC closes all
     key = cv2.waitKey(1) & 0xFF
@@ -103,15 +118,11 @@ def on_msg(ch, method, props, body, state):
         if cv2.getWindowProperty(cam_id, cv2.WND_PROP_VISIBLE) < 1:
             ch.stop_consuming()
     except Exception:
-        pass    
-
-
-    #cv2.imshow(cam_id, frame)
-    #if cv2.waitKey(1) & 0xFF == 27:
-    #    ch.stop_consuming()
-    #ch.basic_ack(delivery_tag=method.delivery_tag)
+        pass
 
 def main():
+    startup.apply_thread_budget()
+    metrics.serve(config.METRICS_PORTS["display"])
     conn = init()
     state = {"conn": conn, "last_seen": {}}
     #params = pika.URLParameters(config.RABBIT_URL)
@@ -125,12 +136,15 @@ def main():
                                         )
     connection = pika.BlockingConnection(params)
     ch = connection.channel(); ensure_topology(ch)
-    #ch.basic_qos(prefetch_count=10)
+    # bounded in-flight window: unacked deliveries are not covered by the queue's max length
+    ch.basic_qos(prefetch_count=config.PREFETCH["display"])
     ch.basic_consume(queue=config.Q_DISPLAY, on_message_callback=lambda ch,m,p,b: on_msg(ch,m,p,b,state), auto_ack=False)
+    control.attach(ch, "display", {"open_sessions": lambda: sum(len(m) for m in state["last_seen"].values())}, [config.Q_DISPLAY])
+    startup.mark_ready("display")
     print("[display] running. ESC to close.")
     try: ch.start_consuming()
     except KeyboardInterrupt: pass
-    finally: ch.close(); connection.close(); cv2.destroyAllWindows()
+    finally: startup.clear_ready("display"); ch.close(); connection.close(); cv2.destroyAllWindows()
 
 if __name__ == "__main__":
     main()
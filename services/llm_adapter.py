@@ -1,12 +1,95 @@
-import os
+"""
+Process-wide llama.cpp model for RAG answers.
+
+The model is loaded once (get_llm) and kept resident. At load the fixed
+instruction PREFIX is evaluated; llama.cpp reuses the longest common token
+prefix of the previous prompt, so every later question starts from the cached
+prefix instead of re-reading it. Retrieved context is trimmed to the tokens left
+in LLM_N_CTX after the prefix, question and answer budget.
+
+    for piece in stream_answer(question, docs): print(piece, end="", flush=True)
+"""
+import os, threading, time, logging
+import config
+
+logger = logging.getLogger("llm")
+
+PREFIX = ("You answer questions about a multi-camera surveillance log. "
+          "Use ONLY the context lines below; if they do not contain the answer, say so.\n\nContext:\n")
+STOP = ["</s>", "User:", "\nQ:"]
+
+_llm = None
+_prefix_tokens = None
+_lock = threading.Lock()   # one generation at a time: the model and its KV cache are shared
+
+def model_path():
+    return os.environ.get("LLAMA2_PATH") or config.LLM_MODEL_PATH
+
+def get_llm():
+    """The resident model, loaded on first use; None when llama_cpp or the model file is missing."""
+    global _llm, _prefix_tokens
+    if _llm is not None:
+        return _llm
+    with _lock:
+        if _llm is None:
+            path = model_path()
+            if not path or not os.path.exists(path):
+                logger.warning("[llm] model not found at %s", path)
+                return None
+            try:
+                from llama_cpp import Llama
+            except ImportError as e:
+                logger.warning("[llm] llama_cpp not available: %s", e)
+                return None
+            t0 = time.monotonic()
+            llm = Llama(model_path=path, n_ctx=config.LLM_N_CTX, n_threads=config.LLM_N_THREADS,
+                        n_batch=config.LLM_N_BATCH, verbose=False)
+            _prefix_tokens = llm.tokenize(PREFIX.encode("utf-8"), add_bos=True)
+            llm.eval(_prefix_tokens)   # warm the KV cache with the shared prefix
+            _llm = llm
+            logger.info("[llm] loaded %s in %.1fs (prefix %d tokens)", path, time.monotonic() - t0, len(_prefix_tokens))
+    return _llm
+
+def _tokens(llm, text):
+    return llm.tokenize(text.encode("utf-8"), add_bos=False)
+
+def build_prompt(llm, question, docs, max_tokens=None):
+    """Prefix + as many docs (in rank order) as fit + question, as tokens; returns (tokens, docs used)."""
+    max_tokens = max_tokens or config.LLM_MAX_TOKENS
+    tail = _tokens(llm, f"\nQ: {question}\nA:")
+    budget = config.LLM_N_CTX - len(_prefix_tokens) - len(tail) - max_tokens
+    body, used = [], 0
+    for d in docs:
+        t = _tokens(llm, f"- {d}\n")
+        if len(body) + len(t) > budget: break
+        body += t; used += 1
+    return _prefix_tokens + body + tail, used
+
+def stream_answer(question, docs, max_tokens=None):
+    """Yield the answer text as it is generated; yields nothing if no model is available."""
+    llm = get_llm()
+    if llm is None:
+        return
+    max_tokens = max_tokens or config.LLM_MAX_TOKENS
+    with _lock:
+        prompt, used = build_prompt(llm, question, docs, max_tokens)
+        t0, first = time.monotonic(), None
+        for chunk in llm.create_completion(prompt=prompt, max_tokens=max_tokens, stop=STOP,
+                                           temperature=config.LLM_TEMPERATURE, stream=True):
+            text = chunk["choices"][0]["text"]
+            if first is None:
+                first = time.monotonic() - t0
+                logger.info("[llm] first token after %.0f ms (%d prompt tokens, %d/%d docs)",
+                            first * 1000.0, len(prompt), used, len(docs))
+            yield text
+
 def generate_with_llama2(prompt: str) -> str:
+    """Blocking completion of a free-form prompt on the resident model; "" if unavailable or on error."""
     try:
-        from llama_cpp import Llama
-        os.environ["LLAMA2_PATH"]="/models/Meta-Llama-3-8B-Instruct.Q4_K_M.gguf"
-        path = os.environ.get("LLAMA2_PATH","")
-        if not path or not os.path.exists(path): return ""
-        llm = Llama(model_path=path, n_ctx=4096, n_threads=4)
-        out = llm(prompt=prompt, max_tokens=256, stop=["</s>","User:"], temperature=0.1)
+        llm = get_llm()
+        if llm is None: return ""
+        with _lock:
+            out = llm(prompt=prompt, max_tokens=config.LLM_MAX_TOKENS, stop=STOP, temperature=config.LLM_TEMPERATURE)
         return out["choices"][0]["text"].strip()
     except Exception:
         return ""
@@ -0,0 +1,210 @@
+"""
+Read-only HTTP/JSON query API over events.db.
+
+    python services/query_api.py        # http://QUERY_API_HOST:QUERY_API_PORT
+
+    GET /trajectory/<global_id>?t1=&t2=           track boxes of one person, by time
+    GET /presence?cam=<cam_id>&t1=&t2=            sessions in a camera overlapping [t1, t2]
+    GET /dwell?cam=&t1=&t2=&bucket_ms=10000       histogram of closed session lengths per camera
+    GET /transitions?t1=&t2=&max_gap_ms=          camera -> camera hand-offs (count, gap stats)
+
+Times are t_ms (epoch ms); omitted bounds are open. List endpoints take
+?limit= (default QUERY_PAGE_LIMIT, at most QUERY_PAGE_MAX) and ?cursor=, and answer
+{"items": [...], "next_cursor": "..." | null}; pass next_cursor back to get the next
+page. Pages use keyset pagination on (t_ms, id), so deep pages cost the same as the first.
+
+Rows are streamed to the client as SQLite produces them (chunked encoding). All
+reads go through a pool of read-only connections; with the database in WAL mode
+(services/db.init) they never block the display/logger's writes.
+"""
+import json, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import config
+from utils import metrics, startup, logs
+from services.db import init, ReadPool
+
+logger = logs.setup("query_api")
+
+metrics.describe("query_api_requests_total", "counter", "Query API requests by route and status")
+metrics.describe("query_api_request_ms", "histogram", "Query API request time, including streaming the response")
+
+T_MIN, T_MAX = -(2 ** 62), 2 ** 62
+
+class BadRequest(ValueError):
+    pass
+
+def _int(qs, name, default=None):
+    v = qs.get(name, [None])[0]
+    if v in (None, ""):
+        return default
+    try:
+        return int(v)
+    except ValueError:
+        raise BadRequest(f"{name} must be an integer")
+
+def _page(qs):
+    limit = _int(qs, "limit", config.QUERY_PAGE_LIMIT)
+    if not 1 <= limit <= config.QUERY_PAGE_MAX:
+        raise BadRequest(f"limit must be in 1..{config.QUERY_PAGE_MAX}")
+    cursor = qs.get("cursor", [None])[0]
+    if not cursor:
+        return limit, (T_MIN, -1)
+    try:
+        t, i = cursor.split(":")
+        return limit, (int(t), int(i))
+    except ValueError:
+        raise BadRequest("bad cursor")
+
+def trajectory(qs, gid):
+    """(sql, params, columns); rows are keyed by their first two columns (t_ms, id)."""
+    sql = ("SELECT t_ms, id, cam_id, track_id, x1, y1, x2, y2, conf FROM tracks "
+           "WHERE global_id=? AND t_ms BETWEEN ? AND ? AND (t_ms, id) > (?, ?) ORDER BY t_ms, id LIMIT ?")
+    params = (gid, _int(qs, "t1", T_MIN), _int(qs, "t2", T_MAX))
+    return sql, params, ("t_ms", "id", "cam_id", "track_id", "x1", "y1", "x2", "y2", "conf")
+
+def presence(qs):
+    cam = qs.get("cam", [None])[0]
+    if not cam:
+        raise BadRequest("cam is required")
+    sql = ("SELECT t_enter_ms, id, global_id, t_exit_ms FROM sessions "
+           "WHERE cam_id=? AND t_enter_ms <= ? AND (t_exit_ms IS NULL OR t_exit_ms >= ?) "
+           "AND (t_enter_ms, id) > (?, ?) ORDER BY t_enter_ms, id LIMIT ?")
+    params = (cam, _int(qs, "t2", T_MAX), _int(qs, "t1", T_MIN))
+    return sql, params, ("t_enter_ms", "id", "global_id", "t_exit_ms")
+
+def dwell(db, qs):
+    bucket = _int(qs, "bucket_ms", 10000)
+    if bucket <= 0:
+        raise BadRequest("bucket_ms must be positive")
+    cam = qs.get("cam", [None])[0]
+    rows = db.execute(
+        "SELECT cam_id, (t_exit_ms - t_enter_ms) / ? AS b, COUNT(*) FROM sessions "
+        "WHERE t_exit_ms IS NOT NULL AND t_enter_ms BETWEEN ? AND ? AND (? IS NULL OR cam_id = ?) "
+        "GROUP BY cam_id, b ORDER BY cam_id, b",
+        (bucket, _int(qs, "t1", T_MIN), _int(qs, "t2", T_MAX), cam, cam))
+    out = {}
+    for cam_id, b, n in rows:
+        out.setdefault(cam_id, []).append({"from_ms": b * bucket, "count": n})
+    return {"bucket_ms": bucket, "cams": out}
+
+def transitions(db, qs):
+    max_gap = _int(qs, "max_gap_ms")
+    rows = db.execute(
+        "WITH s AS (SELECT cam_id, t_enter_ms, "
+        "  LAG(cam_id) OVER w AS prev_cam, LAG(t_exit_ms) OVER w AS prev_exit FROM sessions "
+        "  WHERE t_enter_ms BETWEEN ? AND ? WINDOW w AS (PARTITION BY global_id ORDER BY t_enter_ms, id)) "
+        "SELECT prev_cam, cam_id, COUNT(*), AVG(t_enter_ms - prev_exit), MIN(t_enter_ms - prev_exit), "
+        "  MAX(t_enter_ms - prev_exit) FROM s "
+        "WHERE prev_cam IS NOT NULL AND prev_cam != cam_id AND (? IS NULL OR t_enter_ms - prev_exit <= ?) "
+        "GROUP BY prev_cam, cam_id ORDER BY 3 DESC",
+        (_int(qs, "t1", T_MIN), _int(qs, "t2", T_MAX), max_gap, max_gap))
+    return {"transitions": [
+        {"from_cam": a, "to_cam": b, "count": n, "gap_ms_avg": avg, "gap_ms_min": lo, "gap_ms_max": hi}
+        for a, b, n, avg, lo, hi in rows]}
+
+class _Chunked:
+    """Buffers writes into HTTP/1.1 chunks of ~64 KB."""
+    def __init__(self, wfile, size=65536):
+        self.wfile, self.size, self.buf = wfile, size, []
+        self.n = 0
+
+    def write(self, s):
+        self.buf.append(s); self.n += len(s)
+        if self.n >= self.size: self.flush()
+
+    def flush(self):
+        if not self.buf: return
+        data = "".join(self.buf).encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.buf, self.n = [], 0
+
+    def close(self):
+        self.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    pool = None
+
+    def do_GET(self):
+        t0 = time.monotonic()
+        url = urlsplit(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        route = parts[0] if parts else ""
+        qs = parse_qs(url.query)
+        status = 200
+        try:
+            if route == "trajectory" and len(parts) == 2:
+                self._paged(*trajectory(qs, int(parts[1])), qs)
+            elif route == "presence":
+                self._paged(*presence(qs), qs)
+            elif route in ("dwell", "transitions"):
+                with self.pool.conn() as db:
+                    body = (dwell if route == "dwell" else transitions)(db, qs)
+                self._json(200, body)
+            else:
+                status = 404
+                self._json(404, {"error": "not found"})
+        except (BadRequest, ValueError) as e:
+            status = 400
+            self._json(400, {"error": str(e)})
+        except Exception as e:
+            status = 500
+            logger.exception("[query_api] %s failed: %s", self.path, e)
+            self.close_connection = True   # possibly mid-stream: the client sees a truncated body
+        metrics.inc("query_api_requests_total", route=route or "/", status=status)
+        metrics.observe("query_api_request_ms", (time.monotonic() - t0) * 1000.0, route=route or "/")
+
+    def _json(self, status, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _paged(self, sql, params, cols, qs):
+        limit, after = _page(qs)
+        with self.pool.conn() as db:
+            rows = db.execute(sql, params + after + (limit + 1,))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            out = _Chunked(self.wfile)
+            out.write('{"items":[')
+            nxt, last = None, None
+            for i, row in enumerate(rows):
+                if i == limit:
+                    nxt = f"{last[0]}:{last[1]}"
+                    break
+                out.write(("," if i else "") + json.dumps(dict(zip(cols, row))))
+                last = row
+            out.write('],"next_cursor":%s}' % json.dumps(nxt))
+            out.close()
+
+    def log_message(self, *args):
+        pass
+
+def main():
+    metrics.serve(config.METRICS_PORTS["query_api"])
+    init().close()   # schema, indexes and WAL mode before opening read-only connections
+    Handler.pool = ReadPool(config.QUERY_API_POOL)
+    srv = ThreadingHTTPServer((config.QUERY_API_HOST, config.QUERY_API_PORT), Handler)
+    srv.daemon_threads = True
+    startup.mark_ready("query_api")
+    logger.info("[query_api] serving on http://%s:%d", config.QUERY_API_HOST, config.QUERY_API_PORT)
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        startup.clear_ready("query_api")
+        srv.server_close()
+        Handler.pool.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,12 @@
-import sqlite3, os, chromadb, logging
+import os, chromadb, logging
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
 import config
+from utils import logs
+from services.db import init
 
-log_dir = "/home/msi/Desktop/logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, "rag_index.log")
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s", handlers=[
-    logging.FileHandler(log_file),
-    logging.StreamHandler()
-])
-logger = logging.getLogger("rag_index")
+logger = logs.setup("rag_index")
 
 def main():
     os.makedirs(config.CHROMA_DIR, exist_ok=True)
@@ -21,23 +16,23 @@ def main():
     except Exception: pass
     coll = client.create_collection("events", embedding_function=ef)
 
-    conn = sqlite3.connect(config.DB_PATH)
+    conn = init()
     rows = conn.execute("SELECT cam_id, global_id, t_enter_ms, t_exit_ms FROM sessions WHERE t_enter_ms IS NOT NULL").fetchall()
-    logger.info(f"[rag_index] fetched {rows} sessions and captions from DB.")
+    logger.info("[rag_index] fetched %d sessions from DB.", len(rows))
     docs, ids, metas = [], [], []
     for i,(cam,gid,tin,tout) in enumerate(rows):
         docs.append(f"global_id {gid} was in {cam} from {tin} to {tout or 'ongoing'}")
         ids.append(f"sess_{i}")
         metas.append({"type":"session","cam":cam,"gid":str(gid),"t_enter_ms":str(tin),"t_exit_ms":str(tout or 0)})
-    caps = conn.execute("SELECT cam_id, caption, t_ms FROM captions").fetchall()
-    logger.info(f"[rag_index] fetched {caps} captions from DB.")
+    caps = conn.execute("SELECT cam_id, caption, t_ms, COALESCE(t_end_ms, t_ms) FROM captions").fetchall()
+    logger.info("[rag_index] fetched %d captions from DB.", len(caps))
     off = len(ids)
-    for i,(cam,cap,tms) in enumerate(caps):
-        docs.append(f"{cap} (cam={cam}, t_ms={tms})")
+    for i,(cam,cap,tms,tend) in enumerate(caps):
+        docs.append(f"{cap} (cam={cam}, from t_ms={tms} to {tend})")
         ids.append(f"cap_{off+i}")
-        metas.append({"type":"caption","cam":cam,"t_ms":str(tms)})
+        metas.append({"type":"caption","cam":cam,"t_ms":str(tms),"t_end_ms":str(tend)})
     if ids: coll.add(documents=docs, metadatas=metas, ids=ids)
-    logger.info(f"[rag_index] {len(ids)} docs indexed.")
+    logger.info("[rag_index] %d docs indexed.", len(ids))
 
 if __name__ == "__main__":
     main()
@@ -1,25 +1,41 @@
+"""
+Ask questions about the indexed events (services/rag_index.py).
+
+    python services/rag_query.py "who was in cam2 after 14:00?"
+    python services/rag_query.py          # interactive: model and index stay loaded between questions
+
+The answer streams as it is generated; without a local model the best match is printed instead.
+"""
 import os, chromadb
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
-from services.llm_adapter import generate_with_llama2
+from services.llm_adapter import get_llm, stream_answer
 import config
 
+def answer(coll, q):
+    res = coll.query(query_texts=[q], n_results=config.RAG_N_RESULTS)
+    docs = res.get("documents",[[]])[0]; metas = res.get("metadatas",[[]])[0]
+    if not docs: print("No relevant logs found."); return
+    print("Top matches:\n", "".join([f"- {d} [{m}]\n" for d,m in list(zip(docs, metas))[:5]]))
+    streamed = False
+    for piece in stream_answer(q, [f"{d} [{m}]" for d,m in zip(docs, metas)]):
+        if not streamed: print("\nLLM answer:"); streamed = True
+        print(piece, end="", flush=True)
+    if streamed: print()
+    else: print("\nExtractive answer:\n", docs[0])
+
 def main():
-    if len(sys.argv)<2:
-        print("Usage: python services/rag_query.py \"your question\""); return
-    q = sys.argv[1]
     client = chromadb.PersistentClient(path=config.CHROMA_DIR)
     ef = SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
     coll = client.get_or_create_collection("events", embedding_function=ef)
-    res = coll.query(query_texts=[q], n_results=5)
-    docs = res.get("documents",[[]])[0]; metas = res.get("metadatas",[[]])[0]
-    ctx = "".join([f"- {d} [{m}]\n" for d,m in zip(docs, metas)])
-    if not ctx: print("No relevant logs found."); return
-    print("Top matches:\n", ctx)
-    ans = generate_with_llama2(f"Use ONLY this context:\n{ctx}\n\nQ: {q}\nA:")
-    if ans: print("\nLLM answer:\n", ans)
-    else: print("\nExtractive answer:\n", docs[0] if docs else "N/A")
+    if len(sys.argv) > 1:
+        answer(coll, sys.argv[1]); return
+    get_llm()   # load up front so the first question is as fast as the rest
+    while True:
+        try: q = input("\n? ").strip()
+        except (EOFError, KeyboardInterrupt): break
+        if q: answer(coll, q)
 
 if __name__ == "__main__":
     main()
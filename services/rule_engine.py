@@ -0,0 +1,247 @@
+"""
+Streaming intrusion rules on global_tracks.
+
+Consumes the linker output next to the display/logger, evaluates config.RULES
+(zone entry, loitering, line crossing, wrong-way movement) per message and
+publishes each alert as JSON to the `alerts` exchange with the rule type as
+routing key:
+
+    {"rule": "door", "type": "zone_entry", "cam_id": "cam1", "global_id": 7,
+     "zone": "door", "t_ms": ..., "frame_id": ..., "bbox": [x1, y1, x2, y2]}
+
+Zones and lines of a camera sit in a uniform grid (RULE_GRID_PX), so a person is
+only tested against the shapes in the cells around them. Per-person state
+(current zones, last position, fired alerts) is dropped after RULE_STATE_TTL_MS unseen.
+"""
+import math, pika, json
+from collections import defaultdict, OrderedDict
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import config
+from utils import metrics, trace, startup, logs, control
+from utils.freshness import declare_queue
+
+logger = logs.setup("rule_engine")
+
+metrics.describe("rules_alerts_total", "counter", "Alerts published by rule")
+metrics.describe("rules_tracked_people", "gauge", "(cam_id, global_id) pairs with rule state")
+
+def point_in_polygon(x, y, poly):
+    inside = False
+    j = len(poly) - 1
+    for i in range(len(poly)):
+        xi, yi = poly[i]; xj, yj = poly[j]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+def side(a, b, p):
+    """Sign of (b - a) x (p - a): which side of the line a->b point p is on."""
+    c = (b[0] - a[0]) * (p[1] - a[1]) - (b[1] - a[1]) * (p[0] - a[0])
+    return (c > 0) - (c < 0)
+
+def segments_cross(p, q, a, b):
+    return side(a, b, p) * side(a, b, q) < 0 and side(p, q, a) * side(p, q, b) < 0
+
+class ZoneGrid:
+    """Uniform grid over one camera's image: cell -> shapes whose bounding box touches it."""
+    def __init__(self, cell_px):
+        self.cell = float(cell_px)
+        self.cells = defaultdict(list)
+
+    def _range(self, x0, y0, x1, y1):
+        c = self.cell
+        return (range(int(x0 // c), int(x1 // c) + 1), range(int(y0 // c), int(y1 // c) + 1))
+
+    def add(self, key, points):
+        xs, ys = [p[0] for p in points], [p[1] for p in points]
+        rx, ry = self._range(min(xs), min(ys), max(xs), max(ys))
+        for ix in rx:
+            for iy in ry:
+                self.cells[(ix, iy)].append(key)
+
+    def near(self, x, y):
+        return self.cells.get((int(x // self.cell), int(y // self.cell)), ())
+
+    def near_segment(self, p, q):
+        rx, ry = self._range(min(p[0], q[0]), min(p[1], q[1]), max(p[0], q[0]), max(p[1], q[1]))
+        found = set()
+        for ix in rx:
+            for iy in ry:
+                found.update(self.cells.get((ix, iy), ()))
+        return found
+
+class RuleEngine:
+    def __init__(self, zones, lines, rules, cell_px=64, ttl_ms=30000, cooldown_ms=10000):
+        self.zones = {cam: dict(z) for cam, z in zones.items()}
+        self.lines = {cam: dict(l) for cam, l in lines.items()}
+        self.ttl_ms, self.cooldown_ms = int(ttl_ms), int(cooldown_ms)
+        self.grids = defaultdict(lambda: ZoneGrid(cell_px))
+        for cam, z in self.zones.items():
+            for name, poly in z.items(): self.grids[cam].add(("zone", name), poly)
+        for cam, l in self.lines.items():
+            for name, ab in l.items(): self.grids[cam].add(("line", name), ab)
+        # (cam, "zone" | "line", name) -> rules on that shape; (cam, "move", None) -> wrong_way rules
+        self.rules = defaultdict(list)
+        for r in rules:
+            cam, kind = r["cam"], r["type"]
+            if kind in ("zone_entry", "loiter") or (kind == "wrong_way" and r.get("zone")):
+                if r["zone"] not in self.zones.get(cam, {}):
+                    raise ValueError(f"rule {r['name']}: unknown zone {cam}/{r['zone']}")
+            if kind == "line_cross" and r["line"] not in self.lines.get(cam, {}):
+                raise ValueError(f"rule {r['name']}: unknown line {cam}/{r['line']}")
+            if kind in ("zone_entry", "loiter"): self.rules[(cam, "zone", r["zone"])].append(r)
+            elif kind == "line_cross": self.rules[(cam, "line", r["line"])].append(r)
+            elif kind == "wrong_way": self.rules[(cam, "move", None)].append(r)
+            else: raise ValueError(f"rule {r['name']}: unknown type {kind}")
+        # (cam_id, gid) -> {"pt", "t", "inside": {zone: since_ms}, "fired": {rule: since_ms | t_ms}}, least recent first
+        self.people = OrderedDict()
+
+    @classmethod
+    def from_config(cls):
+        return cls(config.ZONES, config.LINES, config.RULES, config.RULE_GRID_PX,
+                   config.RULE_STATE_TTL_MS, config.RULE_COOLDOWN_MS)
+
+    def _cooled(self, st, rule, t_ms):
+        last = st["fired"].get(rule["name"])
+        if last is not None and t_ms - last < self.cooldown_ms:
+            return False
+        st["fired"][rule["name"]] = t_ms
+        return True
+
+    def process(self, cam_id, t_ms, tracks):
+        """Advance rule state with one message's tracks; returns the alerts it raises."""
+        alerts = []
+        grid = self.grids.get(cam_id)
+        zones, lines = self.zones.get(cam_id, {}), self.lines.get(cam_id, {})
+        move_rules = self.rules.get((cam_id, "move", None), ())
+        for a in tracks:
+            gid = int(a.get("global_id", -1))
+            if gid < 0: continue
+            x1, y1, x2, y2 = a["bbox"]
+            p = ((x1 + x2) / 2.0, float(y2))
+            key = (cam_id, gid)
+            st = self.people.pop(key, None) or {"pt": None, "t": t_ms, "inside": {}, "fired": {}}
+            self.people[key] = st
+            prev = st["pt"]
+
+            def alert(rule, **where):
+                alerts.append({"rule": rule["name"], "type": rule["type"], "cam_id": cam_id, "global_id": gid,
+                               "t_ms": t_ms, "bbox": a["bbox"], **where})
+
+            now_in = set()
+            if grid is not None:
+                for kind, name in grid.near(*p):
+                    if kind == "zone" and point_in_polygon(p[0], p[1], zones[name]):
+                        now_in.add(name)
+            for name in list(st["inside"]):
+                if name not in now_in: del st["inside"][name]
+            for name in now_in:
+                entered = name not in st["inside"]
+                since = st["inside"].setdefault(name, t_ms)
+                for rule in self.rules.get((cam_id, "zone", name), ()):
+                    if rule["type"] == "zone_entry":
+                        if entered and self._cooled(st, rule, t_ms): alert(rule, zone=name)
+                    elif t_ms - since >= rule["seconds"] * 1000 and st["fired"].get(rule["name"]) != since:
+                        st["fired"][rule["name"]] = since   # once per visit
+                        alert(rule, zone=name, dwell_ms=t_ms - since)
+
+            if prev is not None:
+                if grid is not None:
+                    for kind, name in grid.near_segment(prev, p):
+                        if kind != "line": continue
+                        ab = lines[name]
+                        if not segments_cross(prev, p, *ab): continue
+                        s = side(ab[0], ab[1], p)
+                        for rule in self.rules.get((cam_id, "line", name), ()):
+                            if rule.get("direction", 0) in (0, s) and self._cooled(st, rule, t_ms):
+                                alert(rule, line=name, direction=s)
+                dx, dy = p[0] - prev[0], p[1] - prev[1]
+                step = math.hypot(dx, dy)
+                for rule in move_rules:
+                    if step < rule.get("min_px", 20): continue
+                    if rule.get("zone") and rule["zone"] not in now_in: continue
+                    ux, uy = rule["direction"]
+                    cos = (dx * ux + dy * uy) / (step * (math.hypot(ux, uy) or 1.0))
+                    if cos < math.cos(math.radians(rule.get("max_angle", 100))) and self._cooled(st, rule, t_ms):
+                        alert(rule, zone=rule.get("zone"), heading=[dx, dy])
+            st["pt"], st["t"] = p, t_ms
+        self.evict(t_ms)
+        return alerts
+
+    def evict(self, now_ms):
+        cutoff = now_ms - self.ttl_ms
+        n = 0
+        while self.people:
+            key, st = next(iter(self.people.items()))
+            if st["t"] >= cutoff: break
+            self.people.popitem(last=False); n += 1
+        return n
+
+engine = None
+
+def ensure_topology(ch):
+    ch.exchange_declare(exchange=config.EX_GLOBAL_TRACKS, exchange_type='direct', durable=True)
+    declare_queue(ch, config.Q_RULES)
+    ch.queue_bind(queue=config.Q_RULES, exchange=config.EX_GLOBAL_TRACKS, routing_key='global_track_frames')
+    ch.exchange_declare(exchange=config.EX_ALERTS, exchange_type='direct', durable=True)
+
+def on_tracks(ch, method, props, body):
+    try:
+        span = trace.Span("rules", props)
+        data = json.loads(body.decode('utf-8'))
+        cam_id, t_ms = data["cam_id"], int(data["t_ms"])
+        span.bind(cam_id, t_ms)
+        alerts = engine.process(cam_id, t_ms, data.get("tracks", []))
+        span.mark("eval")
+        metrics.set_gauge("rules_tracked_people", len(engine.people))
+        if alerts:
+            headers = span.finish()
+            for al in alerts:
+                al["frame_id"] = data.get("frame_id")
+                ch.basic_publish(exchange=config.EX_ALERTS, routing_key=al["type"],
+                                 body=json.dumps(al).encode('utf-8'),
+                                 properties=pika.BasicProperties(delivery_mode=2, headers=headers))
+                metrics.inc("rules_alerts_total", rule=al["rule"])
+                logger.info("[rules] %s: cam=%s gid=%s t_ms=%s", al["rule"], cam_id, al["global_id"], t_ms)
+    except Exception as e:
+        logger.exception("rules error: %s", e)
+        try: ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        except Exception: pass
+        return
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+
+def main():
+    global engine
+    metrics.serve(config.METRICS_PORTS["rules"])
+    engine = RuleEngine.from_config()
+    params = pika.ConnectionParameters(
+        host='localhost',
+        port=5672,
+        virtual_host='/',
+        credentials=pika.PlainCredentials('guest', 'guest'),
+        blocked_connection_timeout=60,
+        socket_timeout=60
+    )
+    conn = pika.BlockingConnection(params)
+    ch = conn.channel()
+    ensure_topology(ch)
+    ch.basic_qos(prefetch_count=config.PREFETCH["rules"])
+    ch.basic_consume(queue=config.Q_RULES, on_message_callback=on_tracks, auto_ack=False)
+    control.attach(ch, "rules", {"people": lambda: len(engine.people)}, [config.Q_RULES])
+    startup.mark_ready("rules")
+    logger.info("[rules] running with %d rules.", len(config.RULES))
+    try:
+        ch.start_consuming()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        startup.clear_ready("rules")
+        try:
+            ch.close()
+        finally:
+            conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+Process supervisor for the pipeline, driven by supervisor.json.
+
+    python3 supervisor.py start [-c supervisor.json]   # foreground; Ctrl+C or SIGTERM stops everything
+    python3 supervisor.py stop                         # ask a running supervisor to shut down
+    python3 supervisor.py status
+
+Per service:
+  cpus      CPU set ("2-7,12"); split evenly across replicas and applied with sched_setaffinity
+  threads   intra-op thread budget: OMP/MKL/OpenBLAS env vars, plus INTRA_OP_THREADS which
+            the service applies to torch and cv2 (utils.startup.apply_thread_budget)
+  replicas  processes for this stage; replica n gets SERVICE_REPLICA=n and METRICS_PORT=base+100*n.
+            Keep tracker and linker at 1: their state is per process.
+  enabled   false to skip
+
+Services start downstream-first (each waits for its .ready file) and stop in
+listed order, publisher first, so queues drain towards the logger. Stopping sends
+SIGINT (services save checkpoints in their finally blocks), then SIGTERM, then SIGKILL.
+Crashed workers restart with exponential backoff.
+"""
+import argparse, json, os, signal, subprocess, time, logging
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import config
+from utils import logs
+
+logger = logs.setup("supervisor")
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+PIDFILE = os.path.join(config.READY_DIR, "supervisor.pid")
+THREAD_ENV = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+              "NUMEXPR_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "INTRA_OP_THREADS")
+
+def parse_cpus(spec):
+    cpus = []
+    for part in str(spec).split(","):
+        part = part.strip()
+        if not part: continue
+        if "-" in part:
+            a, b = part.split("-"); cpus.extend(range(int(a), int(b) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def split(cpus, n):
+    """Split a CPU list into n contiguous, near-equal chunks (shared if there are fewer CPUs than replicas)."""
+    if not cpus or n <= 1: return [cpus] * max(n, 1)
+    if len(cpus) < n: return [cpus] * n
+    k, r = divmod(len(cpus), n)
+    out, i = [], 0
+    for j in range(n):
+        step = k + (1 if j < r else 0)
+        out.append(cpus[i:i + step]); i += step
+    return out
+
+class Worker:
+    def __init__(self, spec, replica, replicas, cpus, python, cfg):
+        self.spec, self.cpus, self.python, self.cfg = spec, cpus, python, cfg
+        self.service = spec["name"]
+        self.replica = replica if replicas > 1 else None
+        self.name = self.service if self.replica is None else f"{self.service}.{replica}"
+        self.proc = None
+        self.started_at = 0.0
+        self.backoff = cfg.get("backoff_initial_sec", 1)
+        self.restart_at = None
+
+    @property
+    def ready_file(self):
+        return os.path.join(config.READY_DIR, f"{self.name}.ready")
+
+    def env(self):
+        env = dict(os.environ, PYTHONUNBUFFERED="1")
+        threads = self.spec.get("threads") or (len(self.cpus) if self.cpus else None)
+        if threads:
+            for k in THREAD_ENV: env[k] = str(threads)
+        if self.replica is not None:
+            env["SERVICE_REPLICA"] = str(self.replica)
+            base = config.METRICS_PORTS.get(self.service)
+            if base: env["METRICS_PORT"] = str(base + 100 * self.replica)
+        return env
+
+    def start(self):
+        try: os.remove(self.ready_file)
+        except OSError: pass
+        cpus = set(self.cpus) & os.sched_getaffinity(0)
+        if self.cpus and not cpus:
+            logger.warning("[supervisor] %s: none of cpus %s are available; not pinning", self.name, self.cpus)
+        def pin():
+            os.setpgrp()   # our own Ctrl+C handling decides when children see SIGINT
+            if cpus: os.sched_setaffinity(0, cpus)
+        out = open(os.path.join(config.READY_DIR, f"{self.name}.out"), "ab")
+        self.proc = subprocess.Popen([self.python, os.path.join(ROOT, self.spec["script"])],
+                                     cwd=ROOT, env=self.env(), stdout=out, stderr=subprocess.STDOUT,
+                                     preexec_fn=pin)
+        out.close()
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        logger.info("[supervisor] started %s pid=%d cpus=%s", self.name, self.proc.pid, sorted(cpus) or "all")
+
+    def ready(self):
+        try:
+            with open(self.ready_file) as f:
+                return int(f.read().split()[0]) == self.proc.pid
+        except (OSError, ValueError, IndexError):
+            return False
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def stop(self, timeout):
+        if not self.alive(): return
+        for sig, wait in ((signal.SIGINT, timeout), (signal.SIGTERM, 5), (signal.SIGKILL, 5)):
+            try: self.proc.send_signal(sig)
+            except ProcessLookupError: return
+            try:
+                self.proc.wait(wait); break
+            except subprocess.TimeoutExpired:
+                logger.warning("[supervisor] %s ignored %s", self.name, signal.Signals(sig).name)
+        logger.info("[supervisor] stopped %s (exit %s)", self.name, self.proc.returncode)
+
+class Supervisor:
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.stopping = False
+        self.groups = []   # [(service name, [Worker])] in config order
+        python = cfg.get("python", sys.executable)
+        for spec in cfg["services"]:
+            if not spec.get("enabled", True): continue
+            n = int(spec.get("replicas", 1))
+            chunks = split(parse_cpus(spec.get("cpus", "")), n)
+            self.groups.append((spec["name"], [Worker(spec, i, n, chunks[i], python, cfg) for i in range(n)]))
+
+    def workers(self):
+        return [w for _, ws in self.groups for w in ws]
+
+    def start_all(self):
+        timeout = self.cfg.get("ready_timeout_sec", 120)
+        for name, ws in reversed(self.groups):
+            for w in ws: w.start()
+            deadline = time.monotonic() + timeout
+            while not all(w.ready() for w in ws):
+                if self.stopping: return
+                if any(not w.alive() for w in ws) or time.monotonic() > deadline:
+                    logger.error("[supervisor] %s did not become ready; continuing", name)
+                    break
+                time.sleep(0.2)
+            else:
+                logger.info("[supervisor] %s ready", name)
+
+    def watch(self):
+        stable = self.cfg.get("stable_after_sec", 60)
+        max_backoff = self.cfg.get("backoff_max_sec", 60)
+        while not self.stopping:
+            now = time.monotonic()
+            for w in self.workers():
+                if w.alive():
+                    if now - w.started_at > stable: w.backoff = self.cfg.get("backoff_initial_sec", 1)
+                    continue
+                if w.restart_at is None:
+                    w.restart_at = now + w.backoff
+                    logger.error("[supervisor] %s exited with %s; restarting in %.0fs", w.name, w.proc.returncode, w.backoff)
+                    w.backoff = min(w.backoff * 2, max_backoff)
+                elif now >= w.restart_at:
+                    w.start()
+            time.sleep(0.5)
+
+    def stop_all(self):
+        timeout = self.cfg.get("stop_timeout_sec", 15)
+        for name, ws in self.groups:
+            for w in ws: w.stop(timeout)
+
+def cmd_start(cfg):
+    os.makedirs(config.READY_DIR, exist_ok=True)
+    with open(PIDFILE, "w") as f: f.write(str(os.getpid()))
+    sup = Supervisor(cfg)
+    def on_signal(signum, frame): sup.stopping = True
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    try:
+        sup.start_all()
+        sup.watch()
+    finally:
+        logger.info("[supervisor] stopping services in order...")
+        sup.stop_all()
+        try: os.remove(PIDFILE)
+        except OSError: pass
+
+def cmd_stop(timeout=120):
+    try:
+        with open(PIDFILE) as f: pid = int(f.read())
+    except (OSError, ValueError):
+        logger.error("[supervisor] no running supervisor (%s)", PIDFILE); return 1
+    os.kill(pid, signal.SIGTERM)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try: os.kill(pid, 0)
+        except ProcessLookupError: return 0
+        time.sleep(0.2)
+    logger.error("[supervisor] pid %d still running after %ds", pid, timeout); return 1
+
+def cmd_status(cfg):
+    for spec in cfg["services"]:
+        if not spec.get("enabled", True): continue
+        n = int(spec.get("replicas", 1))
+        for i in range(n):
+            name = spec["name"] if n == 1 else f"{spec['name']}.{i}"
+            path = os.path.join(config.READY_DIR, f"{name}.ready")
+            state = "not ready"
+            try:
+                with open(path) as f: pid, age = f.read().split()
+                os.kill(int(pid), 0)
+                state = f"ready pid={pid} startup={float(age):.1f}s"
+            except (OSError, ValueError):
+                pass
+            print(f"{name:20s} {state}")
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("command", choices=["start", "stop", "status"])
+    ap.add_argument("-c", "--config", default=os.path.join(ROOT, "supervisor.json"))
+    args = ap.parse_args()
+    os.chdir(ROOT)
+    if args.command == "stop":
+        sys.exit(cmd_stop())
+    with open(args.config) as f: cfg = json.load(f)
+    if args.command == "start": cmd_start(cfg)
+    else: cmd_status(cfg)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Periodic, atomic state snapshots for warm restarts.
+
+A checkpoint named `linker` in config.CHECKPOINT_DIR is:
+    linker.ckpt          pickled sidecar: mappings, counters, small objects
+    linker-<gen>.npy     optional array (e.g. gallery embeddings), memory-mapped on load
+
+The consumer thread builds a consistent snapshot (cheap copies) when `due()` says
+so; serialization and fsync happen on a background writer thread. The sidecar is
+replaced last with os.replace, so a crash mid-write leaves the previous
+checkpoint intact and the sidecar never points at a half-written array.
+"""
+import glob, os, pickle, queue, threading, time, logging
+import numpy as np
+import config
+
+logger = logging.getLogger("checkpoint")
+
+def _fsync_replace(tmp, dst):
+    with open(tmp, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, dst)
+
+class Checkpointer:
+    def __init__(self, name, interval_s=None, directory=None):
+        self.name = name
+        self.dir = directory or config.CHECKPOINT_DIR
+        self.interval_s = config.CHECKPOINT_INTERVAL_SEC if interval_s is None else interval_s
+        os.makedirs(self.dir, exist_ok=True)
+        self.sidecar = os.path.join(self.dir, f"{name}.ckpt")
+        self._last = time.monotonic()
+        self._q = queue.Queue(maxsize=1)
+        self._busy = threading.Event()
+        threading.Thread(target=self._writer, name=f"ckpt:{name}", daemon=True).start()
+
+    def due(self):
+        """True when the interval elapsed and the previous snapshot is already on disk."""
+        return (self.interval_s > 0 and not self._busy.is_set()
+                and time.monotonic() - self._last >= self.interval_s)
+
+    def submit(self, meta, array=None):
+        """Hand a snapshot to the writer thread; never blocks the caller."""
+        self._last = time.monotonic()
+        try:
+            self._busy.set()
+            self._q.put_nowait((meta, array))
+        except queue.Full:
+            pass
+
+    def save_now(self, meta, array=None):
+        """Synchronous save, e.g. on shutdown."""
+        self.flush()
+        self._write(meta, array)
+
+    def flush(self, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while self._busy.is_set() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def load(self):
+        """Return (meta, array) from the last complete checkpoint, or (None, None)."""
+        if not os.path.exists(self.sidecar):
+            return None, None
+        try:
+            with open(self.sidecar, "rb") as f:
+                meta = pickle.load(f)
+            array = None
+            if meta.get("_npy"):
+                array = np.load(os.path.join(self.dir, meta["_npy"]), mmap_mode="r")
+            return meta, array
+        except Exception as e:
+            logger.error("[checkpoint] cannot load %s: %s", self.sidecar, e)
+            return None, None
+
+    def _writer(self):
+        while True:
+            meta, array = self._q.get()
+            try:
+                self._write(meta, array)
+            except Exception as e:
+                logger.error("[checkpoint] %s write failed: %s", self.name, e)
+            finally:
+                self._busy.clear()
+
+    def _write(self, meta, array):
+        t0 = time.monotonic()
+        meta = dict(meta)
+        npy = None
+        if array is not None:
+            npy = f"{self.name}-{int(time.time() * 1000)}.npy"
+            tmp = os.path.join(self.dir, f".{npy}.tmp")
+            with open(tmp, "wb") as f:
+                np.save(f, np.ascontiguousarray(array))
+            _fsync_replace(tmp, os.path.join(self.dir, npy))
+        meta["_npy"] = npy
+        tmp = self.sidecar + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+        _fsync_replace(tmp, self.sidecar)
+        # arrays no longer referenced by the sidecar (a loaded mmap keeps its inode alive)
+        for old in glob.glob(os.path.join(self.dir, f"{self.name}-*.npy")):
+            if os.path.basename(old) != npy:
+                try: os.remove(old)
+                except OSError: pass
+        logger.info("[checkpoint] %s saved in %.1f ms", self.name, (time.monotonic() - t0) * 1000)
@@ -12,5 +12,66 @@ def decode_frame_b64(b64):
     frame = cv2.imdecode(arr, cv2.IMREAD_COLOR)
     return frame
 
+def frame_dhash(b64):
+    """64-bit difference hash of a JPEG frame; decodes at 1/8 scale in grayscale, so it costs
+    a fraction of decode_frame_b64. Compare with hamming()."""
+    data = np.frombuffer(base64.b64decode(b64.encode('ascii')), dtype=np.uint8)
+    small = cv2.imdecode(data, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if small is None:
+        raise RuntimeError("Failed to decode frame")
+    g = cv2.resize(small, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (g[:, 1:] > g[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
 def now_ms():
     return int(time.time() * 1000)
+
+def crop(frame, xyxy):
+    x1,y1,x2,y2 = map(int, xyxy); h,w = frame.shape[:2]
+    x1=max(0,min(w-1,x1)); x2=max(0,min(w-1,x2)); y1=max(0,min(h-1,y1)); y2=max(0,min(h-1,y2))
+    return frame[y1:y2, x1:x2]
+
+def encode_crop_b64(img, hw, fmt="jpg", quality=90):
+    # Resize to the ReID input size (H, W) so the wire carries only what the model uses
+    img = cv2.resize(img, (int(hw[1]), int(hw[0])), interpolation=cv2.INTER_AREA)
+    if fmt == "raw":
+        return base64.b64encode(np.ascontiguousarray(img, dtype=np.uint8).tobytes()).decode('ascii')
+    return encode_frame_b64(img, quality)
+
+def decode_crop_b64(b64, hw, fmt="jpg"):
+    if fmt == "raw":
+        data = base64.b64decode(b64.encode('ascii'))
+        return np.frombuffer(data, dtype=np.uint8).reshape(int(hw[0]), int(hw[1]), 3)
+    return decode_frame_b64(b64)
+
+def pack_embedding(unit_vec, fmt="f16"):
+    """Wire fields for an L2-normalized embedding: little-endian float16, or int8 with a scale."""
+    v = np.asarray(unit_vec, dtype=np.float32).reshape(-1)
+    if fmt == "json":
+        return {"embedding": v.tolist()}
+    if fmt == "i8":
+        m = float(np.abs(v).max())
+        scale = m / 127.0 if m > 0 else 1.0
+        q = np.clip(np.rint(v / scale), -127, 127).astype(np.int8)
+        return {"emb_b64": base64.b64encode(q.tobytes()).decode('ascii'), "emb_fmt": "i8", "emb_scale": scale}
+    if fmt == "f16":
+        return {"emb_b64": base64.b64encode(v.astype('<f2').tobytes()).decode('ascii'), "emb_fmt": "f16"}
+    raise ValueError(f"unknown embedding format {fmt!r}")
+
+def unpack_embedding(a):
+    """(vector, scale) from a track dict's wire fields, or None. int8 stays int8 (value ~= q * scale)."""
+    b64 = a.get("emb_b64")
+    if b64 is None:
+        return None
+    data = base64.b64decode(b64.encode('ascii'))
+    if a.get("emb_fmt") == "i8":
+        return np.frombuffer(data, dtype=np.int8), float(a["emb_scale"])
+    return np.frombuffer(data, dtype='<f2'), 1.0
+
+def embedding_scores(mat, scales, q, sq):
+    """Dot products of the (vector, scale) embedding q with every row of mat (one scale per row),
+    as one float32 matvec. int8 x int8 products stay exact: |sum| <= 127 * 127 * dim < 2**24."""
+    return (mat.astype(np.float32) @ q.astype(np.float32)) * scales * np.float32(sq)
@@ -0,0 +1,212 @@
+"""
+On-demand diagnostics over the `control` fanout exchange.
+
+Every service binds a private queue to config.EX_CONTROL (control.attach after its
+channel is set up) and answers JSON commands while it keeps consuming:
+
+    {"cmd": "profile", "seconds": 30, "hz": 50}   sampled stack profile of all threads
+    {"cmd": "profile_stop"}                        end a running profile early (still dumps)
+    {"cmd": "tracemalloc", "seconds": 10, "top": 40}
+                                                   allocation growth over `seconds` (or now, if
+                                                   tracing is already on), top lines by size
+    {"cmd": "sizes"}                               queue depths, caches, galleries, ...
+
+Optional "target": "linker" (service or instance name, default every service).
+Results go to config.PROFILE_DIR as <instance>-<cmd>-<time>.txt (profiles also
+write a .folded file for flamegraph.pl / speedscope) and, when the command
+carries reply_to, back to the sender:
+
+    python -m utils.control profile --seconds 30 --target detector
+    python -m utils.control sizes
+
+The profiler is a plain thread reading sys._current_frames(); nothing is hooked
+into the interpreter, so there is no cost while it is off.
+"""
+import argparse, json, os, sys, threading, time, tracemalloc, logging
+from collections import Counter
+import config
+from utils import startup
+
+logger = logging.getLogger("control")
+
+class Sampler(threading.Thread):
+    """Samples every other thread's stack `hz` times a second for `seconds`."""
+    def __init__(self, seconds, hz, on_done):
+        super().__init__(name="control:profile", daemon=True)
+        self.seconds, self.hz, self.on_done = float(seconds), float(hz), on_done
+        self.stop_event = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        self_counts, cum_counts, folded = Counter(), Counter(), Counter()
+        samples, t0 = 0, time.monotonic()
+        deadline = t0 + self.seconds
+        while not self.stop_event.is_set() and time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == own: continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                if not stack: continue
+                self_counts[stack[0]] += 1
+                for fn in set(stack): cum_counts[fn] += 1
+                folded[(names.get(tid, str(tid)),) + tuple(f"{fn[2]} ({os.path.basename(fn[0])}:{fn[1]})" for fn in reversed(stack))] += 1
+            samples += 1
+            self.stop_event.wait(1.0 / self.hz)
+        self.on_done(samples, time.monotonic() - t0, self_counts, cum_counts, folded)
+
+class Control:
+    """Command handler for one service; `call_soon(fn)` runs fn on the connection's thread."""
+    def __init__(self, service, sizes=None, call_soon=None):
+        self.service = service
+        self.instance = startup.instance_name(service)
+        self.sizes = dict(sizes or {})
+        self.call_soon = call_soon or (lambda fn: fn())
+        self.sampler = None
+
+    def _path(self, cmd, ext="txt"):
+        os.makedirs(config.PROFILE_DIR, exist_ok=True)
+        return os.path.join(config.PROFILE_DIR, f"{self.instance}-{cmd}-{time.strftime('%Y%m%d-%H%M%S')}.{ext}")
+
+    def handle(self, msg, reply):
+        """Run one command. `reply(obj)` may be called later, from another thread."""
+        target = msg.get("target", "*")
+        if target not in ("*", self.service, self.instance):
+            return
+        cmd = msg.get("cmd")
+        base = {"service": self.instance, "pid": os.getpid(), "cmd": cmd}
+        send = lambda **kw: self.call_soon(lambda: reply({**base, **kw}))
+        if cmd == "profile":
+            if self.sampler is not None and self.sampler.is_alive():
+                return send(error="profile already running")
+            self.sampler = Sampler(msg.get("seconds", 30), msg.get("hz", 50),
+                                   lambda *r: send(**self._dump_profile(*r)))
+            self.sampler.start()
+            logger.info("[control] profiling %s for %ss", self.instance, msg.get("seconds", 30))
+        elif cmd == "profile_stop":
+            if self.sampler is not None: self.sampler.stop_event.set()
+        elif cmd == "tracemalloc":
+            threading.Thread(target=self._tracemalloc, args=(msg.get("seconds", 10), msg.get("top", 40), send),
+                             name="control:tracemalloc", daemon=True).start()
+        elif cmd == "sizes":
+            out = {}
+            for name, fn in self.sizes.items():
+                try: out[name] = fn()
+                except Exception as e: out[name] = f"error: {e}"
+            logger.info("[control] sizes %s", out)
+            send(sizes=out)
+        else:
+            send(error=f"unknown command {cmd!r}")
+
+    def _dump_profile(self, samples, elapsed, self_counts, cum_counts, folded):
+        path = self._path("profile")
+        total = sum(self_counts.values()) or 1
+        with open(path, "w") as f:
+            f.write(f"# {self.instance} pid={os.getpid()} samples={samples} seconds={elapsed:.1f} "
+                    f"stacks={total} (all threads; idle threads show up in their wait calls)\n")
+            f.write(f"{'cum%':>7} {'self%':>7} {'cum':>8} {'self':>8}  function\n")
+            for fn, cum in cum_counts.most_common(300):
+                f.write(f"{100.0 * cum / total:7.2f} {100.0 * self_counts[fn] / total:7.2f} {cum:8d} {self_counts[fn]:8d}"
+                        f"  {fn[2]} ({fn[0]}:{fn[1]})\n")
+        folded_path = path[:-4] + ".folded"
+        with open(folded_path, "w") as f:
+            for stack, n in folded.items():
+                f.write(";".join(stack) + f" {n}\n")
+        logger.info("[control] profile written to %s", path)
+        return {"file": path, "folded": folded_path, "samples": samples}
+
+    def _tracemalloc(self, seconds, top, send):
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(16)
+            time.sleep(float(seconds))
+        snap = tracemalloc.take_snapshot()
+        if started: tracemalloc.stop()
+        stats = snap.statistics("lineno")
+        path = self._path("tracemalloc")
+        with open(path, "w") as f:
+            f.write(f"# {self.instance} traced={sum(s.size for s in stats) / 1e6:.1f} MB "
+                    f"({'over ' + str(seconds) + 's' if started else 'since tracing started'})\n")
+            for s in stats[:int(top)]:
+                f.write(f"{s.size / 1024:10.1f} KiB {s.count:8d} blocks  {s.traceback}\n")
+        logger.info("[control] tracemalloc snapshot written to %s", path)
+        send(file=path, traced_mb=round(sum(s.size for s in stats) / 1e6, 2))
+
+def _reply_fn(ch, props):
+    import pika
+    if not props.reply_to:
+        return lambda obj: None
+    return lambda obj: ch.basic_publish(exchange="", routing_key=props.reply_to, body=json.dumps(obj).encode("utf-8"),
+                                        properties=pika.BasicProperties(correlation_id=props.correlation_id))
+
+def queue_depth(ch, queue):
+    """Size provider: ready messages in `queue` (passive declare on a blocking channel)."""
+    return lambda: ch.queue_declare(queue=queue, passive=True).method.message_count
+
+def attach(ch, service, sizes=None, queues=()):
+    """Subscribe a BlockingConnection channel to the control exchange. Call before start_consuming."""
+    sizes = dict(sizes or {})
+    for q in queues: sizes[f"queue.{q}"] = queue_depth(ch, q)
+    ctl = Control(service, sizes, ch.connection.add_callback_threadsafe)
+    ch.exchange_declare(exchange=config.EX_CONTROL, exchange_type='fanout', durable=True)
+    q = ch.queue_declare(queue='', exclusive=True, auto_delete=True).method.queue
+    ch.queue_bind(queue=q, exchange=config.EX_CONTROL)
+    def on_cmd(_ch, method, props, body):
+        try:
+            ctl.handle(json.loads(body.decode("utf-8")), _reply_fn(ch, props))
+        except Exception as e:
+            logger.exception("[control] bad command: %s", e)
+    ch.basic_consume(queue=q, on_message_callback=on_cmd, auto_ack=True)
+    return ctl
+
+def attach_async(conn, service, sizes=None):
+    """Same for a SelectConnection: opens its own channel; call from the IO loop (e.g. on open)."""
+    ctl = Control(service, sizes, conn.ioloop.add_callback_threadsafe)
+    def on_cmd(ch, method, props, body):
+        try:
+            ctl.handle(json.loads(body.decode("utf-8")), _reply_fn(ch, props))
+        except Exception as e:
+            logger.exception("[control] bad command: %s", e)
+    def on_channel(ch):
+        def on_queue(frame):
+            q = frame.method.queue
+            ch.queue_bind(queue=q, exchange=config.EX_CONTROL,
+                          callback=lambda _: ch.basic_consume(queue=q, on_message_callback=on_cmd, auto_ack=True))
+        ch.exchange_declare(exchange=config.EX_CONTROL, exchange_type='fanout', durable=True,
+                            callback=lambda _: ch.queue_declare(queue='', exclusive=True, auto_delete=True, callback=on_queue))
+    conn.channel(on_open_callback=on_channel)
+    return ctl
+
+def main():
+    import uuid, pika
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("cmd", choices=["profile", "profile_stop", "tracemalloc", "sizes"])
+    ap.add_argument("--target", default="*")
+    ap.add_argument("--seconds", type=float, default=None)
+    ap.add_argument("--hz", type=float, default=50)
+    ap.add_argument("--top", type=int, default=40)
+    ap.add_argument("--wait", type=float, default=None, help="seconds to collect replies (default: command duration + 5)")
+    args = ap.parse_args()
+    msg = {"cmd": args.cmd, "target": args.target}
+    if args.cmd == "profile": msg.update(seconds=args.seconds or 30, hz=args.hz)
+    if args.cmd == "tracemalloc": msg.update(seconds=args.seconds or 10, top=args.top)
+    wait = args.wait if args.wait is not None else (msg.get("seconds") or 0) + 5
+
+    conn = pika.BlockingConnection(pika.URLParameters(config.RABBIT_URL))
+    ch = conn.channel()
+    ch.exchange_declare(exchange=config.EX_CONTROL, exchange_type='fanout', durable=True)
+    reply_q = ch.queue_declare(queue='', exclusive=True, auto_delete=True).method.queue
+    ch.basic_consume(queue=reply_q, auto_ack=True,
+                     on_message_callback=lambda c, m, p, body: print(body.decode("utf-8"), flush=True))
+    ch.basic_publish(exchange=config.EX_CONTROL, routing_key='', body=json.dumps(msg).encode("utf-8"),
+                     properties=pika.BasicProperties(reply_to=reply_q, correlation_id=uuid.uuid4().hex))
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        conn.process_data_events(time_limit=min(0.5, max(0.0, deadline - time.monotonic())))
+    conn.close()
+
+if __name__ == "__main__":
+    main()
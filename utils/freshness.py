@@ -0,0 +1,103 @@
+"""
+Freshness policy for live frames.
+
+- declare_queue(): every stage declares queues with the same bounded arguments
+  (max length, drop-head overflow, per-message TTL) from config.QUEUE_LIMITS.
+- Gate: drops messages older than the stage's age budget (config.AGE_BUDGET_MS).
+- LatestPerCam: within one prefetch batch keep only the newest message per camera.
+
+Every drop is counted in pipeline_dropped_total{stage,cam,reason} so a degraded
+pipeline shows up in metrics instead of being silently late.
+"""
+import time
+import config
+from utils import metrics
+
+metrics.describe("pipeline_dropped_total", "counter", "Messages dropped by the freshness policy")
+metrics.describe("pipeline_frame_age_ms", "gauge", "Age of the last frame accepted by a stage")
+
+def queue_args(queue):
+    lim = config.QUEUE_LIMITS.get(queue)
+    if not lim:
+        return None
+    args = {}
+    if lim.get("max_length"):
+        args["x-max-length"] = int(lim["max_length"])
+        args["x-overflow"] = "drop-head"
+    if lim.get("ttl_ms"):
+        args["x-message-ttl"] = int(lim["ttl_ms"])
+    return args or None
+
+def declare_queue(ch, queue, callback=None):
+    """Declare `queue` with its configured limits; pass `callback` on asynchronous (SelectConnection) channels."""
+    if callback is not None:
+        return ch.queue_declare(queue=queue, durable=True, arguments=queue_args(queue), callback=callback)
+    return ch.queue_declare(queue=queue, durable=True, arguments=queue_args(queue))
+
+def dropped(stage, cam_id, reason):
+    metrics.inc("pipeline_dropped_total", stage=stage, cam=cam_id, reason=reason)
+
+class Gate:
+    """Age-budget check for one stage."""
+    def __init__(self, stage):
+        self.stage = stage
+        self.budget_ms = config.AGE_BUDGET_MS.get(stage)
+
+    def stale(self, cam_id, t_ms):
+        age = time.time() * 1000.0 - float(t_ms)
+        metrics.set_gauge("pipeline_frame_age_ms", age, stage=self.stage, cam=cam_id)
+        if self.budget_ms is not None and age > self.budget_ms:
+            dropped(self.stage, cam_id, "stale")
+            return True
+        return False
+
+class LatestPerCam:
+    """
+    Parks incoming messages per camera and processes them once the channel has
+    dispatched everything already delivered (i.e. the rest of the prefetch batch).
+    A message superseded by a newer one from the same camera goes to `on_drop`,
+    which must ack it. With coalescing disabled messages are processed immediately.
+    With `process_batch` the surviving messages of a batch (one per camera) are
+    handed over together, e.g. to advance every camera's tracker in one step.
+
+    process(ch, method, props, msg, span) / on_drop(ch, method, props, msg, span)
+    process_batch([(ch, method, props, msg, span), ...])
+    """
+    def __init__(self, stage, process, on_drop=None, enabled=None, process_batch=None):
+        self.stage = stage
+        self.process = process
+        self.process_batch = process_batch
+        self.on_drop = on_drop or self._ack_drop
+        self.enabled = config.COALESCE_PER_CAM if enabled is None else enabled
+        self.pending = {}   # cam_id -> (ch, method, props, msg, span)
+        self._scheduled = False
+
+    def _ack_drop(self, ch, method, props, msg, span):
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    def offer(self, ch, method, props, msg, span):
+        if not self.enabled:
+            self.process(ch, method, props, msg, span)
+            return
+        item = (ch, method, props, msg, span)
+        cam_id = msg["cam_id"]
+        old = self.pending.get(cam_id)
+        if old is not None:
+            if old[3]["t_ms"] > msg["t_ms"]:
+                old, item = item, old
+            dropped(self.stage, cam_id, "superseded")
+            self.on_drop(*old)
+        self.pending[cam_id] = item
+        if not self._scheduled:
+            self._scheduled = True
+            ch.connection.add_callback_threadsafe(self.flush)
+
+    def flush(self):
+        self._scheduled = False
+        items = list(self.pending.values())
+        self.pending.clear()
+        if self.process_batch is not None:
+            self.process_batch(items)
+            return
+        for item in items:
+            self.process(*item)
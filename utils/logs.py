@@ -0,0 +1,117 @@
+"""
+Shared logging setup for every service.
+
+    logger = logs.setup("detector")
+
+Records go through a QueueHandler; a QueueListener thread does the %-interpolation,
+formatting and file/console I/O, so the hot path only pays for enqueueing. Use %-style
+arguments (logger.info("x=%s", x)), never f-strings: the message is only built
+on the listener thread, and only if the record passes the level, sampling and
+rate-limit checks. Plain values (str, numbers, None) are passed as they are; lists,
+dicts and sets are shallow-copied so later changes do not show up in the log, and
+any other argument type makes the caller build the message itself.
+
+Per message template (the unformatted msg):
+- LOG_SAMPLE_EVERY[template] = N keeps 1 in N records;
+- at most LOG_RATE_PER_MIN records per minute; the rest are dropped and the next
+  record that gets through says how many were suppressed.
+Dropped records are counted in log_suppressed_total{logger}.
+
+Per-frame events belong in metrics counters, not in the log.
+"""
+import atexit, copy, logging, logging.handlers, numbers, os, queue, threading, time
+import config
+from utils import metrics
+
+FORMAT = "%(asctime)s %(levelname)s %(name)s %(message)s"
+
+metrics.describe("log_suppressed_total", "counter", "Log records dropped by sampling or rate limits")
+
+class Throttle(logging.Filter):
+    """Sampling and per-template rate limiting; errors with tracebacks are limited like everything else."""
+    def __init__(self, per_min=None, sample_every=None):
+        super().__init__()
+        self.per_min = config.LOG_RATE_PER_MIN if per_min is None else per_min
+        self.sample_every = dict(config.LOG_SAMPLE_EVERY if sample_every is None else sample_every)
+        self._lock = threading.Lock()
+        self._state = {}   # (logger, template) -> [window start, passed, suppressed, seen]
+
+    def filter(self, record):
+        key = (record.name, record.msg if isinstance(record.msg, str) else type(record.msg).__name__)
+        now = time.monotonic()
+        with self._lock:
+            st = self._state.get(key)
+            if st is None:
+                st = self._state[key] = [now, 0, 0, 0]
+            st[3] += 1
+            every = self.sample_every.get(key[1])
+            if every and (st[3] - 1) % every:
+                return self._drop(record, st)
+            if now - st[0] >= 60.0:
+                st[0], st[1] = now, 0
+            if self.per_min and st[1] >= self.per_min:
+                return self._drop(record, st)
+            st[1] += 1
+            suppressed, st[2] = st[2], 0
+        if suppressed:
+            record.msg = f"{record.msg} (+{suppressed} suppressed)"
+        return True
+
+    def _drop(self, record, st):
+        st[2] += 1
+        metrics.inc("log_suppressed_total", logger=record.name)
+        return False
+
+_PLAIN = (str, bytes, numbers.Number, type(None))
+
+def _detach(v):
+    """v, or a copy of it that the caller can no longer change; TypeError if neither is cheap."""
+    if isinstance(v, _PLAIN):
+        return v
+    if isinstance(v, tuple):
+        return tuple(_detach(x) for x in v)
+    if isinstance(v, (list, dict, set)):
+        return copy.copy(v)
+    raise TypeError(type(v).__name__)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Leave interpolation, timestamps and tracebacks to the listener thread; only detach
+        # the arguments from the caller. Unknown argument types are interpolated here instead.
+        if record.args:
+            try:
+                record.args = ({k: _detach(v) for k, v in record.args.items()} if isinstance(record.args, dict)
+                               else _detach(record.args))
+            except TypeError:
+                record.msg, record.args = record.getMessage(), None
+        return record
+
+_listener = None
+
+def setup(service, level=None, directory=None, console=True):
+    """Configure the root logger once per process and return logging.getLogger(service)."""
+    global _listener
+    if _listener is None:
+        level = level or os.environ.get("LOG_LEVEL") or config.LOG_LEVEL
+        directory = directory or os.environ.get("LOG_DIR") or config.LOG_DIR
+        handlers = []
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            handlers.append(logging.handlers.RotatingFileHandler(
+                os.path.join(directory, f"{service}.log"),
+                maxBytes=config.LOG_MAX_BYTES, backupCount=config.LOG_BACKUPS))
+        if console:
+            handlers.append(logging.StreamHandler())
+        fmt = logging.Formatter(FORMAT)
+        for h in handlers: h.setFormatter(fmt)
+        q = queue.SimpleQueue()
+        qh = _QueueHandler(q)
+        qh.addFilter(Throttle())
+        root = logging.getLogger()
+        for h in list(root.handlers): root.removeHandler(h)
+        root.addHandler(qh)
+        root.setLevel(level)
+        _listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+    return logging.getLogger(service)
@@ -0,0 +1,124 @@
+"""
+Tiny in-process metrics registry with a Prometheus text exporter.
+
+Counters, gauges and histograms are keyed by name + label set. Each service
+calls `serve(port)` once in main() and Prometheus scrapes http://host:port/metrics.
+GET /ready answers 200 once the service has called utils.startup.mark_ready(), 503 before.
+"""
+import bisect, os, threading, logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("metrics")
+
+# milliseconds; covers per-step decode/infer times up to minutes-old frames
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+def _key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+def _fmt_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items: return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._kind = {}     # name -> "counter" | "gauge" | "histogram"
+        self._help = {}     # name -> help text
+        self._values = {}   # (name, labels) -> float       (counters, gauges)
+        self._hists = {}    # (name, labels) -> [buckets, counts, sum, count]
+        self.ready = threading.Event()
+
+    def describe(self, name, kind, help_text):
+        with self._lock:
+            self._kind[name] = kind
+            self._help[name] = help_text
+
+    def inc(self, name, value=1.0, **labels):
+        k = _key(name, labels)
+        with self._lock:
+            self._kind.setdefault(name, "counter")
+            self._values[k] = self._values.get(k, 0.0) + value
+
+    def set(self, name, value, **labels):
+        k = _key(name, labels)
+        with self._lock:
+            self._kind.setdefault(name, "gauge")
+            self._values[k] = float(value)
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS_MS, **labels):
+        k = _key(name, labels)
+        with self._lock:
+            self._kind.setdefault(name, "histogram")
+            h = self._hists.get(k)
+            if h is None:
+                h = self._hists[k] = [tuple(buckets), [0] * (len(buckets) + 1), 0.0, 0]
+            h[1][bisect.bisect_left(h[0], value)] += 1
+            h[2] += value; h[3] += 1
+
+    def snapshot(self):
+        """Return ({key: value}, {key: (buckets, counts, sum, count)}) copies for in-process readers."""
+        with self._lock:
+            return dict(self._values), {k: (h[0], list(h[1]), h[2], h[3]) for k, h in self._hists.items()}
+
+    def render(self):
+        values, hists = self.snapshot()
+        with self._lock:
+            kinds, helps = dict(self._kind), dict(self._help)
+        by_name = {}
+        for (name, labels), v in values.items():
+            by_name.setdefault(name, []).append(("v", labels, v))
+        for (name, labels), h in hists.items():
+            by_name.setdefault(name, []).append(("h", labels, h))
+        lines = []
+        for name in sorted(by_name):
+            if name in helps: lines.append(f"# HELP {name} {helps[name]}")
+            lines.append(f"# TYPE {name} {kinds.get(name, 'untyped')}")
+            for typ, labels, v in by_name[name]:
+                if typ == "v":
+                    lines.append(f"{name}{_fmt_labels(labels)} {v}")
+                    continue
+                buckets, counts, total, n = v
+                cum = 0
+                for le, c in zip(buckets, counts):
+                    cum += c
+                    lines.append(f"{name}_bucket{_fmt_labels(labels, [('le', le)])} {cum}")
+                lines.append(f"{name}_bucket{_fmt_labels(labels, [('le', '+Inf')])} {n}")
+                lines.append(f"{name}_sum{_fmt_labels(labels)} {total}")
+                lines.append(f"{name}_count{_fmt_labels(labels)} {n}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+describe, inc, set_gauge, observe = REGISTRY.describe, REGISTRY.inc, REGISTRY.set, REGISTRY.observe
+
+def serve(port, registry=REGISTRY, host="127.0.0.1"):
+    """
+    Expose `registry` at http://host:port/metrics from a daemon thread. Returns the server.
+    METRICS_PORT in the environment (set per replica by the supervisor) overrides `port`.
+    """
+    port = os.environ.get("METRICS_PORT") or port
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path == "/ready":
+                self.send_response(200 if registry.ready.is_set() else 503); self.end_headers(); return
+            if path != "/metrics":
+                self.send_response(404); self.end_headers(); return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    try:
+        srv = ThreadingHTTPServer((host, int(port)), Handler)
+    except OSError as e:
+        logger.error("[metrics] cannot bind %s:%s: %s", host, port, e)
+        return None
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, name=f"metrics:{port}", daemon=True).start()
+    logger.info("[metrics] serving on http://%s:%d/metrics", host, int(port))
+    return srv
@@ -0,0 +1,164 @@
+"""
+Frame sources for the publisher: V4L2 devices, video files and stream URLs.
+
+    src = open_source(config_value, fps=1.0)
+    while (item := src.read()) is not None:
+        frame, src_ms = item
+
+config_value is what config.CAMERA_SOURCES holds: an int or "/dev/videoN" (V4L2),
+"rtsp://" / "http://" / "udp://" ... (stream), anything else is a file path. A dict
+{"src": ..., "fps": 2, "realtime": False} overrides the per-camera options.
+
+Decoding only happens for frames that are actually sampled:
+- live sources (V4L2, streams) keep grabbing on a reader thread so the driver
+  buffer never goes stale, and retrieve (decode) only the frame due at each tick;
+- files skip ahead with grab() (no retrieve) for short gaps and seek by timestamp
+  for long ones, decoding a few frames ahead on a reader thread.
+
+`fps` may be changed while running. File sources run as fast as possible unless
+realtime=True; for backfills also consider AGE_BUDGET_MS / COALESCE_PER_CAM,
+which would otherwise shed frames the detector cannot keep up with.
+"""
+import queue, threading, time, logging
+import cv2
+
+logger = logging.getLogger("sources")
+
+STREAM_PREFIXES = ("rtsp://", "rtsps://", "rtmp://", "http://", "https://", "udp://", "tcp://")
+# above this many frames to skip, seeking is cheaper than grabbing through them
+MAX_GRAB_SKIP = 15
+
+def open_v4l2(src):
+    cap = cv2.VideoCapture(src, cv2.CAP_V4L2)
+    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH,  640)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+    try: cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    except Exception: pass
+    return cap
+
+def open_stream(url):
+    cap = cv2.VideoCapture(url, cv2.CAP_FFMPEG)
+    try: cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    except Exception: pass
+    return cap
+
+class LiveSource:
+    """Camera or network stream: always the freshest frame, reconnecting with backoff."""
+    live = True
+
+    def __init__(self, src, opener, fps=1.0):
+        self.src, self.opener, self.fps = src, opener, float(fps)
+        self._want = threading.Event()
+        self._got = queue.Queue(maxsize=1)
+        self._stop = threading.Event()
+        self._next_tick = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name=f"src:{src}", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        retry = 0
+        while not self._stop.is_set():
+            cap = self.opener(self.src)
+            if not cap.isOpened():
+                logger.error("[source] cannot open %s; retrying", self.src)
+                time.sleep(min(2 ** retry, 10)); retry = min(retry + 1, 3)
+                continue
+            retry = 0
+            while not self._stop.is_set():
+                # grab() drains the device buffer without decoding; retrieve() only when a frame is due
+                if not cap.grab():
+                    logger.error("[source] read failed on %s; reopening...", self.src)
+                    break
+                if self._want.is_set():
+                    self._want.clear()
+                    ok, frame = cap.retrieve()
+                    self._got.put((frame if ok else None, time.time() * 1000.0))
+            cap.release()
+            time.sleep(min(2 ** retry, 10))
+
+    def read(self):
+        """Block until the next tick and return (frame, t_ms); frame is None after a decode error."""
+        now = time.monotonic()
+        if now < self._next_tick:
+            time.sleep(self._next_tick - now)
+        self._next_tick = max(self._next_tick + 1.0 / self.fps, time.monotonic() - 1.0 / self.fps)
+        self._want.set()
+        while not self._stop.is_set():
+            try:
+                return self._got.get(timeout=0.5)
+            except queue.Empty:
+                continue   # device reopening
+        return None
+
+    def release(self):
+        self._stop.set()
+
+class FileSource:
+    """Video file sampled at `fps` in media time, optionally paced to real time."""
+    live = False
+
+    def __init__(self, path, fps=1.0, realtime=False, prefetch=4):
+        self.path, self.fps, self.realtime = path, float(fps), realtime
+        self._q = queue.Queue(maxsize=prefetch)
+        self._stop = threading.Event()
+        self._t_start = self._media_start = None
+        threading.Thread(target=self._run, name=f"src:{path}", daemon=True).start()
+
+    def _run(self):
+        cap = cv2.VideoCapture(self.path)
+        try:
+            if not cap.isOpened():
+                logger.error("[source] cannot open %s", self.path); return
+            native = cap.get(cv2.CAP_PROP_FPS) or 30.0
+            pos_ms = 0.0   # media time of the next frame to emit
+            cur = 0        # index of the next frame the decoder would return
+            while not self._stop.is_set():
+                target = int(round(pos_ms * native / 1000.0))
+                skip = target - cur
+                if skip > MAX_GRAB_SKIP:
+                    cap.set(cv2.CAP_PROP_POS_MSEC, pos_ms)
+                    cur = target
+                else:
+                    while skip > 0 and cap.grab():
+                        skip -= 1; cur += 1
+                ok, frame = cap.read()
+                if not ok or frame is None:
+                    break
+                cur += 1
+                self._q.put((frame, pos_ms))
+                pos_ms += 1000.0 / self.fps
+        finally:
+            cap.release()
+            self._q.put(None)
+
+    def read(self):
+        """Return (frame, media_ms) or None at end of file."""
+        item = self._q.get()
+        if item is None:
+            self._q.put(None)   # keep returning EOS
+            return None
+        if self.realtime:
+            if self._t_start is None:
+                self._t_start, self._media_start = time.monotonic(), item[1]
+            delay = self._t_start + (item[1] - self._media_start) / 1000.0 - time.monotonic()
+            if delay > 0: time.sleep(delay)
+        return item
+
+    def release(self):
+        self._stop.set()
+        try:
+            while True: self._q.get_nowait()   # unblock the reader
+        except queue.Empty:
+            pass
+
+def open_source(spec, fps=1.0, realtime=None):
+    opts = dict(spec) if isinstance(spec, dict) else {"src": spec}
+    src = opts["src"]
+    fps = float(opts.get("fps", fps))
+    if isinstance(src, int) or (isinstance(src, str) and src.startswith("/dev/video")):
+        return LiveSource(src, open_v4l2, fps)
+    if isinstance(src, str) and src.lower().startswith(STREAM_PREFIXES):
+        return LiveSource(src, open_stream, fps)
+    rt = opts.get("realtime", realtime)
+    return FileSource(src, fps, realtime=bool(rt))
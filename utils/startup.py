@@ -0,0 +1,102 @@
+"""
+Worker startup: load models in the background while the broker connection is
+set up, warm them up on a synthetic input, then signal readiness.
+
+    loader = startup.Loader("detector", load_model)   # starts loading immediately
+    conn = pika.BlockingConnection(params); ...        # overlaps with the load
+    yolo = startup.wait(loader, conn)                   # keeps heartbeats flowing
+    ch.basic_consume(...); startup.mark_ready("detector")
+"""
+import os, sys, threading, time, logging
+import config
+from utils import metrics
+
+logger = logging.getLogger("startup")
+
+metrics.describe("service_startup_seconds", "gauge", "Process start to ready")
+metrics.describe("service_model_load_seconds", "gauge", "Model load + warmup time")
+
+def instance_name(service):
+    """`service`, or `service.<n>` when the supervisor runs several replicas."""
+    replica = os.environ.get("SERVICE_REPLICA")
+    return f"{service}.{replica}" if replica else service
+
+def apply_thread_budget():
+    """
+    Cap intra-op threads of the libraries already imported to INTRA_OP_THREADS (set by the
+    supervisor, which also exports OMP/MKL/OpenBLAS limits). Call after the heavy imports.
+    """
+    n = os.environ.get("INTRA_OP_THREADS")
+    if not n: return None
+    n = int(n)
+    if "cv2" in sys.modules:
+        sys.modules["cv2"].setNumThreads(n)
+    if "torch" in sys.modules:
+        torch = sys.modules["torch"]
+        torch.set_num_threads(n)
+        try: torch.set_num_interop_threads(1)
+        except RuntimeError: pass   # only allowed before the first parallel op
+    return n
+
+def process_age_s():
+    """Seconds since this process started (Linux /proc); 0 if unavailable."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+class Loader:
+    """Runs `fn` on a background thread; get() returns its result or re-raises its error."""
+    def __init__(self, service, fn):
+        self.service = service
+        self._done = threading.Event()
+        self._result = self._error = None
+        self.seconds = None
+        threading.Thread(target=self._run, args=(fn,), name=f"load:{service}", daemon=True).start()
+
+    def _run(self, fn):
+        t0 = time.monotonic()
+        try:
+            self._result = fn()
+        except BaseException as e:
+            self._error = e
+        finally:
+            self.seconds = time.monotonic() - t0
+            metrics.set_gauge("service_model_load_seconds", self.seconds, service=self.service)
+            logger.info("[%s] model loaded + warmed up in %.2fs", self.service, self.seconds)
+            self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def get(self, timeout=None):
+        self._done.wait(timeout)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+def wait(loader, conn=None, poll_s=0.2):
+    """Wait for `loader`, servicing the blocking connection so heartbeats don't lapse."""
+    while not loader.done():
+        if conn is not None: conn.process_data_events(time_limit=poll_s)
+        else: time.sleep(poll_s)
+    return loader.get()
+
+def mark_ready(service):
+    age = process_age_s()
+    metrics.set_gauge("service_startup_seconds", age, service=service)
+    metrics.REGISTRY.ready.set()
+    os.makedirs(config.READY_DIR, exist_ok=True)
+    path = os.path.join(config.READY_DIR, f"{instance_name(service)}.ready")
+    with open(path, "w") as f:
+        f.write(f"{os.getpid()} {age:.3f}\n")
+    logger.info("[%s] ready %.2fs after process start", service, age)
+
+def clear_ready(service):
+    metrics.REGISTRY.ready.clear()
+    try: os.remove(os.path.join(config.READY_DIR, f"{instance_name(service)}.ready"))
+    except OSError: pass
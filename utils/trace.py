@@ -0,0 +1,72 @@
+"""
+End-to-end latency tracing carried in AMQP message headers.
+
+Every stage stamps wall-clock milliseconds into the headers it forwards:
+
+    trace.t0         capture time at the publisher (origin of end-to-end latency)
+    trace.last_pub   when the previous stage published (start of queue wait)
+    <stage>.recv     message received by <stage>
+    <stage>.<step>   end of a named step, e.g. detector.decode, detector.infer
+    <stage>.pub      <stage> published downstream
+
+At publish time the span feeds the metrics registry:
+
+    pipeline_queue_wait_ms{stage,cam}   recv - previous stage's pub
+    pipeline_step_ms{stage,step,cam}    duration of each marked step
+    pipeline_stage_ms{stage,cam}        pub - recv
+    pipeline_e2e_ms{stage,cam}          pub - trace.t0
+"""
+import time
+from utils import metrics
+
+T0 = "trace.t0"
+LAST_PUB = "trace.last_pub"
+
+metrics.describe("pipeline_queue_wait_ms", "histogram", "Time a message waited in the broker before this stage received it")
+metrics.describe("pipeline_step_ms", "histogram", "Duration of a processing step inside a stage")
+metrics.describe("pipeline_stage_ms", "histogram", "Receive-to-publish time inside a stage")
+metrics.describe("pipeline_e2e_ms", "histogram", "Capture-to-publish latency as seen by this stage")
+metrics.describe("pipeline_objects_total", "counter", "Objects a stage produced (detections, tracks, embeddings, links, rows)")
+
+def now():
+    return time.time() * 1000.0
+
+class Span:
+    """One message's passage through one stage."""
+    def __init__(self, stage, props=None):
+        self.stage = stage
+        self.headers = dict(getattr(props, "headers", None) or {})
+        self.cam_id = "unknown"
+        self.t_recv = self._last = now()
+        self.headers[f"{stage}.recv"] = self.t_recv
+        self._steps = []
+
+    def bind(self, cam_id, t_ms=None):
+        """Attach the camera label; fall back to the body's t_ms as origin for untraced messages."""
+        self.cam_id = cam_id
+        if T0 not in self.headers and t_ms is not None:
+            self.headers[T0] = float(t_ms)
+        return self
+
+    def mark(self, step):
+        t = now()
+        self.headers[f"{self.stage}.{step}"] = t
+        self._steps.append((step, t - self._last))
+        self._last = t
+        return t
+
+    def finish(self):
+        """Stamp publish time, record histograms, and return the headers to forward."""
+        t = now()
+        h = self.headers
+        h[f"{self.stage}.pub"] = t
+        labels = {"stage": self.stage, "cam": self.cam_id}
+        if LAST_PUB in h:
+            metrics.observe("pipeline_queue_wait_ms", max(0.0, self.t_recv - h[LAST_PUB]), **labels)
+        for step, dt in self._steps:
+            metrics.observe("pipeline_step_ms", dt, step=step, **labels)
+        metrics.observe("pipeline_stage_ms", t - self.t_recv, **labels)
+        if T0 in h:
+            metrics.observe("pipeline_e2e_ms", max(0.0, t - h[T0]), **labels)
+        h[LAST_PUB] = t
+        return h
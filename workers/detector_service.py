@@ -1,41 +1,61 @@
-import pika, json, numpy as np, logging, traceback
+import pika, json, numpy as np, logging
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
-from ultralytics import YOLO
 from utils.codec import decode_frame_b64
+from utils import metrics, trace, startup, logs, control
+from utils.freshness import declare_queue, Gate, LatestPerCam
 import config
 
-log_dir = "/home/msi/Desktop/logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, "detector_service.log")
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s", handlers=[
-    logging.FileHandler(log_file),
-    logging.StreamHandler()
-])
-logger = logging.getLogger("detector_service")
-yolo = YOLO('yolov8n.pt')
+logger = logs.setup("detector_service")
+yolo = None   # set in main() once load_model() finishes
+
+def load_model():
+    # Heavy import deferred so the process can connect to the broker while torch loads
+    from ultralytics import YOLO
+    startup.apply_thread_budget()
+    model = YOLO(config.DETECTOR_WEIGHTS)
+    # warmup: first call pays for lazy kernel/graph initialization
+    model.predict(np.zeros((480, 640, 3), dtype=np.uint8), conf=config.DETECT_CONF, iou=config.IOU_THRESH,
+                  classes=[config.PERSON_CLASS], verbose=False)
+    return model
 
 # RabbitMQ topology
 def ensure_topology(ch):
     #Subscriber Queue and Exchange Declare
     ch.exchange_declare(exchange=config.EX_FRAMES, exchange_type='direct', durable=True)    
-    ch.queue_declare(queue=config.Q_FRAMES_ANY, durable=True)
+    declare_queue(ch, config.Q_FRAMES_ANY)
     ch.queue_bind(queue=config.Q_FRAMES_ANY, exchange=config.EX_FRAMES, routing_key='raw_frames')
 
     # Queue and Exchange Declare for Publisher Downstream
     ch.exchange_declare(exchange=config.EX_DETECTIONS, exchange_type='direct', durable=True)
-    ch.queue_declare(queue=config.Q_DETS_ANY, durable=True)
+    declare_queue(ch, config.Q_DETS_ANY)
     ch.queue_bind(queue=config.Q_DETS_ANY, exchange=config.EX_DETECTIONS, routing_key='detector_frames')
 
 def on_frame(ch, method, props, body):
     try:
+        span = trace.Span("detector", props)
         msg = json.loads(body.decode('utf-8'))   # JSON only
+        span.bind(msg["cam_id"], msg["t_ms"])
+        # Drop frames past the age budget; keep only the newest per camera when behind
+        if gate.stale(msg["cam_id"], msg["t_ms"]):
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        latest.offer(ch, method, props, msg, span)
+    except Exception as e:
+        logger.exception("detector error: %s", e)
+        try: ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        except Exception: pass
+
+def process_frame(ch, method, props, msg, span):
+    try:
         cam_id = msg["cam_id"]
         frame_id = msg["frame_id"]
         frame = decode_frame_b64(msg["frame_b64"])
+        span.mark("decode")
 
         res = yolo.predict(frame, conf=config.DETECT_CONF, iou=config.IOU_THRESH,
                            classes=[config.PERSON_CLASS], verbose=False)[0]
+        span.mark("infer")
 
         dets = []
         # Convert to [x1,y1,x2,y2,conf,cls]
@@ -49,7 +69,6 @@ def on_frame(ch, method, props, body):
                     x1, y1, x2, y2 = box
                     dets.append([x1, y1, x2, y2, score])
             dets = np.concatenate([xyxy, conf[:,None]], axis=1).tolist()
-        logger.info(f"[Detections Published] with detections {dets} from {cam_id} with Frame number {frame_id}.")
         out = {
             "cam_id": cam_id,
             "t_ms": msg["t_ms"],
@@ -59,16 +78,23 @@ def on_frame(ch, method, props, body):
         }
         ch.basic_publish(exchange=config.EX_DETECTIONS, routing_key=f"detector_frames",
                          body=json.dumps(out).encode('utf-8'),
-                         properties=pika.BasicProperties(delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE))
-        logger.info(f"[Detections Published] with detections {dets} from {cam_id} with Frame number {frame_id}.")
+                         properties=pika.BasicProperties(delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE,
+                                                         headers=span.finish()))
+        metrics.inc("pipeline_objects_total", len(dets), stage="detector", cam=cam_id)
+        logger.debug("[detector] %s frame %s: %d detections", cam_id, frame_id, len(dets))
     except Exception as e:
-        logging.error("detector error: %s\n%s", e, traceback.format_exc())
+        logger.exception("detector error: %s", e)
         try: ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
         except Exception: pass
         return
-    #ch.basic_ack(delivery_tag=method.delivery_tag)
-   
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+
+gate = Gate("detector")
+latest = LatestPerCam("detector", process_frame)
+
 def main():
+    global yolo
+    loader = startup.Loader("detector", load_model)
     #params = pika.URLParameters(config.RABBIT_URL)
     params = pika.ConnectionParameters(
                                         host='localhost',        # RabbitMQ server hostname or IP
@@ -78,16 +104,21 @@ def main():
                                         blocked_connection_timeout=60,
                                         socket_timeout=60
                                         )
+    metrics.serve(config.METRICS_PORTS["detector"])
     conn = pika.BlockingConnection(params)
     ch = conn.channel()
     ensure_topology(ch)
-    #ch.basic_qos(prefetch_count=32)
+    yolo = startup.wait(loader, conn)
+    # a bounded prefetch batch is what LatestPerCam coalesces over
+    ch.basic_qos(prefetch_count=config.PREFETCH["detector"])
     ch.basic_consume(queue=config.Q_FRAMES_ANY, on_message_callback=on_frame, auto_ack=False)
+    control.attach(ch, "detector", {"coalesce_pending": lambda: len(latest.pending)}, [config.Q_FRAMES_ANY])
 
+    startup.mark_ready("detector")
     logger.info("[detector] running.")
     try: ch.start_consuming()
     except KeyboardInterrupt: pass
-    finally: ch.close(); conn.close()
+    finally: startup.clear_ready("detector"); ch.close(); conn.close()
 
 if __name__ == "__main__":
     main()
@@ -1,17 +1,15 @@
-import pika, json, numpy as np, logging, traceback
+import pika, json, numpy as np, logging
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 import config
-from collections import deque, defaultdict
+from utils import metrics, trace, startup, logs, control
+from utils.freshness import declare_queue, Gate
+from utils.checkpoint import Checkpointer
+from utils.codec import unpack_embedding, embedding_scores
+from collections import defaultdict, OrderedDict
+from bisect import bisect_left, bisect_right
 
-log_dir = "/home/msi/Desktop/logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, "linker_service.log")
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s", handlers=[
-    logging.FileHandler(log_file),
-    logging.StreamHandler()
-])
-logger = logging.getLogger("linker_service")
+logger = logs.setup("linker_service")
 
 def _to_unit(vec: np.ndarray) -> np.ndarray:
     """Return L2-normalized float32 1D vector; handle zeros/NaNs robustly."""
@@ -23,46 +21,176 @@ def _to_unit(vec: np.ndarray) -> np.ndarray:
         return np.zeros_like(v, dtype=np.float32)
     return (v / n).astype(np.float32, copy=False)
 
+def build_edges(topology):
+    """[(cam_a, cam_b, min_ms, max_ms), ...] -> {cam: {neighbour: (min_ms, max_ms)}}; edges work both ways."""
+    edges = defaultdict(dict)
+    for a, b, lo, hi in topology or ():
+        edges[a][b] = edges[b][a] = (int(lo), int(hi))
+    return dict(edges)
+
+class SubGallery:
+    """
+    One camera's recent embeddings, sorted by t_ms. t and gid are lists (time ranges are a
+    bisect); embeddings are one contiguous (capacity, dim) array with a parallel scale vector,
+    so a time range is scored with a single matvec. int8 rows stay int8; float16 rows are
+    widened to float32 once on insert (exact), since numpy's per-query f16 -> f32 cast costs
+    several times the matvec itself.
+    """
+    __slots__ = ("t", "gid", "emb", "scale")
+
+    def __init__(self):
+        self.t, self.gid = [], []
+        self.emb, self.scale = None, None
+
+    def __len__(self):
+        return len(self.t)
+
+    def add(self, t_ms, gid, emb, scale):
+        n = len(self.t)
+        if emb.dtype != np.int8:
+            emb = emb.astype(np.float32, copy=False)
+        if self.emb is None:
+            self.emb, self.scale = np.empty((64, emb.shape[0]), emb.dtype), np.empty(64, np.float32)
+        elif emb.dtype != self.emb.dtype:
+            # mixed wire formats: int8 rows widen to float32 (scales still apply per row)
+            if self.emb.dtype == np.int8:
+                self.emb = self.emb.astype(np.float32)
+            emb = emb.astype(np.float32)
+        if n == len(self.emb):
+            self.emb = np.concatenate([self.emb, np.empty_like(self.emb)])
+            self.scale = np.concatenate([self.scale, np.empty_like(self.scale)])
+        # a camera's messages arrive in order, so this is almost always an append
+        i = n if not n or t_ms >= self.t[-1] else bisect_right(self.t, t_ms)
+        if i < n:
+            self.emb[i + 1:n + 1] = self.emb[i:n]
+            self.scale[i + 1:n + 1] = self.scale[i:n]
+        self.emb[i], self.scale[i] = emb, scale
+        self.t.insert(i, t_ms); self.gid.insert(i, gid)
+
+    def between(self, lo_ms, hi_ms):
+        return range(bisect_left(self.t, lo_ms), bisect_right(self.t, hi_ms))
+
+    def best(self, idx, q, sq):
+        """(index, similarity) of the closest embedding to (q, sq) in index range idx."""
+        s = embedding_scores(self.emb[idx.start:idx.stop], self.scale[idx.start:idx.stop], q, sq)
+        k = int(s.argmax())
+        return idx.start + k, float(s[k])
+
+    def rows(self):
+        return self.emb[:len(self.t)], self.scale[:len(self.t)]
+
+    def trim(self, before_ms, maxlen, slack=64):
+        """Drop entries older than before_ms or beyond maxlen, in batches of `slack` to keep it amortized O(1)."""
+        n = len(self.t)
+        k = max(bisect_left(self.t, before_ms), n - maxlen)
+        if k >= slack or n > maxlen + slack:
+            del self.t[:k]; del self.gid[:k]
+            self.emb[:n - k] = self.emb[k:n]
+            self.scale[:n - k] = self.scale[k:n]
+
 class Linker:
     """
     Assigns a stable global_id (gid) across cameras using embedding similarity.
-    Stores recent, L2-normalized embeddings in a time-windowed gallery.
+    Stores recent, L2-normalized embeddings in per-camera, time-sorted sub-galleries.
+    With a camera `topology` a track is only compared against cameras that can hand off
+    to its camera, at transit times within that edge's [min_ms, max_ms]; cameras missing
+    from the topology compare against every other camera within `window_ms`.
+    (cam_id, track_id) mappings not seen for `track_ttl_ms` are evicted.
     """
-    def __init__(self, sim_thr: float, window_ms: int):
+    def __init__(self, sim_thr: float, window_ms: int, track_ttl_ms: int = 0, topology=None, max_per_cam: int = 5000):
         self.sim_thr = float(sim_thr)
         self.window_ms = int(window_ms)
+        self.track_ttl_ms = int(track_ttl_ms or 0)
+        self.max_per_cam = int(max_per_cam)
+        self.edges = build_edges(topology)
+        # how long an embedding can still be a candidate for any camera
+        self.horizon_ms = max([self.window_ms] + [hi for nb in self.edges.values() for _, hi in nb.values()])
         self.next_gid = 1
-        # recent embeddings with {gid, cam_id, emb (unit vec), t_ms}
-        self.gallery = deque(maxlen=5000)
+        # cam_id -> SubGallery of {gid, emb (unit vec as received: f16/i8/f32), scale, t_ms}
+        self.gallery: dict[str, SubGallery] = {}
+        self.last_candidates = 0
         # per-camera local track -> gid mapping
         self.cam_track_gid: dict[str, dict[int, int]] = defaultdict(dict)
+        # (cam_id, tid) -> last seen t_ms, least recently seen first; touch and evict are O(1)
+        self.track_seen: OrderedDict = OrderedDict()
+        self.now_ms = 0
+
+    def _touch(self, cam_id: str, tid: int, t_ms: int):
+        key = (cam_id, tid)
+        self.track_seen[key] = max(t_ms, self.track_seen.get(key, t_ms))
+        self.track_seen.move_to_end(key)
+        self.now_ms = max(self.now_ms, t_ms)
 
-    @staticmethod
-    def cos(a: np.ndarray, b: np.ndarray) -> float:
-        # embeddings are already unit vectors -> cosine == dot product
-        return float(np.dot(a, b))
+    def evict(self, now_ms: int = None) -> int:
+        """Drop mappings idle for longer than track_ttl_ms. Returns how many were removed."""
+        if not self.track_ttl_ms:
+            return 0
+        cutoff = (self.now_ms if now_ms is None else now_ms) - self.track_ttl_ms
+        n = 0
+        while self.track_seen:
+            (cam_id, tid), seen = next(iter(self.track_seen.items()))
+            if seen >= cutoff:
+                break
+            self.track_seen.popitem(last=False)
+            m = self.cam_track_gid.get(cam_id)
+            if m is not None:
+                m.pop(tid, None)
+                if not m: del self.cam_track_gid[cam_id]
+            n += 1
+        return n
+
+    def mapping_count(self) -> int:
+        return len(self.track_seen)
+
+    def gallery_size(self) -> int:
+        return sum(len(sub) for sub in self.gallery.values())
 
-    def assign(self, cam_id: str, tid: int, emb: np.ndarray, t_ms: int) -> int:
+    def _add(self, cam_id: str, gid: int, emb: np.ndarray, scale: float, t_ms: int):
+        sub = self.gallery.get(cam_id)
+        if sub is None:
+            sub = self.gallery[cam_id] = SubGallery()
+        sub.add(t_ms, gid, emb, scale)
+        sub.trim(self.now_ms - self.horizon_ms, self.max_per_cam)
+
+    def _candidates(self, cam_id: str, t_ms: int):
+        """(SubGallery, index range) pairs that could be the same person as a track on cam_id at t_ms."""
+        nbrs = self.edges.get(cam_id)
+        if nbrs is None:
+            for other, sub in self.gallery.items():
+                if other != cam_id:
+                    yield sub, sub.between(t_ms - self.window_ms, float("inf"))
+            return
+        for other, (lo, hi) in nbrs.items():
+            sub = self.gallery.get(other)
+            if sub is None: continue
+            # either side may be seen first (overlapping views, delivery skew)
+            if lo <= 0:
+                yield sub, sub.between(t_ms - hi, t_ms + hi)
+            else:
+                yield sub, sub.between(t_ms - hi, t_ms - lo)
+                yield sub, sub.between(t_ms + lo, t_ms + hi)
+
+    def assign(self, cam_id: str, tid: int, emb: np.ndarray, t_ms: int, scale: float = 1.0) -> int:
         # 1) Fast path: if this camera's track already has a gid, reuse it
         if tid in self.cam_track_gid[cam_id]:
             gid = self.cam_track_gid[cam_id][tid]
+            self._touch(cam_id, tid, t_ms)
             # still update the gallery with the latest embedding snapshot
-            self.gallery.append({"gid": gid, "cam_id": cam_id, "emb": emb, "t_ms": t_ms})
+            self._add(cam_id, gid, emb, scale, t_ms)
+            self.last_candidates = 0
             return gid
 
-        # 2) Cross-camera match search within the time window
+        # 2) Cross-camera match search, restricted to plausible cameras and transit times;
+        # embeddings are unit vectors, so cosine == dot product, one matvec per time range
         best_gid, best_sim = None, -1.0
-        cutoff = t_ms - self.window_ms
-
-        # Assumes approximate time ordering by append; if not guaranteed, remove the 'break'
-        for item in reversed(self.gallery):
-            if item["t_ms"] < cutoff:
-                break
-            if item["cam_id"] == cam_id:
-                continue
-            s = self.cos(emb, item["emb"])
+        n = 0
+        for sub, idx in self._candidates(cam_id, t_ms):
+            if not len(idx): continue
+            n += len(idx)
+            i, s = sub.best(idx, emb, scale)
             if s > best_sim:
-                best_gid, best_sim = item["gid"], s
+                best_gid, best_sim = sub.gid[i], s
+        self.last_candidates = n
 
         # 3) Decide gid
         if best_gid is not None and best_sim >= self.sim_thr:
@@ -73,62 +201,128 @@ class Linker:
 
         # 4) Record mapping and gallery
         self.cam_track_gid[cam_id][tid] = gid
-        self.gallery.append({"gid": gid, "cam_id": cam_id, "emb": emb, "t_ms": t_ms})
+        self._touch(cam_id, tid, t_ms)
+        self._add(cam_id, gid, emb, scale, t_ms)
+        return gid
+
+    def lookup(self, cam_id: str, tid: int, t_ms: int):
+        """gid of an already linked track without a fresh embedding (crop mode), else None."""
+        gid = self.cam_track_gid.get(cam_id, {}).get(tid)
+        if gid is not None:
+            self._touch(cam_id, tid, t_ms)
         return gid
 
-linker = Linker(config.SIM_THRESHOLD, config.MERGE_WINDOW_MS)
+    def snapshot(self):
+        """(meta, embeddings) copy of the linker state for Checkpointer."""
+        subs = list(self.gallery.items())
+        # kept in gallery precision (int8 rows become float32 if formats are mixed; scales stay per row)
+        rows = [sub.rows() for _, sub in subs if len(sub)]
+        embs = np.concatenate([e for e, _ in rows]) if rows else None
+        meta = {
+            "next_gid": self.next_gid,
+            "gids": [g for _, sub in subs for g in sub.gid],
+            "scales": [float(s) for _, sc in rows for s in sc],
+            "cam_ids": [c for c, sub in subs for _ in range(len(sub))],
+            "t_ms": [t for _, sub in subs for t in sub.t],
+            "cam_track_gid": {c: dict(m) for c, m in self.cam_track_gid.items()},
+            "track_seen": list(self.track_seen.items()),
+        }
+        return meta, embs
+
+    def restore(self, meta, embs):
+        self.next_gid = int(meta["next_gid"])
+        self.cam_track_gid = defaultdict(dict, {c: dict(m) for c, m in meta["cam_track_gid"].items()})
+        self.now_ms = max(meta["t_ms"], default=0)
+        seen = meta.get("track_seen") or [((c, tid), self.now_ms) for c, m in self.cam_track_gid.items() for tid in m]
+        self.track_seen = OrderedDict((tuple(k), t) for k, t in seen)
+        self.gallery = {}
+        if embs is not None:
+            # rows are copied out of the memory-mapped array into each camera's sub-gallery
+            scales = meta.get("scales") or [1.0] * len(meta["gids"])
+            for gid, cam_id, t_ms, emb, scale in zip(meta["gids"], meta["cam_ids"], meta["t_ms"], embs, scales):
+                self._add(cam_id, gid, emb, scale, t_ms)
+
+linker = Linker(config.SIM_THRESHOLD, config.MERGE_WINDOW_MS, config.LINK_TRACK_TTL_MS, config.CAMERA_TOPOLOGY)
+metrics.describe("linker_track_mappings", "gauge", "Live (cam_id, track_id) -> global_id mappings")
+metrics.describe("linker_gallery_size", "gauge", "Embeddings in the linker gallery")
+metrics.describe("linker_comparisons_total", "counter", "Gallery embeddings compared against new tracks")
+metrics.describe("linker_evicted_total", "counter", "Track mappings evicted after LINK_TRACK_TTL_MS idle")
+gate = Gate("linker")
+ckpt = None   # set in main(): the writer thread and checkpoint directory are not import side effects
 
 def ensure_topology(ch):
     ch.exchange_declare(exchange=config.EX_REID, exchange_type='direct', durable=True)
-    ch.queue_declare(queue=config.Q_REID_ANY, durable=True)
+    declare_queue(ch, config.Q_REID_ANY)
     ch.queue_bind(queue=config.Q_REID_ANY, exchange=config.EX_REID, routing_key='reid_frames')
 
     ch.exchange_declare(exchange=config.EX_GLOBAL_TRACKS, exchange_type='direct', durable=True)
-    ch.queue_declare(queue=config.Q_DISPLAY, durable=True)
+    declare_queue(ch, config.Q_DISPLAY)
     ch.queue_bind(queue=config.Q_DISPLAY, exchange=config.EX_GLOBAL_TRACKS, routing_key='global_track_frames')
 
 def on_reid(ch, method, props, body):
     try:
+        span = trace.Span("linker", props)
         data = json.loads(body.decode('utf-8'))
         cam_id = data["cam_id"]
         t_ms = int(data["t_ms"])
+        span.bind(cam_id, t_ms)
+        if gate.stale(cam_id, t_ms):
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
         tracks = data.get("tracks", [])
-        logger.info(f"[Linker] processing {len(tracks)} tracks from cam={cam_id}")
 
+        compared = 0
         for a in tracks:
-            emb_raw = a.get("embedding")
-            if emb_raw is None:
+            # packed embeddings arrive normalized; compare them as received
+            packed = unpack_embedding(a)
+            if packed is not None:
+                emb, scale = packed
+            elif a.get("embedding") is not None:
+                # legacy float list: normalize once; store and compare as unit vector
+                emb, scale = _to_unit(a["embedding"]), 1.0
+            else:
+                gid = linker.lookup(cam_id, int(a["track_id"]), t_ms)
+                if gid is not None: a["global_id"] = int(gid)
                 continue
-            # Normalize once; store and compare as unit vector
-            emb = _to_unit(emb_raw)
             if emb.size == 0 or not np.isfinite(emb).all():
                 continue  # skip bad embeddings
 
             tid = int(a["track_id"])
-            gid = linker.assign(cam_id, tid, emb, t_ms)
+            gid = linker.assign(cam_id, tid, emb, t_ms, scale)
+            compared += linker.last_candidates
             a["global_id"] = int(gid)
 
-            # Optional: trim payload to reduce bandwidth
-            # a.pop("embedding", None)
+            # embeddings are of no use downstream
+            for k in ("emb_b64", "emb_fmt", "emb_scale", "embedding"): a.pop(k, None)
+        span.mark("infer")
+        if compared: metrics.inc("linker_comparisons_total", compared)
+        metrics.inc("pipeline_objects_total", sum("global_id" in a for a in tracks), stage="linker", cam=cam_id)
+        evicted = linker.evict()
+        if evicted: metrics.inc("linker_evicted_total", evicted)
+        metrics.set_gauge("linker_track_mappings", linker.mapping_count())
+        metrics.set_gauge("linker_gallery_size", linker.gallery_size())
 
         ch.basic_publish(
             exchange=config.EX_GLOBAL_TRACKS,
             routing_key="global_track_frames",
             body=json.dumps(data).encode('utf-8'),
-            properties=pika.BasicProperties(delivery_mode=2),
+            properties=pika.BasicProperties(delivery_mode=2, headers=span.finish()),
         )
 
         # ACK only after successful publish
         ch.basic_ack(delivery_tag=method.delivery_tag)
+        if ckpt is not None and ckpt.due():
+            ckpt.submit(*linker.snapshot())
 
     except Exception as e:
-        logging.error("linker error: %s\n%s", e, traceback.format_exc())
+        logger.exception("linker error: %s", e)
         try:
             ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
         except Exception:
             pass
 
 def main():
+    global ckpt
     params = pika.ConnectionParameters(
         host='localhost',
         port=5672,
@@ -137,18 +331,29 @@ def main():
         blocked_connection_timeout=60,
         socket_timeout=60
     )
+    metrics.serve(config.METRICS_PORTS["linker"])
+    ckpt = Checkpointer("linker")
+    meta, embs = ckpt.load()
+    if meta is not None:
+        linker.restore(meta, embs)
+        logger.info("[linker] restored %d gallery entries, next_gid=%d", linker.gallery_size(), linker.next_gid)
     conn = pika.BlockingConnection(params)
     ch = conn.channel()
     ensure_topology(ch)
     # let the broker throttle deliveries for steadier processing
-    ch.basic_qos(prefetch_count=8)
+    ch.basic_qos(prefetch_count=config.PREFETCH["linker"])
     ch.basic_consume(queue=config.Q_REID_ANY, on_message_callback=on_reid, auto_ack=False)
+    control.attach(ch, "linker", {"gallery": linker.gallery_size, "mappings": linker.mapping_count,
+                                  "gallery_cams": lambda: len(linker.gallery)}, [config.Q_REID_ANY])
+    startup.mark_ready("linker")
     logger.info("[linker] running.")
     try:
         ch.start_consuming()
     except KeyboardInterrupt:
         pass
     finally:
+        startup.clear_ready("linker")
+        ckpt.save_now(*linker.snapshot())
         try:
             ch.close()
         finally:
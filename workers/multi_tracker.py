@@ -0,0 +1,284 @@
+"""
+Multi-camera ByteTrack in NumPy.
+
+TrackerManager keeps the tracks of every camera in one set of arrays (a camera
+index per row) and advances all cameras of a batch together: one Kalman predict
+and one Kalman update over the stacked tracks, and per association step one IoU
+computation over all cameras, padded to (cameras, tracks, detections). Only the
+assignment itself (linear_sum_assignment) runs per camera. The association
+follows ByteTrack (yolox.tracker.byte_tracker): high-score detections against
+tracked and lost tracks, low-score detections against the remaining tracked
+ones, then unconfirmed tracks against the high-score detections left over.
+
+Frame timing comes from the messages. Each camera's frame interval is the
+median of its recent t_ms deltas. A message after a gap (dropped frames, a
+slower publisher) advances the camera by that many frames, so the Kalman
+prediction covers the gap and lost tracks age by elapsed time. Lost tracks are
+kept for TRACK_LOST_SEC at the measured frame rate.
+"""
+import math
+from collections import deque
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+import config
+
+TRACKED, LOST = 1, 2
+STD_POS, STD_VEL = 1.0 / 20, 1.0 / 160   # ByteTrack's Kalman noise, relative to box height
+_I4, _I8 = np.arange(4), np.arange(8)
+
+def to_xyah(tlbr):
+    w, h = tlbr[:, 2] - tlbr[:, 0], tlbr[:, 3] - tlbr[:, 1]
+    return np.stack([tlbr[:, 0] + w / 2, tlbr[:, 1] + h / 2, w / np.maximum(h, 1e-6), h], axis=1)
+
+def to_tlbr(mean):
+    h = mean[:, 3]; w = mean[:, 2] * h
+    x1, y1 = mean[:, 0] - w / 2, mean[:, 1] - h / 2
+    return np.stack([x1, y1, x1 + w, y1 + h], axis=1)
+
+def batch_iou(a, b):
+    """(C, N, 4) x (C, M, 4) tlbr boxes -> (C, N, M) IoU within each camera."""
+    a, b = a[:, :, None, :], b[:, None, :, :]
+    iw = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    ih = np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    inter = iw * ih
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    return inter / np.maximum(area_a + area_b - inter, 1e-9)
+
+def kalman_initiate(xyah):
+    n, h = len(xyah), xyah[:, 3]
+    mean = np.zeros((n, 8)); mean[:, :4] = xyah
+    std = np.stack([2 * STD_POS * h, 2 * STD_POS * h, np.full(n, 1e-2), 2 * STD_POS * h,
+                    10 * STD_VEL * h, 10 * STD_VEL * h, np.full(n, 1e-5), 10 * STD_VEL * h], axis=1)
+    cov = np.zeros((n, 8, 8)); cov[:, _I8, _I8] = std ** 2
+    return mean, cov
+
+def kalman_predict(mean, cov, steps):
+    """Constant-velocity step over `steps` frames per row (process noise grows linearly with steps)."""
+    n, h, k = len(mean), mean[:, 3], steps.astype(np.float64)
+    q = np.stack([STD_POS * h, STD_POS * h, np.full(n, 1e-2), STD_POS * h,
+                  STD_VEL * h, STD_VEL * h, np.full(n, 1e-5), STD_VEL * h], axis=1) ** 2 * k[:, None]
+    F = np.tile(np.eye(8), (n, 1, 1)); F[:, _I4, _I4 + 4] = k[:, None]
+    mean = mean.copy(); mean[:, :4] += k[:, None] * mean[:, 4:]
+    cov = F @ cov @ F.transpose(0, 2, 1)
+    cov[:, _I8, _I8] += q
+    return mean, cov
+
+def kalman_update(mean, cov, xyah):
+    n, h = len(mean), mean[:, 3]
+    r = np.stack([STD_POS * h, STD_POS * h, np.full(n, 1e-1), STD_POS * h], axis=1) ** 2
+    S = cov[:, :4, :4].copy(); S[:, _I4, _I4] += r
+    K = np.linalg.solve(S, cov[:, :4, :]).transpose(0, 2, 1)   # P H^T S^-1, S and P symmetric
+    mean = mean + (K @ (xyah - mean[:, :4])[:, :, None])[:, :, 0]
+    cov = cov - K @ S @ K.transpose(0, 2, 1)
+    return mean, cov
+
+def _pack(slot, n_slots, values):
+    """Scatter rows into (n_slots, max rows per slot, ...) by slot.
+    Returns the padded values, rows per slot and (slot, rank) -> row position."""
+    counts = np.bincount(slot, minlength=n_slots)
+    order = np.argsort(slot, kind="stable")
+    starts = np.cumsum(counts) - counts
+    rank = np.empty(len(slot), np.int64)
+    rank[order] = np.arange(len(slot)) - starts[slot[order]]
+    width = int(counts.max(initial=0))
+    out = np.zeros((n_slots, width) + values.shape[1:], values.dtype)
+    out[slot, rank] = values
+    pos = np.full((n_slots, width), -1, np.int64)
+    pos[slot, rank] = np.arange(len(slot))
+    return out, counts, pos
+
+class _Clock:
+    """Frame counter of one camera, advanced by the number of frame intervals between messages."""
+    __slots__ = ("frame", "last_t", "deltas")
+
+    def __init__(self):
+        self.frame, self.last_t = 0, None
+        self.deltas = deque(maxlen=config.TRACK_FPS_WINDOW)
+
+    def interval_ms(self):
+        if not self.deltas:
+            return 1000.0 / config.TRACK_DEFAULT_FPS
+        return sorted(self.deltas)[len(self.deltas) // 2]
+
+    def max_lost(self):
+        return max(1, math.ceil(config.TRACK_LOST_SEC * 1000.0 / self.interval_ms()))
+
+    def tick(self, t_ms):
+        steps = 1
+        if self.last_t is not None and t_ms > self.last_t:
+            self.deltas.append(t_ms - self.last_t)
+            steps = min(max(1, round((t_ms - self.last_t) / self.interval_ms())), self.max_lost() + 1)
+        if self.last_t is None or t_ms > self.last_t:
+            self.last_t = t_ms
+        self.frame += steps
+        return steps
+
+class TrackerManager:
+    """ByteTrack for every camera; update_batch() advances the cameras of one batch together."""
+    def __init__(self, track_thresh=None, match_thresh=None):
+        self.track_thresh = config.TRACK_THRESH if track_thresh is None else track_thresh
+        self.match_thresh = config.TRACK_MATCH_THRESH if match_thresh is None else match_thresh
+        self.det_thresh = self.track_thresh + 0.1
+        self.cams = {}      # cam_id -> camera index
+        self.clocks = []    # camera index -> _Clock
+        self.next_id = 0
+        self.cam = np.zeros(0, np.int64)
+        self.tid = np.zeros(0, np.int64)
+        self.mean = np.zeros((0, 8))
+        self.cov = np.zeros((0, 8, 8))
+        self.score = np.zeros(0, np.float32)
+        self.state = np.zeros(0, np.int8)
+        self.activated = np.zeros(0, bool)
+        self.start = np.zeros(0, np.int64)
+        self.end = np.zeros(0, np.int64)
+
+    def __len__(self):
+        return len(self.tid)
+
+    def fps(self, cam_id):
+        return 1000.0 / self.clocks[self.cams[cam_id]].interval_ms()
+
+    def _index(self, cam_id):
+        i = self.cams.get(cam_id)
+        if i is None:
+            i = self.cams[cam_id] = len(self.clocks)
+            self.clocks.append(_Clock())
+        return i
+
+    def update(self, cam_id, t_ms, dets):
+        return self.update_batch([(cam_id, t_ms, dets)])[0]
+
+    def update_batch(self, items):
+        """
+        items: [(cam_id, t_ms, dets (N, 5) [x1, y1, x2, y2, score])]
+        returns per item (track ids (K,), tlbr boxes (K, 4), scores (K,)) of the confirmed tracks.
+        A camera that appears more than once is advanced once per message, in order.
+        """
+        out, rounds = [None] * len(items), []
+        for i, (cam_id, _, _) in enumerate(items):
+            for r in rounds:
+                if cam_id not in r:
+                    r[cam_id] = i; break
+            else:
+                rounds.append({cam_id: i})
+        for r in rounds:
+            idx = list(r.values())
+            for i, res in zip(idx, self._step([items[i] for i in idx])):
+                out[i] = res
+        return out
+
+    def _associate(self, t_rows, t_slot, d_rows, d_slot, boxes, dets, n_slots, thresh, fuse):
+        """Match tracks to detections within each camera; returns matched positions into t_rows and d_rows."""
+        if len(t_rows) == 0 or len(d_rows) == 0:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64)
+        a, na, pa = _pack(t_slot, n_slots, boxes)
+        b, nb, pb = _pack(d_slot, n_slots, dets[d_rows])
+        sim = batch_iou(a, b[..., :4])
+        if fuse:
+            sim = sim * b[:, None, :, 4]   # ByteTrack's fuse_score: IoU weighted by detection score
+        mt, md = [], []
+        for s in np.flatnonzero((na > 0) & (nb > 0)):
+            cost = 1.0 - sim[s, :na[s], :nb[s]]
+            r, c = linear_sum_assignment(np.where(cost > thresh, 1e6, cost))
+            ok = cost[r, c] <= thresh
+            mt.append(pa[s, r[ok]]); md.append(pb[s, c[ok]])
+        if not mt:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64)
+        return np.concatenate(mt), np.concatenate(md)
+
+    def _step(self, items):
+        B = len(items)
+        ci = np.array([self._index(cam_id) for cam_id, _, _ in items], np.int64)
+        steps = np.array([self.clocks[c].tick(int(t)) for c, (_, t, _) in zip(ci, items)], np.int64)
+        frame = np.array([self.clocks[c].frame for c in ci], np.int64)
+        max_lost = np.array([self.clocks[c].max_lost() for c in ci], np.int64)
+        slot_of = np.full(len(self.clocks), -1, np.int64); slot_of[ci] = np.arange(B)
+        slot = slot_of[self.cam]
+        sel = slot >= 0
+
+        dl = [np.asarray(d, np.float32).reshape(-1, 5) for _, _, d in items]
+        D = np.concatenate(dl).astype(np.float64) if dl else np.zeros((0, 5))
+        dslot = np.repeat(np.arange(B), [len(d) for d in dl])
+        score = D[:, 4]
+        hi = np.flatnonzero(score > self.track_thresh)
+        lo = np.flatnonzero((score > 0.1) & (score < self.track_thresh))
+
+        # Predict tracked and lost tracks; unconfirmed ones stay put, as in ByteTrack
+        pool = np.flatnonzero(sel & self.activated)
+        if len(pool):
+            m = self.mean[pool]
+            m[self.state[pool] != TRACKED, 7] = 0
+            self.mean[pool], self.cov[pool] = kalman_predict(m, self.cov[pool], steps[slot[pool]])
+
+        # 1. tracked + lost vs high-score detections
+        t1, d1 = self._associate(pool, slot[pool], hi, dslot[hi], to_tlbr(self.mean[pool]), D, B,
+                                 self.match_thresh, fuse=True)
+        # 2. unmatched tracked vs low-score detections; still unmatched -> lost
+        rest = np.delete(pool, t1)
+        rest = rest[self.state[rest] == TRACKED]
+        t2, d2 = self._associate(rest, slot[rest], lo, dslot[lo], to_tlbr(self.mean[rest]), D, B, 0.5, fuse=False)
+        # 3. unconfirmed vs the high-score detections left; still unmatched -> removed
+        unconf = np.flatnonzero(sel & ~self.activated)
+        hi_left = np.delete(hi, d1)
+        t3, d3 = self._associate(unconf, slot[unconf], hi_left, dslot[hi_left], to_tlbr(self.mean[unconf]), D, B,
+                                 0.7, fuse=True)
+
+        # Kalman update for every match of every camera at once
+        rows = np.concatenate([pool[t1], rest[t2], unconf[t3]])
+        drows = np.concatenate([hi[d1], lo[d2], hi_left[d3]])
+        if len(rows):
+            self.mean[rows], self.cov[rows] = kalman_update(self.mean[rows], self.cov[rows], to_xyah(D[drows, :4]))
+            self.state[rows] = TRACKED
+            self.activated[rows] = True
+            self.score[rows] = score[drows]
+            self.end[rows] = frame[slot[rows]]
+        self.state[np.delete(rest, t2)] = LOST
+        removed = np.zeros(len(self.tid), bool)
+        removed[np.delete(unconf, t3)] = True
+        sel_rows = np.flatnonzero(sel)
+        too_old = frame[slot[sel_rows]] - self.end[sel_rows] > max_lost[slot[sel_rows]]
+        removed[sel_rows[(self.state[sel_rows] == LOST) & too_old]] = True
+
+        # New tracks from confident unmatched detections (confirmed on a camera's first frame only)
+        new = np.delete(hi_left, d3)
+        new = new[score[new] >= self.det_thresh]
+        if len(new):
+            n = len(new)
+            mean, cov = kalman_initiate(to_xyah(D[new, :4]))
+            nslot = dslot[new]
+            self.cam = np.concatenate([self.cam, ci[nslot]])
+            self.tid = np.concatenate([self.tid, self.next_id + 1 + np.arange(n)]); self.next_id += n
+            self.mean = np.concatenate([self.mean, mean]); self.cov = np.concatenate([self.cov, cov])
+            self.score = np.concatenate([self.score, score[new].astype(np.float32)])
+            self.state = np.concatenate([self.state, np.full(n, TRACKED, np.int8)])
+            self.activated = np.concatenate([self.activated, frame[nslot] == 1])
+            self.start = np.concatenate([self.start, frame[nslot]]); self.end = np.concatenate([self.end, frame[nslot]])
+            removed = np.concatenate([removed, np.zeros(n, bool)])
+            slot = np.concatenate([slot, nslot])
+
+        # Drop the younger of a tracked/lost pair that overlap almost completely
+        live = np.flatnonzero((slot >= 0) & ~removed)
+        tr = live[self.state[live] == TRACKED]; ls = live[self.state[live] == LOST]
+        if len(tr) and len(ls):
+            a, na, pa = _pack(slot[tr], B, to_tlbr(self.mean[tr]))
+            b, nb, pb = _pack(slot[ls], B, to_tlbr(self.mean[ls]))
+            s, i, j = np.nonzero(batch_iou(a, b) > 0.85)
+            ok = (i < na[s]) & (j < nb[s])
+            p, q = tr[pa[s[ok], i[ok]]], ls[pb[s[ok], j[ok]]]
+            age_p = frame[slot[p]] - self.start[p]; age_q = frame[slot[q]] - self.start[q]
+            removed[np.where(age_p > age_q, q, p)] = True
+
+        if removed.any():
+            keep = ~removed
+            for name in ("cam", "tid", "mean", "cov", "score", "state", "activated", "start", "end"):
+                setattr(self, name, getattr(self, name)[keep])
+            slot = slot[keep]
+
+        shown = np.flatnonzero((slot >= 0) & (self.state == TRACKED) & self.activated)
+        boxes, shown_slot = to_tlbr(self.mean[shown]), slot[shown]
+        out = []
+        for s in range(B):
+            k = shown_slot == s
+            out.append((self.tid[shown[k]], boxes[k], self.score[shown[k]]))
+        return out
@@ -1,34 +1,37 @@
 # This script assigns cropped (from detections) ReID embeddings to tracks 
 
-import pika, json, numpy as np, cv2, logging, traceback
-import torchvision, torchreid
-from torchreid.utils import FeatureExtractor
+import pika, json, numpy as np, cv2, logging
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 import config
+from utils import metrics, trace, startup, logs, control
+from utils.freshness import declare_queue, Gate, LatestPerCam
+from utils.codec import crop, decode_crop_b64, pack_embedding
 
-log_dir = "/home/msi/Desktop/logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, "reid_service.log")
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s", handlers=[
-    logging.FileHandler(log_file),
-    logging.StreamHandler()
-])
-logger = logging.getLogger("reid_service")
+logger = logs.setup("reid_service")
 
-# ReID model (TorchReID)
-extractor = FeatureExtractor(model_name=config.REID_MODEL, model_path='osnet_x0_25_msmt17',device='cuda' if cv2.cuda.getCudaEnabledDeviceCount()>0 else 'cpu')
-logger.info(f"[Feature Extractor Initialised]")
+# ReID model (TorchReID), set in main() once load_model() finishes
+extractor = None
+
+def load_model():
+    # torch/torchreid imports take seconds; deferred so the broker connection is set up meanwhile
+    from torchreid.utils import FeatureExtractor
+    startup.apply_thread_budget()
+    ext = FeatureExtractor(model_name=config.REID_MODEL, model_path='osnet_x0_25_msmt17',device='cuda' if cv2.cuda.getCudaEnabledDeviceCount()>0 else 'cpu')
+    # warmup on a synthetic person-sized crop (OSNet input is 256x128)
+    ext([np.zeros((256, 128, 3), dtype=np.uint8)])
+    logger.info("[reid] feature extractor initialised")
+    return ext
 # RabbitMQ topology
 def ensure_topology(ch):
     #Subscriber Queue and Exchange Declare
     ch.exchange_declare(exchange=config.EX_TRACKS, exchange_type='direct', durable=True)
-    ch.queue_declare(queue=config.Q_TRACKS_ANY, durable=True)
+    declare_queue(ch, config.Q_TRACKS_ANY)
     ch.queue_bind(queue=config.Q_TRACKS_ANY, exchange=config.EX_TRACKS, routing_key='tracker_frames')
 
     # Queue and Exchange Declare for Publisher Downstream
     ch.exchange_declare(exchange=config.EX_REID, exchange_type='direct', durable=True)
-    ch.queue_declare(queue=config.Q_REID_ANY, durable=True)
+    declare_queue(ch, config.Q_REID_ANY)
     ch.queue_bind(queue=config.Q_REID_ANY, exchange=config.EX_REID, routing_key='reid_frames')
 
 def decode_frame_b64(b64):
@@ -37,25 +40,65 @@ def decode_frame_b64(b64):
     arr = np.frombuffer(data, dtype=np.uint8)
     return cv2.imdecode(arr, cv2.IMREAD_COLOR)
 
-def crop(frame, xyxy):
-    x1,y1,x2,y2 = map(int, xyxy); h,w = frame.shape[:2]
-    x1=max(0,min(w-1,x1)); x2=max(0,min(w-1,x2)); y1=max(0,min(h-1,y1)); y2=max(0,min(h-1,y2))
-    return frame[y1:y2, x1:x2]
+# cam_id -> {track_id: (crop_b64, crop_fmt)} from crop-mode messages dropped here (stale or
+# superseded). The tracker sends a track's crop only every REID_REFRESH_MS, so a dropped crop is
+# handed to the next processed message of the camera instead of leaving a new track unlinked.
+carried = {}
+CARRY_MAX = 256   # per camera
+
+def carry_crops(data):
+    if "crop_fmt" not in data: return
+    c = carried.setdefault(data["cam_id"], {})
+    for a in data.get("tracks", []):
+        if "crop_b64" in a:
+            c.pop(a["track_id"], None)
+            c[a["track_id"]] = (a["crop_b64"], data["crop_fmt"])
+    while len(c) > CARRY_MAX:
+        del c[next(iter(c))]
+
+def drop_tracks(ch, method, props, data, span):
+    carry_crops(data)
+    ch.basic_ack(delivery_tag=method.delivery_tag)
 
 def on_tracks(ch, method, props, body):
-    try:    
+    try:
+        span = trace.Span("reid", props)
         data = json.loads(body.decode('utf-8'))
+        span.bind(data["cam_id"], data["t_ms"])
+        if gate.stale(data["cam_id"], data["t_ms"]):
+            drop_tracks(ch, method, props, data, span)
+            return
+        latest.offer(ch, method, props, data, span)
+    except Exception as e:
+        logger.exception("reid error: %s", e)
+        try: ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        except Exception: pass
+
+def process_tracks(ch, method, props, data, span):
+    try:
         cam_id = data["cam_id"]
-        # Base64 -> bytes -> NumPy buffer -> cv2.imdecode -> BGR image.
-        frame = decode_frame_b64(data["frame_b64"])
         crops, idx = [], []
-        logger.info(f"[ReID Processing] with {len(data['tracks'])} tracks from {cam_id}")
-        #Clips coords to image bounds and extracts the person patch from the frame.
-        for a in data["tracks"]:
-            c = crop(frame, a["bbox"])
-            if c.size == 0: continue
-            crops.append(c[:,:,::-1])  # convert BGR → RGB for the model
-            idx.append(a) # keep a reference to the original track dict
+        if "crop_fmt" in data:
+            # The tracker already cropped and resized the tracks that need an embedding;
+            # the others keep their global_id in the linker.
+            prev = carried.pop(cam_id, {})
+            for a in data["tracks"]:
+                b64, fmt = a.pop("crop_b64", None), data["crop_fmt"]
+                if b64 is None:
+                    if a["track_id"] not in prev: continue
+                    b64, fmt = prev[a["track_id"]]
+                crops.append(decode_crop_b64(b64, config.REID_INPUT_HW, fmt)[:,:,::-1])
+                idx.append(a)
+        else:
+            # Base64 -> bytes -> NumPy buffer -> cv2.imdecode -> BGR image.
+            frame = decode_frame_b64(data["frame_b64"])
+            #Clips coords to image bounds and extracts the person patch from the frame.
+            for a in data["tracks"]:
+                c = crop(frame, a["bbox"])
+                if c.size == 0: continue
+                crops.append(c[:,:,::-1])  # convert BGR → RGB for the model
+                idx.append(a) # keep a reference to the original track dict
+        span.mark("decode")
         if crops:
             # Runs all crops as a batch through the TorchReID model.
             embs = extractor(crops)  # NxD
@@ -63,23 +106,31 @@ def on_tracks(ch, method, props, body):
             embs = embs / (embs.norm(p=2, dim=1, keepdim=True) + 1e-12)   # L2 normalize along D
             embs_np = embs.cpu().numpy().astype(np.float32)
             # L2-normalizes each embedding vector and writes it back into the same data["tracks"] elements
-            # idx holds references to those dicts
+            # idx holds references to those dicts; packed binary (EMBED_WIRE_FORMAT) instead of float lists
             for a, e_np in zip(idx, embs_np):
-                a["embedding"] = e_np.tolist()
-        out = {"cam_id": cam_id, "t_ms": data["t_ms"], "frame_id": data["frame_id"],
-            "frame_b64": data["frame_b64"], "tracks": data["tracks"]}
+                a.update(pack_embedding(e_np, config.EMBED_WIRE_FORMAT))
+        span.mark("infer")
+        out = {"cam_id": cam_id, "t_ms": data["t_ms"], "frame_id": data["frame_id"], "tracks": data["tracks"]}
+        if "frame_b64" in data:
+            out["frame_b64"] = data["frame_b64"]
         ch.basic_publish(exchange=config.EX_REID, routing_key="reid_frames",
                         body=json.dumps(out).encode('utf-8'),
-                        properties=pika.BasicProperties(delivery_mode=2))
-        logger.info(f"[ReID Published] to {config.EX_REID} with {len(data['tracks'])} tracks")
+                        properties=pika.BasicProperties(delivery_mode=2, headers=span.finish()))
+        metrics.inc("pipeline_objects_total", len(idx), stage="reid", cam=cam_id)
+        logger.debug("[reid] %s: %d tracks, %d embedded", cam_id, len(data["tracks"]), len(idx))
     except Exception as e:
-        logging.error("reid error: %s\n%s", e, traceback.format_exc())
+        logger.exception("reid error: %s", e)
         try: ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
         except Exception: pass
         return
-    #ch.basic_ack(delivery_tag=method.delivery_tag)
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+
+gate = Gate("reid")
+latest = LatestPerCam("reid", process_tracks, on_drop=drop_tracks)
 
 def main():
+    global extractor
+    loader = startup.Loader("reid", load_model)
     #params = pika.URLParameters(config.RABBIT_URL)
     params = pika.ConnectionParameters(
                                         host='localhost',        # RabbitMQ server hostname or IP
@@ -89,16 +140,21 @@ def main():
                                         blocked_connection_timeout=60,
                                         socket_timeout=60
                                         )
+    metrics.serve(config.METRICS_PORTS["reid"])
     conn = pika.BlockingConnection(params)
     ch = conn.channel()
     ensure_topology(ch)
-    #ch.basic_qos(prefetch_count=2)
+    extractor = startup.wait(loader, conn)
+    ch.basic_qos(prefetch_count=config.PREFETCH["reid"])
     ch.basic_consume(queue=config.Q_TRACKS_ANY, on_message_callback=on_tracks, auto_ack=False)
+    control.attach(ch, "reid", {"coalesce_pending": lambda: len(latest.pending),
+                                "carried_crops": lambda: sum(len(c) for c in carried.values())}, [config.Q_TRACKS_ANY])
 
+    startup.mark_ready("reid")
     logger.info("[reid] running.")
     try: ch.start_consuming()
     except KeyboardInterrupt: pass
-    finally: ch.close(); conn.close()
+    finally: startup.clear_ready("reid"); ch.close(); conn.close()
 
 if __name__ == "__main__":
     main()
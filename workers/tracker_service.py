@@ -1,58 +1,28 @@
-import pika, json, numpy as np, cv2, traceback, logging
-from types import SimpleNamespace
-from yolox.tracker.byte_tracker import BYTETracker
+import pika, json, pickle, numpy as np, cv2, logging
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 import config
+from utils import metrics, trace, startup, logs, control
+from utils.codec import crop, encode_crop_b64
+from utils.freshness import declare_queue, Gate, LatestPerCam
+from utils.checkpoint import Checkpointer
+from workers.multi_tracker import TrackerManager
 
-log_dir = "/home/msi/Desktop/logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, "tracker_service.log")
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s", handlers=[
-    logging.FileHandler(log_file),
-    logging.StreamHandler()
-])
-logger = logging.getLogger("tracker_service")
-
-class PerCamTracker:
-    """
-    Per-camera ByteTrack wrapper with sane defaults.
-    BYTETracker requires an `args` namespace; we create it here.
-    """
-    def __init__(self, frame_rate=30,
-                 track_thresh=0.50,     # min det score to start/keep a track
-                 match_thresh=0.80,     # IoU for matching detections to tracks
-                 track_buffer=30,       # keep "lost" tracks this many frames
-                 min_box_area=10,       # filter tiny boxes
-                 mot20=False):          # special tuning for MOT20 (usually False)
-        args = SimpleNamespace(
-            track_thresh=track_thresh,
-            match_thresh=match_thresh,
-            track_buffer=track_buffer,
-            min_box_area=min_box_area,
-            mot20=mot20
-        )
-        self.tracker = BYTETracker(args, frame_rate=frame_rate)
-
-    def update(self, dets, frame):
-        """
-        dets: np.ndarray (N, 5) -> [x1, y1, x2, y2, score] (float32 recommended)
-        frame: BGR image (H, W, 3)
-        returns: list[STrack] with .tlwh and .track_id
-        """
-        H, W = frame.shape[:2]
-        return self.tracker.update(dets, [H, W], [H, W])
+logger = logs.setup("tracker_service")
+
+metrics.describe("tracker_batch_cams", "histogram", "Cameras advanced together in one tracker update")
+metrics.describe("tracker_cam_fps", "gauge", "Frame rate the tracker measures from each camera's t_ms")
 
 # RabbitMQ topology
 def ensure_topology(ch):
     #Subscriber Queue and Exchange Declare
     ch.exchange_declare(exchange=config.EX_DETECTIONS, exchange_type='direct', durable=True)
-    ch.queue_declare(queue=config.Q_DETS_ANY, durable=True)
+    declare_queue(ch, config.Q_DETS_ANY)
     ch.queue_bind(queue=config.Q_DETS_ANY, exchange=config.EX_DETECTIONS, routing_key='detector_frames')
 
     # Queue and Exchange Declare for Publisher Downstream
     ch.exchange_declare(exchange=config.EX_TRACKS, exchange_type='direct', durable=True)
-    ch.queue_declare(queue=config.Q_TRACKS_ANY, durable=True)
+    declare_queue(ch, config.Q_TRACKS_ANY)
     ch.queue_bind(queue=config.Q_TRACKS_ANY, exchange=config.EX_TRACKS, routing_key='tracker_frames')
 
 def decode_frame_b64(b64):
@@ -62,60 +32,128 @@ def decode_frame_b64(b64):
     return cv2.imdecode(arr, cv2.IMREAD_COLOR)
 
 
-#Each camera (cam_id) gets its own BYTETracker instance.
-#Those tracker instances live in the state["per_cam"] dictionary.
-#When a new frame from the same camera arrives, you call .update() on the same tracker, so it remembers previous tracks.
-state = {"per_cam": {}}
+#One TrackerManager holds the ByteTrack state of every camera (see workers/multi_tracker.py).
+#The cameras of one prefetch batch are advanced together; each camera's frame rate comes from its t_ms.
+state = {"tracker": TrackerManager(), "reid_seen": {}}
+
+def snapshot():
+    # Pickle on the consumer thread so the copy is consistent; the writer thread only does I/O.
+    # Track ids (TrackerManager.next_id) are part of the pickle, so they do not restart at 1.
+    return {"tracker": pickle.dumps(state["tracker"], protocol=pickle.HIGHEST_PROTOCOL)}
+
+def restore(meta):
+    if "tracker" not in meta:
+        logger.warning("[tracker] checkpoint from the per-camera BYTETracker version ignored; starting fresh")
+        return False
+    state["tracker"] = pickle.loads(meta["tracker"])
+    return True
+
+def attach_crops(cam_id, frame, annots, t_ms):
+    # Crop forwarding: only tracks that are new or due a refresh carry a crop; the linker
+    # reuses the known global_id for the rest. A new track's first REID_NEW_TRACK_CROPS crops go
+    # out every REID_RETRY_MS, so one dropped message downstream does not leave it unlinked
+    # for a whole REID_REFRESH_MS.
+    seen = state["reid_seen"].setdefault(cam_id, {})   # track_id -> [last crop t_ms, crops sent]
+    for a in annots:
+        last = seen.get(a["track_id"])
+        if last is not None:
+            every = config.REID_RETRY_MS if last[1] < config.REID_NEW_TRACK_CROPS else config.REID_REFRESH_MS
+            if t_ms - last[0] < every:
+                continue
+        c = crop(frame, a["bbox"])
+        if c.size == 0: continue
+        a["crop_b64"] = encode_crop_b64(c, config.REID_INPUT_HW, config.REID_CROP_FORMAT)
+        seen[a["track_id"]] = [t_ms, 1 if last is None else last[1] + 1]
+    # forget tracks not refreshed for a long time
+    if len(seen) > 4 * len(annots) + 64:
+        for tid in [tid for tid, (t, _) in seen.items() if t_ms - t > 10 * config.REID_REFRESH_MS]:
+            del seen[tid]
+
+def as_dets(data):
+    # Ensure dets is (N, 5) float32: [x1,y1,x2,y2,score]
+    return np.asarray(data["detections"],dtype=np.float32) if data["detections"] else np.zeros((0,5),dtype=np.float32)
+
+def advance_only(ch, method, props, data, span):
+    # Dropped frames still advance the Kalman state so tracks stay continuous; nothing is published.
+    try:
+        state["tracker"].update(data["cam_id"], int(data["t_ms"]), as_dets(data))
+    finally:
+        ch.basic_ack(delivery_tag=method.delivery_tag)
 
 def on_detections(ch, method, props, body):
-    try:    
+    try:
+        span = trace.Span("tracker", props)
         data = json.loads(body.decode('utf-8'))
+        span.bind(data["cam_id"], data["t_ms"])
+        if gate.stale(data["cam_id"], data["t_ms"]):
+            advance_only(ch, method, props, data, span)
+            return
+        latest.offer(ch, method, props, data, span)
+    except Exception as e:
+        logger.exception("tracker error: %s", e)
+        try: ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        except Exception: pass
+
+def process_detections(ch, method, props, data, span):
+    process_batch([(ch, method, props, data, span)])
+
+def process_batch(items):
+    # One tracker step for every camera in the batch: the Kalman and IoU work is stacked across cameras
+    try:
+        results = state["tracker"].update_batch(
+            [(data["cam_id"], int(data["t_ms"]), as_dets(data)) for _, _, _, data, _ in items])
+    except Exception as e:
+        logger.exception("tracker error: %s", e)
+        for ch, method, *_ in items:
+            try: ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            except Exception: pass
+        return
+    metrics.observe("tracker_batch_cams", len(items))
+    for item, res in zip(items, results):
+        publish_tracks(*item, res)
+    if ckpt is not None and ckpt.due():
+        ckpt.submit(snapshot())
+
+def publish_tracks(ch, method, props, data, span, res):
+    try:
         cam_id = data["cam_id"]
-        frame = decode_frame_b64(data["frame_b64"])
-        # Ensure dets is (N, 5) float32: [x1,y1,x2,y2,score]
-        dets = np.asarray(data["detections"],dtype=np.float32) if data["detections"] else np.zeros((0,5),dtype=np.float32)
-        if cam_id not in state["per_cam"]: 
-            state["per_cam"][cam_id] = PerCamTracker(frame_rate=1)
-        # Tracks
-        tracks = state["per_cam"][cam_id].update(dets, frame)
-        logger.info(f"[Tracks Detected] with detections {dets} from {cam_id}")
-
-        # Convert STrack objects to publishing JSON schema
-        annots = []
-        for t in tracks:
-            # t.tlwh: (x, y, w, h) floats
-            x1, y1, x2, y2 = map(int, t.tlbr)
-            #x1, y1, x2, y2 = x, y, x + w, y + h
-
-            # t.track_id: integer persistent ID within this camera/session
-            tid = int(t.track_id)
-
-            # Some builds set 'score' and 'cls' on STrack; guard with getattr
-            conf = float(getattr(t, "score", 0.0))
-            #cls_ = int(getattr(t, "cls", -1))
-
-            annots.append({
-                "track_id": tid,
-                "bbox": [x1, y1, x2, y2],
-                "conf": conf,
-                #"cls": cls_
-            })
+        span.mark("infer")
+        metrics.set_gauge("tracker_cam_fps", state["tracker"].fps(cam_id), cam=cam_id)
+        tids, boxes, scores = res
+        logger.debug("[tracker] %s: %d detections -> %d tracks", cam_id, len(data["detections"]), len(tids))
+
+        # Convert tracks to publishing JSON schema
+        annots = [{"track_id": int(tid), "bbox": [int(v) for v in box], "conf": float(conf)}
+                  for tid, box, conf in zip(tids, boxes, scores)]
         out = {
-            "cam_id": cam_id, "t_ms": data["t_ms"], "frame_id": data["frame_id"],
-            "frame_b64": data["frame_b64"], "tracks": annots
+            "cam_id": cam_id, "t_ms": data["t_ms"], "frame_id": data["frame_id"], "tracks": annots
         }
+        if config.REID_CROP_MODE:
+            # The tracker itself never needs pixels; decode only to cut the crops
+            frame = decode_frame_b64(data["frame_b64"])
+            span.mark("decode")
+            attach_crops(cam_id, frame, annots, int(data["t_ms"]))
+            out["crop_fmt"] = config.REID_CROP_FORMAT
+            span.mark("crop")
+        if config.FORWARD_FULL_FRAME.get(cam_id, True):
+            out["frame_b64"] = data["frame_b64"]
         ch.basic_publish(exchange=config.EX_TRACKS, routing_key=f"tracker_frames",
                         body=json.dumps(out).encode('utf-8'),
-                        properties=pika.BasicProperties(delivery_mode=2))
+                        properties=pika.BasicProperties(delivery_mode=2, headers=span.finish()))
     
     except Exception as e:
-        logging.error("tracker error: %s\n%s", e, traceback.format_exc())
+        logger.exception("tracker error: %s", e)
         try: ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
         except Exception: pass
         return
-    #ch.basic_ack(delivery_tag=method.delivery_tag)
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+
+gate = Gate("tracker")
+latest = LatestPerCam("tracker", process_detections, on_drop=advance_only, process_batch=process_batch)
+ckpt = None   # set in main(): the writer thread and checkpoint directory are not import side effects
 
 def main():
+    global ckpt
     #params = pika.URLParameters(config.RABBIT_URL)
     params = pika.ConnectionParameters(
                                         host='localhost',        # RabbitMQ server hostname or IP
@@ -125,15 +163,26 @@ def main():
                                         blocked_connection_timeout=60,
                                         socket_timeout=60
                                         )
+    startup.apply_thread_budget()
+    metrics.serve(config.METRICS_PORTS["tracker"])
+    ckpt = Checkpointer("tracker")
+    meta, _ = ckpt.load()
+    if meta is not None and restore(meta):
+        logger.info("[tracker] restored %d tracks on %d cameras", len(state["tracker"]), len(state["tracker"].cams))
     conn = pika.BlockingConnection(params)
     ch = conn.channel()
     ensure_topology(ch)
-    #ch.basic_qos(prefetch_count=4)
+    ch.basic_qos(prefetch_count=config.PREFETCH["tracker"])
     ch.basic_consume(queue=config.Q_DETS_ANY, on_message_callback=on_detections, auto_ack=False)
+    control.attach(ch, "tracker", {"cameras": lambda: len(state["tracker"].cams),
+                                   "tracks": lambda: len(state["tracker"]),
+                                   "reid_seen": lambda: sum(len(m) for m in state["reid_seen"].values()),
+                                   "coalesce_pending": lambda: len(latest.pending)}, [config.Q_DETS_ANY])
+    startup.mark_ready("tracker")
     logger.info("[tracker] running.")
     try: ch.start_consuming()
     except KeyboardInterrupt: pass
-    finally: ch.close(); conn.close()
+    finally: startup.clear_ready("tracker"); ckpt.save_now(snapshot()); ch.close(); conn.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file